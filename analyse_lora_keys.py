@@ -2,15 +2,295 @@
 """
 LoRA Inspector - Analyze and visualize LoRA file structure
 Usage: python lora_inspector.py input_path [--detailed] [--export]
+       python lora_inspector.py --index loras.sqlite --scan /models/loras
+       python lora_inspector.py --index loras.sqlite --component ffn --min-block 30
 """
 
 import argparse
 import sys
 import os
 import json
+import re
+import sqlite3
+import time
 from collections import defaultdict, Counter
-import safetensors.torch
-import torch
+from concurrent.futures import ThreadPoolExecutor
+from safetensors_io import LazySafetensors
+
+
+FORMAT_LABELS = {
+    "comfyui": "ComfyUI/WAN format detected (diffusion_model.blocks.*)",
+    "diffsynth": "DiffSynth format detected (blocks.* without diffusion_model prefix)",
+    "lora_unet": "Standard Diffusers format detected (lora_unet.*)",
+    "unknown": "Unknown format - manual analysis needed",
+}
+
+# "diffusion_model.blocks.12.ffn.0" and "lora_unet_blocks_12_ffn_0" -> block 12, component "ffn.0" / "ffn_0"
+BLOCK_RE = re.compile(r"blocks[._](\d+)[._](.+)$")
+MODULE_SUFFIXES = (
+    ".lora_down.weight", ".lora_up.weight", ".lora_A.default.weight", ".lora_B.default.weight",
+    ".lora_A.weight", ".lora_B.weight", ".alpha", ".diff_b", ".diff",
+)
+DOWN_SUFFIXES = (".lora_down.weight", ".lora_A.weight", ".lora_A.default.weight")
+
+
+def detect_format(keys):
+    """Single pass over the keys; same precedence as the checks the inspector always printed."""
+    seen = set()
+    for k in keys:
+        if "diffusion_model.blocks." in k:
+            return "comfyui"
+        if k.startswith("blocks."):
+            seen.add("diffsynth")
+        elif "lora_unet" in k:
+            seen.add("lora_unet")
+    for fmt in ("diffsynth", "lora_unet"):
+        if fmt in seen:
+            return fmt
+    return "unknown"
+
+
+def split_module(key):
+    """(module name, suffix) of a LoRA key, e.g. ('...ffn.0', '.lora_down.weight')."""
+    for suffix in MODULE_SUFFIXES:
+        if key.endswith(suffix):
+            return key[:-len(suffix)], suffix
+    return key, ""
+
+
+def summarize_header(path):
+    """Everything the index stores about one file, from its safetensors header only."""
+    stat = os.stat(path)
+    with LazySafetensors(path) as sd:
+        modules = {}
+        tensors = []
+        for key, info in sd.tensors.items():
+            tensors.append((key, info.dtype, json.dumps(list(info.shape))))
+            module, suffix = split_module(key)
+            entry = modules.setdefault(module, {"rank": None, "in": None, "out": None, "dtype": info.dtype})
+            if suffix in DOWN_SUFFIXES and info.shape:
+                entry["rank"] = info.shape[0]
+                entry["in"] = info.shape[1] if len(info.shape) > 1 else None
+            elif suffix in (".lora_up.weight", ".lora_B.weight", ".lora_B.default.weight") and info.shape:
+                entry["out"] = info.shape[0]
+
+        rows = []
+        for module, entry in modules.items():
+            m = BLOCK_RE.search(module)
+            block, component = (int(m.group(1)), m.group(2)) if m else (None, None)
+            rows.append((module, block, component, entry["rank"], entry["in"], entry["out"], entry["dtype"]))
+
+        blocks = sorted({r[1] for r in rows if r[1] is not None})
+        ranks = sorted({r[3] for r in rows if r[3] is not None})
+        return {
+            "path": path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "format": detect_format(sd.keys()),
+            "n_keys": len(sd),
+            "total_params": sd.total_params(),
+            "ranks": ",".join(str(r) for r in ranks),
+            "min_block": blocks[0] if blocks else None,
+            "max_block": blocks[-1] if blocks else None,
+            "n_blocks": len(blocks),
+            "metadata": json.dumps(sd.metadata) if sd.metadata else None,
+            "modules": rows,
+            "tensors": tensors,
+        }
+
+
+class LoraIndex:
+    """SQLite index of many LoRA files: one row per file, per LoRA module and per tensor.
+
+    Built from headers only and refreshed incrementally (files whose size and mtime did not
+    change are skipped), so questions about thousands of LoRAs are a single indexed query.
+    """
+
+    def __init__(self, path):
+        index_dir = os.path.dirname(path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                format TEXT,
+                n_keys INTEGER,
+                total_params INTEGER,
+                ranks TEXT,
+                min_block INTEGER,
+                max_block INTEGER,
+                n_blocks INTEGER,
+                metadata TEXT,
+                error TEXT,
+                indexed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS modules (
+                path TEXT NOT NULL,
+                module TEXT NOT NULL,
+                block INTEGER,
+                component TEXT,
+                rank INTEGER,
+                in_features INTEGER,
+                out_features INTEGER,
+                dtype TEXT
+            );
+            CREATE TABLE IF NOT EXISTS tensors (
+                path TEXT NOT NULL,
+                key TEXT NOT NULL,
+                dtype TEXT,
+                shape TEXT
+            );
+            CREATE INDEX IF NOT EXISTS modules_path ON modules (path);
+            CREATE INDEX IF NOT EXISTS modules_component_block ON modules (component, block);
+            CREATE INDEX IF NOT EXISTS tensors_path ON tensors (path);
+            CREATE INDEX IF NOT EXISTS tensors_key ON tensors (key);
+        """)
+        self.conn.commit()
+
+    def stale(self, paths):
+        """Paths that are new or whose size/mtime changed since they were indexed."""
+        known = {row[0]: (row[1], row[2]) for row in self.conn.execute("SELECT path, size, mtime FROM files")}
+        result = []
+        for path in paths:
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime):
+                result.append(path)
+        return result
+
+    def _delete(self, path):
+        for table in ("files", "modules", "tensors"):
+            self.conn.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+
+    def record(self, summary):
+        path = summary["path"]
+        self._delete(path)
+        self.conn.execute("""
+            INSERT INTO files (path, size, mtime, format, n_keys, total_params, ranks,
+                               min_block, max_block, n_blocks, metadata, error, indexed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)
+        """, (path, summary["size"], summary["mtime"], summary["format"], summary["n_keys"],
+              summary["total_params"], summary["ranks"], summary["min_block"], summary["max_block"],
+              summary["n_blocks"], summary["metadata"], time.time()))
+        self.conn.executemany("INSERT INTO modules VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              [(path, *row) for row in summary["modules"]])
+        self.conn.executemany("INSERT INTO tensors VALUES (?, ?, ?, ?)",
+                              [(path, *row) for row in summary["tensors"]])
+
+    def record_error(self, path, error):
+        self._delete(path)
+        stat = os.stat(path) if os.path.exists(path) else None
+        self.conn.execute("INSERT INTO files (path, size, mtime, error, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                          (path, stat.st_size if stat else None, stat.st_mtime if stat else None,
+                           str(error), time.time()))
+
+    def forget_missing(self, root):
+        """Drop entries under root whose file no longer exists."""
+        prefix = os.path.join(root, "")
+        rows = self.conn.execute("SELECT path FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+        missing = [row[0] for row in rows if not os.path.exists(row[0])]
+        for path in missing:
+            self._delete(path)
+        self.conn.commit()
+        return len(missing)
+
+    def commit(self):
+        self.conn.commit()
+
+    def query(self, component=None, min_block=None, max_block=None, fmt=None, min_rank=None, max_rank=None):
+        """Files with at least one module matching every given filter, with the matching module count.
+
+        component is a prefix ("ffn" matches ffn.0, ffn_2, ...); SQL wildcards (%, _) are allowed.
+        """
+        where, params = [], []
+        if component:
+            where.append("m.component LIKE ?")
+            params.append(component + "%")
+        if min_block is not None:
+            where.append("m.block >= ?")
+            params.append(min_block)
+        if max_block is not None:
+            where.append("m.block <= ?")
+            params.append(max_block)
+        if fmt:
+            where.append("f.format = ?")
+            params.append(fmt)
+        if min_rank is not None:
+            where.append("m.rank >= ?")
+            params.append(min_rank)
+        if max_rank is not None:
+            where.append("m.rank <= ?")
+            params.append(max_rank)
+        sql = """
+            SELECT f.path, f.format, f.ranks, COUNT(*), MIN(m.block), MAX(m.block)
+            FROM modules m JOIN files f ON f.path = m.path
+        """
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY f.path ORDER BY f.path"
+        return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def find_safetensors(roots):
+    for root in roots:
+        if os.path.isfile(root):
+            yield os.path.abspath(root)
+            continue
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if name.endswith(".safetensors"):
+                    yield os.path.abspath(os.path.join(dirpath, name))
+
+
+def build_index(index_path, roots, workers=16, rebuild=False):
+    """Read the headers of every .safetensors under roots in parallel and store them in the index."""
+    index = LoraIndex(index_path)
+    try:
+        paths = sorted(set(find_safetensors(roots)))
+        todo = paths if rebuild else index.stale(paths)
+        print(f"🗂️ {len(paths)} files found, {len(todo)} new or changed")
+
+        indexed = failed = 0
+        start = time.perf_counter()
+        # Header reads are small and I/O bound; threads overlap the disk latency, SQLite writes stay on this thread
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {path: executor.submit(summarize_header, path) for path in todo}
+            for n, (path, future) in enumerate(futures.items(), 1):
+                try:
+                    index.record(future.result())
+                    indexed += 1
+                except Exception as e:
+                    index.record_error(path, e)
+                    failed += 1
+                    print(f"❌ {path}: {e}", file=sys.stderr)
+                if n % 500 == 0:
+                    index.commit()
+                    print(f"  ... {n}/{len(todo)}")
+        index.commit()
+
+        removed = sum(index.forget_missing(os.path.abspath(root)) for root in roots if os.path.isdir(root))
+        elapsed = time.perf_counter() - start
+        print(f"✅ Indexed {indexed} files ({failed} errors, {removed} removed) in {elapsed:.1f}s -> {index_path}")
+    finally:
+        index.close()
+
+
+def print_query_results(rows):
+    if not rows:
+        print("No LoRA matches the query.")
+        return
+    print(f"{len(rows)} matching file(s):")
+    for path, fmt, ranks, count, min_block, max_block in rows:
+        blocks = f"blocks {min_block}-{max_block}" if min_block is not None else "no blocks"
+        print(f"  {path}  [{fmt}, rank {ranks or '?'}, {count} modules, {blocks}]")
 
 
 def analyze_lora_structure(input_path, detailed=False, export_json=False):
@@ -30,10 +310,10 @@ def analyze_lora_structure(input_path, detailed=False, export_json=False):
     print(f"🔍 Analyzing LoRA: {input_path}")
     print(f"📁 File size: {os.path.getsize(input_path) / (1024*1024):.2f} MB")
     
-    # Load safetensors file
+    # Read only the safetensors header (names, shapes, dtypes); no tensor data is loaded
     try:
-        sd = safetensors.torch.load_file(input_path)
-        print(f"✅ Successfully loaded {len(sd.keys())} keys")
+        sd = LazySafetensors(input_path)
+        print(f"✅ Successfully read header with {len(sd.keys())} keys")
     except Exception as e:
         raise RuntimeError(f"Error loading file: {e}")
     
@@ -56,16 +336,16 @@ def analyze_lora_structure(input_path, detailed=False, export_json=False):
     print("=" * 80)
     
     for i, key in enumerate(sorted(sd.keys())):
-        tensor = sd[key]
-        shape = list(tensor.shape)
-        dtype = str(tensor.dtype)
+        info = sd.info(key)
+        shape = list(info.shape)
+        dtype = info.torch_dtype_name
         
         # Store key info
         key_info = {
             "key": key,
             "shape": shape,
             "dtype": dtype,
-            "total_params": torch.numel(tensor)
+            "total_params": info.numel
         }
         analysis["keys"].append(key_info)
         
@@ -104,14 +384,14 @@ def analyze_lora_structure(input_path, detailed=False, export_json=False):
         # Print detailed info if requested
         if detailed or i < 20:  # Always show first 20
             print(f"{i+1:3d}. {key}")
-            print(f"     Shape: {shape}, Dtype: {dtype}, Params: {torch.numel(tensor):,}")
+            print(f"     Shape: {shape}, Dtype: {dtype}, Params: {info.numel:,}")
             
             if not detailed and i == 19 and len(sd.keys()) > 20:
                 print(f"     ... and {len(sd.keys()) - 20} more keys (use --detailed to see all)")
                 break
     
     # Statistics
-    total_params = sum(torch.numel(tensor) for tensor in sd.values())
+    total_params = sd.total_params()
     analysis["statistics"] = {
         "total_parameters": total_params,
         "key_patterns": dict(key_patterns),
@@ -158,14 +438,9 @@ def analyze_lora_structure(input_path, detailed=False, export_json=False):
     
     # Format detection
     print(f"\n🎯 FORMAT DETECTION:")
-    if any("diffusion_model.blocks." in k for k in sd.keys()):
-        print("  ✅ ComfyUI/WAN format detected (diffusion_model.blocks.*)")
-    elif any(k.startswith("blocks.") and not k.startswith("diffusion_model") for k in sd.keys()):
-        print("  ✅ DiffSynth format detected (blocks.* without diffusion_model prefix)")
-    elif any("lora_unet" in k for k in sd.keys()):
-        print("  ✅ Standard Diffusers format detected (lora_unet.*)")
-    else:
-        print("  ❓ Unknown format - manual analysis needed")
+    fmt = detect_format(sd.keys())
+    analysis["format"] = fmt
+    print(f"  {'❓' if fmt == 'unknown' else '✅'} {FORMAT_LABELS[fmt]}")
     
     # Export to JSON if requested
     if export_json:
@@ -183,8 +458,8 @@ def compare_loras(file1, file2):
     print("=" * 50)
     
     try:
-        sd1 = safetensors.torch.load_file(file1)
-        sd2 = safetensors.torch.load_file(file2)
+        sd1 = LazySafetensors(file1)
+        sd2 = LazySafetensors(file2)
         
         keys1 = set(sd1.keys())
         keys2 = set(sd2.keys())
@@ -226,6 +501,7 @@ def main():
     
     parser.add_argument(
         "input_path",
+        nargs="?",
         help="Path to LoRA file to analyze"
     )
     
@@ -246,8 +522,41 @@ def main():
         help="Compare with another LoRA file"
     )
     
+    parser.add_argument("--index", help="SQLite index for batch mode (built with --scan, queried with the filters below)")
+    parser.add_argument("--scan", nargs="+", metavar="PATH", help="Folders/files whose headers are added to --index")
+    parser.add_argument("--workers", type=int, default=16, help="Parallel header reads for --scan")
+    parser.add_argument("--rebuild", action="store_true", help="Re-read every file instead of only new/changed ones")
+    parser.add_argument("--component", help="Query: module name after the block index, prefix match (e.g. ffn, self_attn)")
+    parser.add_argument("--min-block", type=int, help="Query: lowest block index")
+    parser.add_argument("--max-block", type=int, help="Query: highest block index")
+    parser.add_argument("--format", choices=sorted(FORMAT_LABELS), help="Query: key format")
+    parser.add_argument("--min-rank", type=int, help="Query: lowest LoRA rank")
+    parser.add_argument("--max-rank", type=int, help="Query: highest LoRA rank")
+    parser.add_argument("--sql", help="Query: raw SQL against the index (tables files, modules, tensors)")
+
     args = parser.parse_args()
-    
+
+    if args.index:
+        try:
+            if args.scan:
+                build_index(args.index, args.scan, args.workers, args.rebuild)
+            filters = (args.component, args.min_block, args.max_block, args.format, args.min_rank, args.max_rank)
+            if args.sql:
+                index = LoraIndex(args.index)
+                for row in index.conn.execute(args.sql):
+                    print("  ".join("" if v is None else str(v) for v in row))
+                index.close()
+            elif any(f is not None for f in filters) or not args.scan:
+                index = LoraIndex(args.index)
+                print_query_results(index.query(*filters))
+                index.close()
+        except (sqlite3.Error, OSError) as e:
+            print(f"❌ Index error: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+    if not args.input_path:
+        parser.error("input_path is required unless --index is given")
+
     try:
         # Expand relative paths
         input_path = os.path.abspath(args.input_path)
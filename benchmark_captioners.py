@@ -0,0 +1,141 @@
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from mock_gemini_server import MockSettings, start_server
+
+CAPTIONERS = {
+    'video': ('gemini_video_captioner', '.mp4'),
+    'image': ('gemini_image_captioner', '.jpg'),
+}
+
+
+def create_fake_media(folder: str, num_files: int, size_mb: float, ext: str):
+    os.makedirs(folder, exist_ok=True)
+    size = int(size_mb * 1024 * 1024)
+    for i in range(num_files):
+        # Distinct content per file so nothing is deduplicated by hash
+        with open(os.path.join(folder, f"bench_{i:05d}{ext}"), 'wb') as f:
+            f.write(i.to_bytes(4, 'little') + os.urandom(max(0, size - 4)))
+
+
+def read_summary(trace_path: str) -> dict:
+    summary = {}
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('event') == 'summary':
+                summary = record
+    return summary
+
+
+def run_captioner(module, argv: list[str]):
+    old_argv = sys.argv
+    sys.argv = [module.__file__] + argv
+    try:
+        module.main()
+    finally:
+        sys.argv = old_argv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark of the Gemini captioners against the local mock server")
+    parser.add_argument('--captioner', choices=list(CAPTIONERS), default='video')
+    parser.add_argument('--num_files', type=int, default=32, help='Synthetic files per run')
+    parser.add_argument('--file_size_mb', type=float, default=2.0, help='Size of each synthetic file')
+    parser.add_argument('--concurrency', default='1,2,4,8,16', help='Comma-separated --num_threads values to test')
+    parser.add_argument('--trigger_word', default='benchpx')
+    parser.add_argument('--mock_url', default=None, help='Use an already running mock_gemini_server.py instead of starting one')
+    parser.add_argument('--upload_mbps', type=float, default=MockSettings.upload_mbps)
+    parser.add_argument('--activation_median', type=float, default=MockSettings.activation_median)
+    parser.add_argument('--activation_sigma', type=float, default=MockSettings.activation_sigma)
+    parser.add_argument('--generation_median', type=float, default=MockSettings.generation_median)
+    parser.add_argument('--generation_sigma', type=float, default=MockSettings.generation_sigma)
+    parser.add_argument('--error_rate_429', type=float, default=0.0)
+    parser.add_argument('--rpm_limit', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work_dir', default=None, help='Keep media/manifests/traces here instead of a temp dir')
+    parser.add_argument('--output_json', default=None, help='Also write the results table as JSON')
+    args = parser.parse_args()
+
+    module_name, ext = CAPTIONERS[args.captioner]
+    module = importlib.import_module(module_name)
+    levels = [int(c) for c in args.concurrency.split(',') if c.strip()]
+
+    server = None
+    mock_url = args.mock_url
+    if mock_url is None:
+        settings = MockSettings(
+            upload_mbps=args.upload_mbps,
+            activation_median=args.activation_median,
+            activation_sigma=args.activation_sigma,
+            generation_median=args.generation_median,
+            generation_sigma=args.generation_sigma,
+            error_rate_429=args.error_rate_429,
+            rpm_limit=args.rpm_limit,
+            caption_prefix=args.trigger_word,
+            seed=args.seed,
+        )
+        server = start_server(settings=settings)
+        mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='caption_bench_')
+    media_dir = os.path.join(work_dir, 'media')
+    create_fake_media(media_dir, args.num_files, args.file_size_mb, ext)
+    print(f"🧪 {args.num_files} x {args.file_size_mb} MB {args.captioner} files, mock server {mock_url}")
+
+    results = []
+    try:
+        for threads in levels:
+            run_dir = os.path.join(work_dir, f"threads_{threads}")
+            shutil.rmtree(run_dir, ignore_errors=True)
+            os.makedirs(run_dir)
+            trace_path = os.path.join(run_dir, 'trace.jsonl')
+            run_captioner(module, [
+                '--folder', media_dir,
+                '--csv_path', os.path.join(run_dir, 'captions.csv'),
+                '--backend', 'mock',
+                '--mock_url', mock_url,
+                '--num_threads', str(threads),
+                '--trigger_word', args.trigger_word,
+                '--no_caption_cache',
+                '--max_attempts', '1',
+                '--trace_path', trace_path,
+            ])
+            summary = read_summary(trace_path)
+            ok = summary.get('statuses', {}).get('ok', 0)
+            elapsed = summary.get('elapsed_s', 0.0)
+            stages = summary.get('stages', {})
+            results.append({
+                'threads': threads,
+                'ok': ok,
+                'errors': summary.get('statuses', {}).get('error', 0),
+                'rate_limited': summary.get('counters', {}).get('rate_limited', 0),
+                'elapsed_s': elapsed,
+                'captions_per_min': round(ok / elapsed * 60, 2) if elapsed else 0.0,
+                'upload_p95_s': stages.get('upload', {}).get('p95_s', 0.0),
+                'activation_p95_s': stages.get('activation', {}).get('p95_s', 0.0),
+                'generation_p95_s': stages.get('generation', {}).get('p95_s', 0.0),
+            })
+    finally:
+        if server is not None:
+            server.shutdown()
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{'threads':>8}{'ok':>6}{'errors':>8}{'429s':>6}{'elapsed s':>11}{'captions/min':>14}{'upload p95':>12}{'activ p95':>11}{'gen p95':>9}")
+    for r in results:
+        print(f"{r['threads']:>8}{r['ok']:>6}{r['errors']:>8}{r['rate_limited']:>6}{r['elapsed_s']:>11.1f}"
+              f"{r['captions_per_min']:>14.1f}{r['upload_p95_s']:>12.2f}{r['activation_p95_s']:>11.2f}{r['generation_p95_s']:>9.2f}")
+
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+
+from lora_extraction import PoolConfig, iter_extracted_layers
+from safetensors_io import LazySafetensors, SafetensorsWriter
+
+
+def create_fake_models(folder: str, small_layers: int, small_shape: tuple, large_layers: int, large_shape: tuple,
+                       delta_rank: int, seed: int):
+    """Base/tuned pair where tuned = base + a low-rank update + noise, like a real fine-tune delta."""
+    generator = torch.Generator().manual_seed(seed)
+    shapes = [(f"blocks.{i}.attn.qkv.weight", small_shape) for i in range(small_layers)]
+    shapes += [(f"blocks.{i}.ffn.1.weight", large_shape) for i in range(large_layers)]
+    paths = (os.path.join(folder, 'base.safetensors'), os.path.join(folder, 'tuned.safetensors'))
+    entries = [(name, 'BF16', shape) for name, shape in shapes]
+    with SafetensorsWriter(paths[0], entries) as base_writer, SafetensorsWriter(paths[1], entries) as tuned_writer:
+        for name, (rows, cols) in shapes:
+            base = torch.randn(rows, cols, generator=generator) * 0.02
+            update = torch.randn(rows, delta_rank, generator=generator) @ torch.randn(delta_rank, cols, generator=generator) * 1e-3
+            tuned = base + update + torch.randn(rows, cols, generator=generator) * 1e-5
+            base_writer.write_tensor(name, base.bfloat16())
+            tuned_writer.write_tensor(name, tuned.bfloat16())
+    return paths
+
+
+def run_config(base_path: str, tuned_path: str, pool: PoolConfig | None, args) -> tuple[float, dict]:
+    with LazySafetensors(base_path) as base, LazySafetensors(tuned_path) as tuned:
+        keys = list(tuned.keys())
+        start = time.perf_counter()
+        results = {}
+        for key, result, error in iter_extracted_layers(base, tuned, keys, args.rank, 'cpu', args.prune_rate,
+                                                        args.svd_method, args.svd_niter, seed=args.seed, pool=pool):
+            if error is not None:
+                raise error
+            results[key] = result
+        return time.perf_counter() - start, results
+
+
+def max_factor_difference(reference: dict, results: dict) -> float:
+    worst = 0.0
+    for key, (down, up, _) in results.items():
+        ref_down, ref_up, _ = reference[key]
+        worst = max(worst, (down - ref_down).abs().max().item(), (up - ref_up).abs().max().item())
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Layers/sec of LoRA extraction for different CPU worker layouts")
+    parser.add_argument('--small_layers', type=int, default=48)
+    parser.add_argument('--small_shape', default='1024x1024')
+    parser.add_argument('--large_layers', type=int, default=8)
+    parser.add_argument('--large_shape', default='3072x8192')
+    parser.add_argument('--delta_rank', type=int, default=32, help='Rank of the synthetic fine-tune update')
+    parser.add_argument('--rank', type=int, default=64)
+    parser.add_argument('--prune_rate', type=float, default=0.0)
+    parser.add_argument('--svd_method', default='randomized')
+    parser.add_argument('--svd_niter', type=int, default=2)
+    parser.add_argument('--cpu_workers', default=f'0,2,4,{os.cpu_count() or 1}',
+                        help='Comma-separated --cpu_workers values to test (0 = sequential in-process)')
+    parser.add_argument('--large_workers', type=int, default=2)
+    parser.add_argument('--large_layer_numel', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work_dir', default=None, help='Keep the synthetic models here instead of a temp dir')
+    parser.add_argument('--output_json', default=None, help='Also write the results table as JSON')
+    args = parser.parse_args()
+
+    small_shape = tuple(int(d) for d in args.small_shape.lower().split('x'))
+    large_shape = tuple(int(d) for d in args.large_shape.lower().split('x'))
+    levels = [int(c) for c in args.cpu_workers.split(',') if c.strip()]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='lora_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    total_layers = args.small_layers + args.large_layers
+    print(f"🧪 {args.small_layers} x {small_shape} + {args.large_layers} x {large_shape} layers, rank {args.rank}, "
+          f"{args.svd_method} SVD, {os.cpu_count()} CPUs")
+    try:
+        base_path, tuned_path = create_fake_models(work_dir, args.small_layers, small_shape, args.large_layers,
+                                                   large_shape, args.delta_rank, args.seed)
+        rows = []
+        reference = None
+        for cpus in levels:
+            pool = PoolConfig.for_cpus(cpus, args.large_workers, args.large_layer_numel) if cpus > 0 else None
+            label = pool.describe() if pool else f"sequential ({torch.get_num_threads()} intra-op threads)"
+            elapsed, results = run_config(base_path, tuned_path, pool, args)
+            if reference is None:
+                reference = results
+            rows.append({
+                'cpu_workers': cpus,
+                'layout': label,
+                'elapsed_s': round(elapsed, 3),
+                'layers_per_s': round(total_layers / elapsed, 2),
+                'max_abs_diff_vs_first': max_factor_difference(reference, results),
+            })
+            print(f"  {label}: {elapsed:.1f}s")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{'cpu_workers':>12}{'elapsed s':>11}{'layers/s':>10}{'max diff':>11}  layout")
+    for r in rows:
+        print(f"{r['cpu_workers']:>12}{r['elapsed_s']:>11.1f}{r['layers_per_s']:>10.2f}{r['max_abs_diff_vs_first']:>11.2e}  {r['layout']}")
+
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'useful-scripts', 'caption_cache.sqlite')
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CaptionCache:
+    """Caption results shared across runs and datasets, keyed by media content hash + model + prompt.
+
+    File hashes are memoized by (path, size, mtime) so re-running over the same folder does not
+    re-read every file. Safe to share between the worker threads of one process.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS captions (
+                key TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                caption TEXT NOT NULL,
+                created_at REAL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def file_hash(self, path: str) -> str:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, content_hash FROM file_hashes WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+
+        content_hash = hash_file(path)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)',
+                              (path, st.st_size, st.st_mtime_ns, content_hash))
+            self.conn.commit()
+        return content_hash
+
+    @staticmethod
+    def make_key(content_hash: str, model: str, prompt: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for part in (content_hash, model, prompt):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute('SELECT caption FROM captions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, content_hash: str, model: str, caption: str):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO captions (key, content_hash, model, caption, created_at) VALUES (?, ?, ?, ?, ?)',
+                              (key, content_hash, model, caption, time.time()))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
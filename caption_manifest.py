@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import time
+
+STATUS_DONE = 'done'
+STATUS_ERROR = 'error'
+
+
+def is_error_caption(caption: str, trigger_word: str) -> bool:
+    """The captioners return '<trigger>, error_...' instead of raising; treat that as a failure."""
+    if not caption or not caption.strip():
+        return True
+    return caption.strip().lower().startswith(f"{trigger_word}, error_".lower())
+
+
+def timed_call(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def default_manifest_path(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + '_manifest.sqlite'
+
+
+class CaptionManifest:
+    """SQLite manifest of a captioning run: one row per source file.
+
+    Every result is committed in its own (WAL) transaction, so a crash loses at most the
+    in-flight items. Resume reads only this table instead of stat-ing the output folder.
+    """
+
+    def __init__(self, path: str):
+        manifest_dir = os.path.dirname(path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                source_path TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                latency REAL,
+                caption TEXT,
+                error TEXT,
+                updated_at REAL
+            )
+        """)
+        self.conn.commit()
+
+    def completed(self) -> set[str]:
+        rows = self.conn.execute('SELECT source_path FROM items WHERE status = ?', (STATUS_DONE,))
+        return {row[0] for row in rows}
+
+    def exhausted(self, max_attempts: int) -> set[str]:
+        if max_attempts <= 0:
+            return set()
+        rows = self.conn.execute('SELECT source_path FROM items WHERE status = ? AND attempts >= ?',
+                                 (STATUS_ERROR, max_attempts))
+        return {row[0] for row in rows}
+
+    def record(self, source_path: str, file_name: str, status: str,
+               caption: str | None = None, latency: float | None = None, error: str | None = None):
+        self.conn.execute("""
+            INSERT INTO items (source_path, file_name, status, attempts, latency, caption, error, updated_at)
+            VALUES (?, ?, ?, 1, ?, ?, ?, ?)
+            ON CONFLICT(source_path) DO UPDATE SET
+                file_name = excluded.file_name,
+                status = excluded.status,
+                attempts = items.attempts + 1,
+                latency = excluded.latency,
+                caption = excluded.caption,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+        """, (source_path, file_name, status, latency, caption, error, time.time()))
+        self.conn.commit()
+
+    def done_rows(self, since: float | None = None):
+        """Done items, optionally only those (re)completed at or after the `since` timestamp."""
+        if since is None:
+            return self.conn.execute('SELECT file_name, caption FROM items WHERE status = ? ORDER BY file_name, source_path',
+                                     (STATUS_DONE,))
+        return self.conn.execute('SELECT file_name, caption FROM items WHERE status = ? AND updated_at >= ? '
+                                 'ORDER BY file_name, source_path', (STATUS_DONE, since))
+
+    def summary(self) -> dict[str, int]:
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM items GROUP BY status'))
+
+    def close(self):
+        self.conn.close()
+
+
+def export_captions(manifest: CaptionManifest, csv_path: str, sanitize, append_since: float | None = None,
+                    txt_dir: str | None = None) -> int:
+    """Write the 'file_name|caption' CSV (and optionally one .txt per item) in one pass over the manifest.
+
+    By default the CSV is rebuilt in full from every done item and swapped in atomically, so resumed
+    runs never duplicate rows. With append_since, only items completed at or after that timestamp
+    (i.e. in the current run) are appended to an existing CSV.
+    """
+    csv_dir = os.path.dirname(csv_path)
+    if csv_dir:
+        os.makedirs(csv_dir, exist_ok=True)
+    if txt_dir:
+        os.makedirs(txt_dir, exist_ok=True)
+
+    append = append_since is not None
+    write_header = not append or not os.path.exists(csv_path)
+    out_path = csv_path if append else csv_path + '.tmp'
+    count = 0
+    with open(out_path, 'a' if append else 'w', encoding='utf-8') as f_csv:
+        if write_header:
+            f_csv.write('file_name|caption\n')
+        for file_name, caption in manifest.done_rows(since=append_since):
+            f_csv.write(f"{sanitize(file_name)}|{sanitize(caption)}\n")
+            if txt_dir:
+                with open(os.path.join(txt_dir, file_name + '.txt'), 'w', encoding='utf-8') as f_txt:
+                    f_txt.write(caption)
+            count += 1
+    if not append:
+        os.replace(out_path, csv_path)
+    return count
@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.0
+    lower = int(pos)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    text = f"{type(e).__name__} {e}"
+    return '429' in text or 'RESOURCE_EXHAUSTED' in text.upper() or 'RATE LIMIT' in text.upper()
+
+
+class StageTrace:
+    """Per-item timers (seconds per stage) and counters for one captioned file."""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.status = 'ok'
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def record_usage(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return
+        for field, counter in (('prompt_token_count', 'prompt_tokens'),
+                               ('candidates_token_count', 'output_tokens'),
+                               ('total_token_count', 'total_tokens')):
+            value = getattr(usage, field, None)
+            if value:
+                self.count(counter, int(value))
+
+    def to_dict(self) -> dict:
+        return {
+            'event': 'item',
+            'file': self.file_name,
+            'status': self.status,
+            'wall_s': round(time.perf_counter() - self.start, 4),
+            'stages': {k: round(v, 4) for k, v in self.stages.items()},
+            'counters': dict(self.counters),
+            'ts': time.time(),
+        }
+
+
+class TraceWriter:
+    """Collects item traces from worker threads, appends them to a JSONL file and builds the run summary."""
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.run_id = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.run_start = time.perf_counter()
+        self.stage_samples = defaultdict(list)
+        self.wall_samples = []
+        self.counters = defaultdict(int)
+        self.statuses = defaultdict(int)
+        self.f = open(path, 'a', encoding='utf-8') if path else None
+
+    def write(self, trace: StageTrace):
+        record = trace.to_dict()
+        record['run_id'] = self.run_id
+        with self.lock:
+            for name, seconds in trace.stages.items():
+                self.stage_samples[name].append(seconds)
+            for name, n in trace.counters.items():
+                self.counters[name] += n
+            self.statuses[trace.status] += 1
+            self.wall_samples.append(record['wall_s'])
+            if self.f:
+                self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self.f.flush()
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.run_start
+        stages = {}
+        for name, samples in list(self.stage_samples.items()) + [('item_wall', self.wall_samples)]:
+            stages[name] = {
+                'n': len(samples),
+                'total_s': round(sum(samples), 3),
+                'p50_s': round(percentile(samples, 50), 3),
+                'p95_s': round(percentile(samples, 95), 3),
+                'max_s': round(max(samples), 3) if samples else 0.0,
+            }
+        items = sum(self.statuses.values())
+        upload_s = sum(self.stage_samples.get('upload', []))
+        return {
+            'event': 'summary',
+            'run_id': self.run_id,
+            'elapsed_s': round(elapsed, 3),
+            'items': items,
+            'items_per_min': round(items / elapsed * 60, 2) if elapsed > 0 else 0.0,
+            'statuses': dict(self.statuses),
+            'counters': dict(self.counters),
+            'upload_mb_per_s': round(self.counters.get('bytes_uploaded', 0) / upload_s / 1e6, 3) if upload_s > 0 else 0.0,
+            'stages': stages,
+        }
+
+    def close(self) -> dict:
+        summary = self.summary()
+        with self.lock:
+            if self.f:
+                self.f.write(json.dumps(summary, ensure_ascii=False) + '\n')
+                self.f.close()
+                self.f = None
+        return summary
+
+
+def print_summary(summary: dict):
+    print(f"\n⏱️ {summary['items']} items in {summary['elapsed_s']:.1f}s ({summary['items_per_min']:.1f}/min) {summary['statuses']}")
+    print(f"{'stage':<16}{'n':>7}{'total s':>11}{'p50 s':>9}{'p95 s':>9}{'max s':>9}")
+    for name, s in summary['stages'].items():
+        print(f"{name:<16}{s['n']:>7}{s['total_s']:>11.1f}{s['p50_s']:>9.2f}{s['p95_s']:>9.2f}{s['max_s']:>9.2f}")
+    counters = summary['counters']
+    if counters:
+        print("counters: " + ", ".join(f"{k}={v}" for k, v in sorted(counters.items())))
+    if summary['upload_mb_per_s']:
+        print(f"upload throughput: {summary['upload_mb_per_s']:.2f} MB/s per stream")
@@ -1,17 +1,63 @@
 import torch
 import argparse
+import math
 import os
-from safetensors.torch import load_file as load_safetensors
+from safetensors_io import LazySafetensors
 
-def load_model_weights(path):
+def load_model_shapes(path):
+    """Key -> (shape, dtype). Safetensors files are read from the header only, .pt files are memory-mapped when possible."""
     if path.endswith(".safetensors"):
-        return load_safetensors(path)
+        with LazySafetensors(path) as sd:
+            return {key: (info.shape, info.torch_dtype_name) for key, info in sd.tensors.items()}
+    try:
+        state_dict = torch.load(path, map_location="cpu", mmap=True)
+    except (RuntimeError, TypeError):
+        # Legacy (non-zip) checkpoints cannot be memory-mapped; older torch has no mmap argument at all
+        state_dict = torch.load(path, map_location="cpu")
+    return {key: (tuple(value.shape), str(value.dtype)) for key, value in state_dict.items() if hasattr(value, "shape")}
+
+def diff_tensor_values(model1, model2, key, chunk_elems):
+    """Max-abs difference and cosine similarity of one tensor pair, streamed chunk by chunk from the mmapped files."""
+    max_abs = 0.0
+    dot = norm1 = norm2 = 0.0
+    for a, b in zip(model1.iter_chunks(key, chunk_elems), model2.iter_chunks(key, chunk_elems)):
+        a = a.double()
+        b = b.double()
+        max_abs = max(max_abs, (a - b).abs().max().item())
+        dot += torch.dot(a, b).item()
+        norm1 += torch.dot(a, a).item()
+        norm2 += torch.dot(b, b).item()
+    if norm1 == 0.0 and norm2 == 0.0:
+        cosine = 1.0
+    elif norm1 == 0.0 or norm2 == 0.0:
+        cosine = 0.0
     else:
-        return torch.load(path, map_location="cpu")
+        cosine = dot / math.sqrt(norm1 * norm2)
+    return max_abs, cosine
+
+def compare_model_values(model1_path, model2_path, keys, chunk_mb=64, top=None):
+    if not (model1_path.endswith(".safetensors") and model2_path.endswith(".safetensors")):
+        print("\n⚠️ Value diff needs two .safetensors files (they are streamed through mmap); skipping.")
+        return
+    # Per element: two float32 chunks, their float64 copies and two float64 temporaries (~40 bytes)
+    chunk_elems = max(1, chunk_mb * 1024 * 1024 // 40)
+    results = []
+    with LazySafetensors(model1_path) as model1, LazySafetensors(model2_path) as model2:
+        for key in keys:
+            max_abs, cosine = diff_tensor_values(model1, model2, key, chunk_elems)
+            results.append((key, max_abs, cosine))
+
+    changed = [r for r in results if r[1] > 0]
+    print(f"\n🔸 Value differences ({len(changed)} of {len(results)} common layers differ):")
+    changed.sort(key=lambda r: r[1], reverse=True)
+    for key, max_abs, cosine in changed[:top] if top else changed:
+        print(f"  - {key}: max_abs={max_abs:.6g} cosine={cosine:.6f}")
+    if top and len(changed) > top:
+        print(f"  ... and {len(changed) - top} more (use --top 0 to list all)")
 
-def compare_model_keys(model1_path, model2_path, show_shape_diff=False):
-    model1 = load_model_weights(model1_path)
-    model2 = load_model_weights(model2_path)
+def compare_model_keys(model1_path, model2_path, show_shape_diff=False, value_diff=False, chunk_mb=64, top=None):
+    model1 = load_model_shapes(model1_path)
+    model2 = load_model_shapes(model2_path)
 
     keys1 = set(model1.keys())
     keys2 = set(model2.keys())
@@ -28,17 +74,32 @@ def compare_model_keys(model1_path, model2_path, show_shape_diff=False):
     for key in sorted(only_in_model2):
         print(f"  - {key}")
 
+    same_shape = [key for key in sorted(common_keys) if model1[key][0] == model2[key][0]]
     if show_shape_diff:
         print(f"\n🔸 Layers with shape differences:")
         for key in sorted(common_keys):
-            if model1[key].shape != model2[key].shape:
-                print(f"  - {key}: {tuple(model1[key].shape)} vs {tuple(model2[key].shape)}")
+            if model1[key][0] != model2[key][0]:
+                print(f"  - {key}: {model1[key][0]} vs {model2[key][0]}")
+
+        print(f"\n🔸 Layers with dtype differences:")
+        for key in same_shape:
+            if model1[key][1] != model2[key][1]:
+                print(f"  - {key}: {model1[key][1]} vs {model2[key][1]}")
+
+    print(f"\n📊 {len(common_keys)} common layers ({len(same_shape)} with matching shapes), "
+          f"{len(only_in_model1)} only in model 1, {len(only_in_model2)} only in model 2")
+
+    if value_diff:
+        compare_model_values(model1_path, model2_path, same_shape, chunk_mb, top)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compare layer names and shapes between two model files.")
     parser.add_argument("--model1", type=str, required=True, help="Path to the first model (.safetensors or .pt)")
     parser.add_argument("--model2", type=str, required=True, help="Path to the second model (.safetensors or .pt)")
-    parser.add_argument("--show-shape-diff", action="store_true", help="Show shape differences for common layers")
+    parser.add_argument("--show-shape-diff", action="store_true", help="Show shape and dtype differences for common layers")
+    parser.add_argument("--value-diff", action="store_true", help="Also compare values of common layers (max abs diff and cosine), streamed from disk")
+    parser.add_argument("--chunk-mb", type=int, default=64, help="Working memory per chunk for --value-diff")
+    parser.add_argument("--top", type=int, default=50, help="Show only the N layers with the largest difference (0 = all)")
 
     args = parser.parse_args()
-    compare_model_keys(args.model1, args.model2, args.show_shape_diff)
+    compare_model_keys(args.model1, args.model2, args.show_shape_diff, args.value_diff, args.chunk_mb, args.top or None)
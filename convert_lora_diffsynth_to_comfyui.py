@@ -8,8 +8,7 @@ import argparse
 import sys
 import os
 from pathlib import Path
-import safetensors.torch
-import torch
+from safetensors_io import LazySafetensors, RenameRules, rename_safetensors
 
 
 def convert_diffsynth_to_comfyui(input_path, output_path, default_alpha=1.0):
@@ -33,12 +32,13 @@ def convert_diffsynth_to_comfyui(input_path, output_path, default_alpha=1.0):
     
     print(f"Loading LoRA from: {input_path}")
     
-    # Load safetensors file
+    # Read the header only; the data section is copied as-is when saving
     try:
-        sd = safetensors.torch.load_file(input_path)
+        sd = LazySafetensors(input_path)
     except Exception as e:
         raise RuntimeError(f"Error loading file: {e}")
     
+    # new key -> original key (None for the added alpha scalars)
     new_sd = {}
     
     print(f"\nOriginal keys found: {len(sd.keys())}")
@@ -55,7 +55,15 @@ def convert_diffsynth_to_comfyui(input_path, output_path, default_alpha=1.0):
     alpha_added_count = 0
     skipped_count = 0
     
-    # Key mapping for DiffSynth -> ComfyUI (WAN) conversion
+    # Key mapping for DiffSynth -> ComfyUI (WAN) conversion:
+    #   blocks.4.cross_attn.k.lora_A.default.weight -> diffusion_model.blocks.4.cross_attn.k.lora_A.weight
+    # Non-LoRA keys are skipped, and every lora_A (equivalent to lora_down) gets an alpha scalar
+    rules = RenameRules(
+        regex_map=[(r"^(.*)\.lora_([AB])\.default\.weight", r"diffusion_model.\1.lora_\2.weight")],
+        drop_unmatched=True,
+        scalars=[(r"\.lora_A\.weight$", ".alpha", default_alpha)],
+    )
+    
     def convert_key(original_key):
         """
         Converts a key from DiffSynth format to ComfyUI (WAN) format
@@ -63,27 +71,7 @@ def convert_diffsynth_to_comfyui(input_path, output_path, default_alpha=1.0):
         Input:  blocks.4.cross_attn.k.lora_A.default.weight
         Output: diffusion_model.blocks.4.cross_attn.k.lora_A.weight
         """
-        
-        key = original_key
-        
-        # Check if it's a valid LoRA key
-        if not (".lora_A.default.weight" in key or ".lora_B.default.weight" in key):
-            return None  # Skip non-LoRA keys
-        
-        # Remove ".default" from the middle of the key
-        # From: blocks.4.cross_attn.k.lora_A.default.weight
-        # To:   blocks.4.cross_attn.k.lora_A.weight
-        if ".lora_A.default.weight" in key:
-            base_key = key.replace(".lora_A.default.weight", ".lora_A.weight")
-        elif ".lora_B.default.weight" in key:
-            base_key = key.replace(".lora_B.default.weight", ".lora_B.weight")
-        else:
-            return None
-        
-        # Add diffusion_model prefix
-        new_key = f"diffusion_model.{base_key}"
-        
-        return new_key
+        return rules.apply(original_key)
     
     # Process all keys
     for original_key in sorted(sd.keys()):
@@ -91,14 +79,14 @@ def convert_diffsynth_to_comfyui(input_path, output_path, default_alpha=1.0):
         
         if new_key is not None:
             # Add tensor to new dictionary
-            new_sd[new_key] = sd[original_key]
+            new_sd[new_key] = original_key
             converted_count += 1
             
             # Add alpha if it's lora_A (equivalent to lora_down)
             if new_key.endswith(".lora_A.weight"):
                 alpha_key = new_key.replace(".lora_A.weight", ".alpha")
                 if alpha_key not in new_sd:
-                    new_sd[alpha_key] = torch.tensor(default_alpha, dtype=torch.float32)
+                    new_sd[alpha_key] = None
                     alpha_added_count += 1
         else:
             skipped_count += 1
@@ -133,8 +121,9 @@ def convert_diffsynth_to_comfyui(input_path, output_path, default_alpha=1.0):
     # Save converted file
     print(f"\n💾 Saving converted file to: {output_path}")
     try:
-        safetensors.torch.save_file(new_sd, output_path)
-        print("✅ Conversion completed successfully!")
+        # Only the header is rewritten; tensor bytes are copied kernel-side and the alphas appended
+        stats = rename_safetensors(input_path, output_path, rules, metadata={})
+        print(f"✅ Conversion completed successfully! ({stats['data_bytes'] / 1024**2:.1f} MB copied via {', '.join(stats['copy_methods']) or 'nothing'})")
     except Exception as e:
         raise RuntimeError(f"Error saving file: {e}")
     
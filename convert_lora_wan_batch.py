@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import argparse
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from safetensors_io import LazySafetensors, SafetensorsWriter, torch_dtype
+
+# dimensões do embed e MLP do Wan2.1 1.3B vs 14B (mesmas de convert_lora_to_14b.py / convert_lora_to_13b.py)
+OLD_H, OLD_F = 1536, 8960
+NEW_H, NEW_F = 5120, 13824
+NUM_LAYERS_1B = 30  # 0..29
+
+DIRECTIONS = {
+    'to_14b': {OLD_H: NEW_H, OLD_F: NEW_F},
+    'to_13b': {NEW_H: OLD_H, NEW_F: OLD_F},
+}
+METHODS = ['pad', 'bilinear']
+# Cobre os dois formatos de chave: "blocks.12." (diffusers/musubi) e "lora_unet_blocks_12_" (kohya)
+BLOCK_RE = re.compile(r"blocks[._](\d+)[._]")
+
+
+def target_shape(shape: tuple, direction: str):
+    """Formato de saída de um tensor, ou None se ele não muda.
+
+    2D: cada eixo com uma dimensão do modelo de origem vira a do destino. 1D só é cortado no
+    sentido 14B→1.3B (múltiplos de NEW_H/NEW_F), como em convert_lora_to_13b.py.
+    """
+    dims = DIRECTIONS[direction]
+    if len(shape) == 2:
+        new = tuple(dims.get(d, d) for d in shape)
+        return new if new != tuple(shape) else None
+    if len(shape) == 1 and direction == 'to_13b':
+        length = shape[0]
+        for new_dim, old_dim in ((NEW_H, OLD_H), (NEW_F, OLD_F)):
+            if length and length % new_dim == 0:
+                return (old_dim * (length // new_dim),)
+    return None
+
+
+def resize_tensor(t: torch.Tensor, shape: tuple, method: str) -> torch.Tensor:
+    """Pad com zeros / crop (sem clones: o crop é uma view) ou interpolação bilinear para `shape`."""
+    if method == 'bilinear' and t.ndim == 2:
+        out = F.interpolate(t.float()[None, None], size=shape, mode='bilinear', align_corners=False)[0, 0]
+        return out.to(t.dtype)
+    if all(new <= old for new, old in zip(shape, t.shape)):
+        return t[tuple(slice(0, n) for n in shape)]
+    out = t.new_zeros(shape)
+    out[tuple(slice(0, n) for n in t.shape)] = t
+    return out
+
+
+def plan_conversion(lora: LazySafetensors, direction: str, alpha_scale: float):
+    """[(chave, ação, formato)] só a partir do header: 'skip', 'copy' (bytes), 'resize' ou 'alpha'."""
+    plan = []
+    for key, info in lora.tensors.items():
+        if direction == 'to_13b':
+            m = BLOCK_RE.search(key)
+            if m and int(m.group(1)) >= NUM_LAYERS_1B:
+                plan.append((key, 'skip', None))
+                continue
+        if key.endswith('.alpha') and alpha_scale != 1.0:
+            plan.append((key, 'alpha', info.shape))
+            continue
+        shape = target_shape(info.shape, direction)
+        plan.append((key, 'resize', shape) if shape is not None else (key, 'copy', info.shape))
+    return plan
+
+
+def convert_file(in_path: str, out_path: str, direction: str, method: str, alpha_scale: float, verbose: bool) -> dict:
+    """Converte um LoRA: tensores inalterados são copiados byte a byte do mmap, só os afetados passam pelo torch."""
+    stats = {'copy': 0, 'resize': 0, 'skip': 0, 'alpha': 0, 'log': []}
+    with LazySafetensors(in_path) as lora:
+        plan = plan_conversion(lora, direction, alpha_scale)
+        entries = [(key, lora.info(key).dtype, shape) for key, action, shape in plan if action != 'skip']
+        with SafetensorsWriter(out_path, entries, metadata=lora.metadata) as writer:
+            for key, action, shape in plan:
+                stats[action] += 1
+                if action == 'skip':
+                    if verbose:
+                        stats['log'].append(f"  [SKIP] {key} (layer >= {NUM_LAYERS_1B})")
+                elif action == 'copy':
+                    writer.copy_tensor(key, lora, key)
+                elif action == 'alpha':
+                    t = lora.get_tensor(key)
+                    writer.write_tensor(key, (t.float() * alpha_scale).to(torch_dtype(lora.info(key).dtype)))
+                else:
+                    t = lora.get_tensor(key)
+                    writer.write_tensor(key, resize_tensor(t, shape, method))
+                    if verbose:
+                        tag = 'PAD' if direction == 'to_14b' else 'CROP'
+                        if method == 'bilinear' and t.ndim == 2:
+                            tag = 'INTERP'
+                        stats['log'].append(f"  [{tag}] {key}: {tuple(t.shape)} → {tuple(shape)}")
+    return stats
+
+
+def _init_worker():
+    # Um processo por arquivo; threads internas do torch só disputariam os mesmos núcleos
+    torch.set_num_threads(1)
+
+
+def find_loras(input_dir: Path, recursive: bool):
+    pattern = '**/*.safetensors' if recursive else '*.safetensors'
+    return sorted(p for p in input_dir.glob(pattern) if p.is_file())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converte em lote LoRAs Wan2.1 1.3B ↔ 14B (pad/crop ou interpolação bilinear)"
+    )
+    parser.add_argument("input", help="Pasta com LoRAs (.safetensors) ou um único arquivo")
+    parser.add_argument("output", help="Pasta de saída (mantém a estrutura de subpastas)")
+    parser.add_argument("--direction", choices=list(DIRECTIONS), default='to_14b',
+                        help="to_14b: 1.3B → 14B; to_13b: 14B → 1.3B (descarta blocks 30+)")
+    parser.add_argument("--method", choices=METHODS, default='pad',
+                        help="pad: zero-pad/crop; bilinear: redimensiona as matrizes 2D por interpolação")
+    parser.add_argument("--alpha_scale", type=float, default=1.0, help="Multiplica os tensores .alpha")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="Arquivos convertidos em paralelo")
+    parser.add_argument("--recursive", action="store_true", help="Procura LoRAs em subpastas")
+    parser.add_argument("--suffix", default='', help="Sufixo no nome dos arquivos de saída, ex. _14b")
+    parser.add_argument("--overwrite", action="store_true", help="Reconverte arquivos que já existem na saída")
+    parser.add_argument("--verbose", action="store_true", help="Lista cada tensor alterado/descartado")
+    args = parser.parse_args()
+
+    inp = Path(args.input)
+    out = Path(args.output)
+    if not inp.exists():
+        print(f"❌ Arquivo não encontrado: {inp}")
+        exit(1)
+
+    if inp.is_file():
+        dst = out if out.suffix == '.safetensors' else out / f"{inp.stem}{args.suffix}{inp.suffix}"
+        jobs = [(inp, dst)]
+    else:
+        jobs = [(p, out / p.relative_to(inp).with_name(f"{p.stem}{args.suffix}{p.suffix}"))
+                for p in find_loras(inp, args.recursive)]
+    pending = [(src, dst) for src, dst in jobs if args.overwrite or not dst.exists()]
+    if len(pending) < len(jobs):
+        print(f"⏭️  {len(jobs) - len(pending)} já convertidos (use --overwrite para refazer)")
+    if not pending:
+        print("✔ Nada a fazer.")
+        return
+    print(f"▶ Convertendo {len(pending)} LoRA(s) {args.direction} ({args.method}) com {args.workers} worker(s)")
+
+    totals = {'copy': 0, 'resize': 0, 'skip': 0, 'alpha': 0}
+    failed = []
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), mp_context=context, initializer=_init_worker) as executor:
+        futures = {executor.submit(convert_file, str(src), str(dst), args.direction, args.method,
+                                   args.alpha_scale, args.verbose): src for src, dst in pending}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Convertendo"):
+            src = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                failed.append(src)
+                tqdm.write(f"❌ {src}: {e}")
+                continue
+            for key in totals:
+                totals[key] += stats[key]
+            if args.verbose:
+                tqdm.write(f"✔ {src}\n" + "\n".join(stats['log']))
+
+    print(f"\n✔ {len(pending) - len(failed)} convertidos, {len(failed)} com erro. "
+          f"Tensores: {totals['resize']} redimensionados, {totals['copy']} copiados, "
+          f"{totals['alpha']} alphas escalados, {totals['skip']} descartados.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
 import os
+import io
 import csv
 import json
+import time
+import hashlib
 import shutil
+import asyncio
 import logging
 import argparse
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
 from tqdm import tqdm
-from ollama import Client
+from ollama import AsyncClient
 from pydantic import BaseModel, ValidationError
-from multiprocessing import Pool, Lock, Manager
 
 # ========== LOG SETUP ==========
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
@@ -24,18 +29,102 @@ class ImageAnalysis(BaseModel):
     blur_level: str | None = None
     watermark: bool | None = None
 
-# Shared lock for writing to CSV
-global_csv_lock = Lock()
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+PAYLOAD_MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
 
-# ========== FUNCOES ==========
-def ask_ollama_structured(image_path, prompt, model, host):
-    client = Client(host=host, timeout=300)
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
+# ========== DISPATCHER ==========
+class OllamaHost:
+    def __init__(self, url, timeout):
+        self.url = url
+        self.client = AsyncClient(host=url, timeout=timeout)  # one persistent client (connection pool) per host
+        self.in_flight = 0
+        self.latency = None  # EWMA of request latency in seconds
+        self.failures = 0
+        self.evicted_until = 0.0
+        self.completed = 0
+
+class OllamaDispatcher:
+    """Routes each request to the Ollama host with the lowest expected finish time.
+
+    Expected finish time is (in_flight + 1) * EWMA latency, bounded by a per-host in-flight limit.
+    Hosts that error or time out are evicted with exponential backoff and re-admitted afterwards.
+    """
+    def __init__(self, hosts, max_in_flight=2, timeout=300, evict_seconds=30.0, max_evict_seconds=600.0, alpha=0.3):
+        self.hosts = [OllamaHost(h, timeout) for h in hosts]
+        self.max_in_flight = max_in_flight
+        self.evict_seconds = evict_seconds
+        self.max_evict_seconds = max_evict_seconds
+        self.alpha = alpha
+        self.cond = asyncio.Condition()
+
+    def _pick(self, now):
+        candidates = [h for h in self.hosts if h.evicted_until <= now and h.in_flight < self.max_in_flight]
+        if not candidates:
+            return None
+        # Hosts without a latency sample yet score 0 so they get probed first
+        return min(candidates, key=lambda h: ((h.in_flight + 1) * (h.latency or 0.0), h.in_flight))
+
+    async def acquire(self):
+        async with self.cond:
+            while True:
+                now = time.monotonic()
+                host = self._pick(now)
+                if host is not None:
+                    host.in_flight += 1
+                    return host
+                evicted = [h.evicted_until for h in self.hosts if h.evicted_until > now]
+                try:
+                    await asyncio.wait_for(self.cond.wait(), timeout=max(0.05, min(evicted) - now) if evicted else None)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, host, latency=None, error=False):
+        async with self.cond:
+            host.in_flight -= 1
+            if error:
+                host.failures += 1
+                backoff = min(self.max_evict_seconds, self.evict_seconds * 2 ** (host.failures - 1))
+                host.evicted_until = time.monotonic() + backoff
+                logging.warning(f"⛔ Host {host.url} evicted for {backoff:.0f}s after {host.failures} consecutive failure(s)")
+            else:
+                host.failures = 0
+                host.completed += 1
+                if latency is not None:
+                    host.latency = latency if host.latency is None else self.alpha * latency + (1 - self.alpha) * host.latency
+            self.cond.notify_all()
 
+    @asynccontextmanager
+    async def host(self):
+        host = await self.acquire()
+        start = time.monotonic()
+        try:
+            yield host
+        except ValidationError:
+            # The host answered; the model output was just malformed
+            await self.release(host, latency=time.monotonic() - start)
+            raise
+        except Exception:
+            await self.release(host, error=True)
+            raise
+        except BaseException:
+            await self.release(host)
+            raise
+        await self.release(host, latency=time.monotonic() - start)
+
+    @property
+    def capacity(self):
+        return len(self.hosts) * self.max_in_flight
+
+    def report(self):
+        for h in self.hosts:
+            latency = f"{h.latency:.2f}s" if h.latency is not None else "n/a"
+            logging.info(f"🖥️ {h.url}: {h.completed} done, avg latency {latency}, consecutive failures {h.failures}")
+
+# ========== FUNCOES ==========
+async def ask_ollama_structured(image_bytes, prompt, model, client):
     schema = ImageAnalysis.model_json_schema()
 
-    response = client.generate(
+    response = await client.generate(
         model=model,
         prompt=prompt,
         images=[image_bytes],
@@ -46,90 +135,319 @@ def ask_ollama_structured(image_path, prompt, model, host):
     content = response['response']
     return ImageAnalysis.model_validate_json(content)
 
-def ask_gemini(client, image_path, prompt):
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
+def ask_gemini(client, image_bytes, prompt, mime_type="image/jpeg"):
     response = client.generate_content(
         model="gemini-pro-vision",
         contents=[
             {"role": "user", "parts": [
-                {"inline_data": {"mime_type": "image/jpeg", "data": image_bytes}},
+                {"inline_data": {"mime_type": mime_type, "data": image_bytes}},
                 {"text": prompt}
             ]},
         ],
     )
     return response.text.strip()
 
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def content_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def prepare_image_payload(image_path, max_side, fmt, quality, cache_dir):
+    """Runs in the preprocessing process pool: downscale + re-encode the image for the VLM request.
+
+    Returns (payload_bytes, mime_type, original_size, content_hash). The encoded payload is cached on disk
+    by content hash and encode settings, so re-runs skip the decode entirely.
+    """
+    raw = read_bytes(image_path)
+    mime_type = PAYLOAD_MIME_TYPES[fmt]
+    content_hash = content_digest(raw)
+    key = hashlib.blake2b(f"{content_hash}|{max_side}|{fmt}|{quality}".encode(), digest_size=16)
+    cache_path = os.path.join(cache_dir, key.hexdigest() + "." + fmt) if cache_dir else None
+    size_path = cache_path + ".size" if cache_path else None
+
+    if cache_path and os.path.exists(cache_path) and os.path.exists(size_path):
+        with open(size_path, "r", encoding="utf-8") as f:
+            original_size = tuple(json.loads(f.read()))
+        return read_bytes(cache_path), mime_type, original_size, content_hash
+
+    with Image.open(io.BytesIO(raw)) as img:
+        original_size = img.size
+        if img.format == "JPEG" and fmt == "jpeg" and max(original_size) <= max_side:
+            # Already small enough and in the target format: send as-is, no generation loss
+            return raw, mime_type, original_size, content_hash
+        # JPEG draft mode decodes directly at a reduced scale, much cheaper than a full decode
+        img.draft("RGB", (max_side, max_side))
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.Resampling.BICUBIC)
+        buf = io.BytesIO()
+        img.save(buf, format=fmt.upper(), quality=quality)
+        payload = buf.getvalue()
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, cache_path)
+        with open(size_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(list(original_size)))
+    return payload, mime_type, original_size, content_hash
+
 def organize_image(image_path, base_out, quality, style, category, resolution, blur_level, watermark):
     parts = [quality, blur_level or "clear", resolution or "std", "watermarked" if watermark else "clean", style, category]
     dest_dir = os.path.join(base_out, *map(str.lower, parts))
     os.makedirs(dest_dir, exist_ok=True)
-    shutil.copy(image_path, os.path.join(dest_dir, os.path.basename(image_path)))
+    copy_if_changed(image_path, os.path.join(dest_dir, os.path.basename(image_path)))
     txt_src = os.path.splitext(image_path)[0] + ".txt"
     if os.path.exists(txt_src):
-        shutil.copy(txt_src, os.path.join(dest_dir, os.path.basename(txt_src)))
+        copy_if_changed(txt_src, os.path.join(dest_dir, os.path.basename(txt_src)))
+
+def copy_if_changed(src, dst):
+    try:
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if src_stat.st_size == dst_stat.st_size and dst_stat.st_mtime >= src_stat.st_mtime:
+            return
+    except FileNotFoundError:
+        pass
+    shutil.copy2(src, dst)
 
 def load_tags(txt_path):
     return open(txt_path, "r", encoding="utf-8").read().strip() if os.path.exists(txt_path) else ""
 
-def append_csv_row(csv_path, data_dict, fieldnames):
-    with global_csv_lock:
-        file_exists = os.path.isfile(csv_path)
-        with open(csv_path, "a", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(data_dict)
+# ========== MANIFEST ==========
+def backend_model_id(args):
+    return args.model if args.backend == "ollama" else "gemini-pro-vision"
 
-def process_single_image(args_tuple):
-    filename, args, prompt_template, fieldnames, hosts, host_index = args_tuple
+def load_manifest(manifest_path):
+    """filename -> last completed record. A truncated last line (crash mid-write) is ignored."""
+    records = {}
+    if not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["filename"]] = record
+    return records
 
-    if not filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
-        return
+def file_signature(path):
+    """(size, mtime_ns) of a file: the cheap check done before falling back to hashing its content."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
 
-    img_path = os.path.join(args.input_dir, filename)
-    tags_path = os.path.splitext(img_path)[0] + ".txt"
-    original_tags = load_tags(tags_path)
-    host = hosts[host_index % len(hosts)]
+def resume_filter(input_dir, filenames, records, model_id, manifest_path):
+    """Split filenames into (to_analyze, skipped) using the manifest's content hash and model.
+
+    A record counts only for the same model. Size/mtime are compared first; the file is re-hashed only
+    when they differ, and re-analyzed when the hash no longer matches (an image replaced under the same
+    name). Unchanged files whose mtime moved get a refreshed record, so they are not re-hashed next run.
+    """
+    pending, refreshed = [], []
+    skipped = 0
+    for filename in filenames:
+        record = records.get(filename)
+        if record is None or record.get("model") != model_id:
+            pending.append(filename)
+            continue
+        path = os.path.join(input_dir, filename)
+        size, mtime_ns = file_signature(path)
+        if record.get("size") == size and record.get("mtime_ns") == mtime_ns:
+            skipped += 1
+            continue
+        if record.get("size") not in (None, size) or content_digest(read_bytes(path)) != record.get("content_hash"):
+            pending.append(filename)
+            continue
+        refreshed.append({**record, "size": size, "mtime_ns": mtime_ns})
+        skipped += 1
+    if refreshed:
+        with open(manifest_path, "a", encoding="utf-8") as f:
+            for record in refreshed:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return pending, skipped
+
+def dedupe_csv(csv_path, fieldnames):
+    """Rewrite dataset_summary.csv keeping only the last row per filename. Returns the number of rows dropped."""
+    if not os.path.exists(csv_path):
+        return 0
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    unique = {row["filename"]: row for row in rows}
+    if len(unique) == len(rows):
+        return 0
+    tmp_path = csv_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(unique.values())
+    os.replace(tmp_path, csv_path)
+    return len(rows) - len(unique)
+
+async def csv_writer_task(csv_path, manifest_path, fieldnames, queue):
+    """Single owner of dataset_summary.csv and the manifest: (row, record) pairs arrive through the queue, None stops the writer.
+
+    The manifest line is written after the CSV row, so a crash in between only causes a re-run of that
+    image (and a duplicate row that dedupe_csv drops on the next start).
+    """
+    file_exists = os.path.isfile(csv_path)
+    with open(csv_path, "a", encoding="utf-8", newline="") as f, open(manifest_path, "a", encoding="utf-8") as f_manifest:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        if not file_exists:
+            writer.writeheader()
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            row, record = item
+            writer.writerow(row)
+            f.flush()
+            f_manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f_manifest.flush()
+
+def organize_from_manifest(args, records):
+    """Re-create the organized folder tree from stored analyses, without querying any model."""
+    def organize(record):
+        row = record["row"]
+        img_path = os.path.join(args.input_dir, record["filename"])
+        if not os.path.exists(img_path):
+            logging.warning(f"⚠️ {record['filename']} is in the manifest but missing from {args.input_dir}")
+            return
+        organize_image(img_path, args.output_dir, row["quality"], row["style"], row["category"],
+                       row["resolution"], row["blur_level"], row["watermark"])
+
+    with ThreadPoolExecutor(max_workers=args.io_workers) as pool:
+        list(tqdm(pool.map(organize, records.values()), total=len(records), desc="Organizing from manifest"))
+
+# ========== ENGINE ==========
+class CurationEngine:
+    def __init__(self, args, prompt_template, fieldnames):
+        self.args = args
+        self.prompt_template = prompt_template
+        self.fieldnames = fieldnames
+        self.io_pool = ThreadPoolExecutor(max_workers=args.io_workers)
+        self.cpu_pool = ProcessPoolExecutor(max_workers=args.preprocess_workers) if args.max_image_side > 0 else None
+        self.csv_queue = asyncio.Queue()
+        self.model_id = backend_model_id(args)
+        self.dispatcher = None
+        self.gemini_client = None
+        self.gemini_semaphore = None
 
-    try:
         if args.backend == "ollama":
-            data = ask_ollama_structured(img_path, prompt_template, args.model, host)
+            hosts = [h.strip() for h in args.ollama_hosts.split(",") if h.strip()]
+            self.dispatcher = OllamaDispatcher(hosts, max_in_flight=args.max_inflight_per_host,
+                                               timeout=args.ollama_timeout, evict_seconds=args.host_evict_seconds)
+            self.concurrency = args.num_workers or self.dispatcher.capacity
         elif args.backend == "gemini":
             from google import genai
-            client = genai.Client(api_key=args.api_key)
-            response_text = ask_gemini(client, img_path, prompt_template)
-            data = ImageAnalysis.model_validate_json(response_text)
+            self.gemini_client = genai.Client(api_key=args.api_key)
+            self.concurrency = args.num_workers or 4
+            self.gemini_semaphore = asyncio.Semaphore(self.concurrency)
         else:
             raise ValueError("Invalid backend. Use 'ollama' or 'gemini'.")
 
-        quality = data.quality.lower()
-        style = data.style.lower()
-        category = data.category.lower()
-        resolution = (data.resolution or "std").lower()
-        blur_level = (data.blur_level or "clear").lower()
-        watermark = data.watermark
-
-        organize_image(img_path, args.output_dir, quality, style, category, resolution, blur_level, watermark)
-
-        row = {
-            "filename": filename,
-            "original_tags": original_tags,
-            "predicted_tags": data.booru_tags,
-            "descriptive_caption": data.descriptive_caption,
-            "quality": quality,
-            "style": style,
-            "category": category,
-            "resolution": resolution,
-            "blur_level": blur_level,
-            "watermark": watermark
-        }
-
-        append_csv_row(os.path.join(args.output_dir, "dataset_summary.csv"), row, fieldnames)
-        logging.info(f"✅ {filename} -> {quality}/{blur_level}/{resolution}/{'watermarked' if watermark else 'clean'}/{style}/{category}")
-
-    except Exception as e:
-        logging.error(f"[ERROR] {filename}: {e}")
+    async def run_io(self, fn, *fn_args):
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, fn, *fn_args)
+
+    async def load_payload(self, img_path):
+        args = self.args
+        if self.cpu_pool is None:
+            raw = await self.run_io(read_bytes, img_path)
+            return raw, "image/jpeg", self.prompt_template, content_digest(raw)
+        payload, mime_type, (width, height), content_hash = await asyncio.get_running_loop().run_in_executor(
+            self.cpu_pool, prepare_image_payload, img_path, args.max_image_side, args.payload_format,
+            args.payload_quality, args.payload_cache_dir)
+        # The model only sees the downscaled copy, so tell it the real size for the resolution field
+        prompt = self.prompt_template + f"The original image resolution is {width}x{height} pixels.\n"
+        return payload, mime_type, prompt, content_hash
+
+    async def analyze(self, img_path):
+        image_bytes, mime_type, prompt, content_hash = await self.load_payload(img_path)
+        if self.dispatcher is not None:
+            async with self.dispatcher.host() as host:
+                return await ask_ollama_structured(image_bytes, prompt, self.args.model, host.client), content_hash
+        async with self.gemini_semaphore:
+            response_text = await asyncio.to_thread(ask_gemini, self.gemini_client, image_bytes, prompt, mime_type)
+        return ImageAnalysis.model_validate_json(response_text), content_hash
+
+    async def process_single_image(self, filename):
+        args = self.args
+        img_path = os.path.join(args.input_dir, filename)
+        tags_path = os.path.splitext(img_path)[0] + ".txt"
+
+        try:
+            original_tags = await self.run_io(load_tags, tags_path)
+            # Taken before the read, so a file replaced mid-analysis is caught by the next resume
+            size, mtime_ns = await self.run_io(file_signature, img_path)
+            data, content_hash = await self.analyze(img_path)
+
+            quality = data.quality.lower()
+            style = data.style.lower()
+            category = data.category.lower()
+            resolution = (data.resolution or "std").lower()
+            blur_level = (data.blur_level or "clear").lower()
+            watermark = data.watermark
+
+            await self.run_io(organize_image, img_path, args.output_dir, quality, style, category, resolution, blur_level, watermark)
+
+            row = {
+                "filename": filename,
+                "original_tags": original_tags,
+                "predicted_tags": data.booru_tags,
+                "descriptive_caption": data.descriptive_caption,
+                "quality": quality,
+                "style": style,
+                "category": category,
+                "resolution": resolution,
+                "blur_level": blur_level,
+                "watermark": watermark
+            }
+
+            record = {"filename": filename, "content_hash": content_hash, "size": size, "mtime_ns": mtime_ns,
+                      "model": self.model_id, "row": row}
+            await self.csv_queue.put((row, record))
+            logging.info(f"✅ {filename} -> {quality}/{blur_level}/{resolution}/{'watermarked' if watermark else 'clean'}/{style}/{category}")
+
+        except Exception as e:
+            logging.error(f"[ERROR] {filename}: {e}")
+
+    async def worker(self, queue, progress):
+        while True:
+            filename = await queue.get()
+            if filename is None:
+                return
+            await self.process_single_image(filename)
+            progress.update(1)
+
+    async def run(self, filenames):
+        writer = asyncio.create_task(csv_writer_task(os.path.join(self.args.output_dir, "dataset_summary.csv"),
+                                                     self.args.manifest_path, self.fieldnames, self.csv_queue))
+
+        # Fixed number of workers pulling filenames keeps memory flat regardless of dataset size
+        queue = asyncio.Queue()
+        for filename in filenames:
+            queue.put_nowait(filename)
+        for _ in range(self.concurrency):
+            queue.put_nowait(None)
+
+        with tqdm(total=len(filenames), desc="Processing images") as progress:
+            await asyncio.gather(*(self.worker(queue, progress) for _ in range(self.concurrency)))
+
+        await self.csv_queue.put(None)
+        await writer
+        self.io_pool.shutdown()
+        if self.cpu_pool is not None:
+            self.cpu_pool.shutdown()
+        if self.dispatcher is not None:
+            self.dispatcher.report()
 
 # ========== CLI ==========
 def main():
@@ -140,11 +458,27 @@ def main():
     parser.add_argument("--model", default="qwen:vl", help="Ollama model name (ignored if backend=gemini)")
     parser.add_argument("--api_key", help="API key for Gemini (only needed if using --backend gemini)")
     parser.add_argument("--trigger_word", default="live wallpaper", help="Word to insert if image is suitable for animation")
-    parser.add_argument("--num_workers", type=int, default=4, help="Number of parallel workers to use")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of concurrent requests (default: hosts x --max_inflight_per_host for ollama, 4 for gemini)")
     parser.add_argument("--ollama_hosts", default="http://localhost:11434", help="Comma-separated list of Ollama host URLs")
+    parser.add_argument("--max_inflight_per_host", type=int, default=2, help="Maximum concurrent requests sent to each Ollama host")
+    parser.add_argument("--ollama_timeout", type=float, default=300, help="Request timeout in seconds for Ollama hosts")
+    parser.add_argument("--host_evict_seconds", type=float, default=30, help="Initial eviction time for a host that errors or times out (doubles on repeated failures)")
+    parser.add_argument("--io_workers", type=int, default=4, help="Threads for file reads and copies")
+    parser.add_argument("--max_image_side", type=int, default=1024, help="Downscale images so the longest side is at most this before sending (0 = send original bytes)")
+    parser.add_argument("--payload_format", choices=list(PAYLOAD_MIME_TYPES), default="jpeg", help="Encoding of the downscaled payload")
+    parser.add_argument("--payload_quality", type=int, default=90, help="JPEG/WebP quality of the downscaled payload")
+    parser.add_argument("--payload_cache_dir", default=None, help="Cache folder for encoded payloads, keyed by content hash (default: <output_dir>/.payload_cache, '' to disable)")
+    parser.add_argument("--manifest_path", default=None, help="JSONL manifest of completed images (default: <output_dir>/curation_manifest.jsonl)")
+    parser.add_argument("--no_resume", action="store_true", help="Re-analyze images that are already in the manifest")
+    parser.add_argument("--organize_only", action="store_true", help="Only (re)organize images from the manifest, without querying any model")
+    parser.add_argument("--preprocess_workers", type=int, default=os.cpu_count() or 1, help="Processes used to decode/resize/encode images")
     args = parser.parse_args()
 
     os.makedirs(args.output_dir, exist_ok=True)
+    if args.payload_cache_dir is None:
+        args.payload_cache_dir = os.path.join(args.output_dir, ".payload_cache")
+    if args.manifest_path is None:
+        args.manifest_path = os.path.join(args.output_dir, "curation_manifest.jsonl")
 
     prompt_template = (
         f"""Analyze this image and return a JSON with the following fields:
@@ -162,13 +496,29 @@ Add the word '{args.trigger_word}' as a tag if the image is suitable for animate
 
     fieldnames = ["filename", "original_tags", "predicted_tags", "descriptive_caption", "quality", "style", "category", "resolution", "blur_level", "watermark"]
 
-    filenames = sorted([f for f in os.listdir(args.input_dir) if f.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))])
-    hosts = [h.strip() for h in args.ollama_hosts.split(",")]
+    records = load_manifest(args.manifest_path)
+    if args.organize_only:
+        organize_from_manifest(args, records)
+        return
+
+    csv_path = os.path.join(args.output_dir, "dataset_summary.csv")
+    dropped = dedupe_csv(csv_path, fieldnames)
+    if dropped:
+        logging.info(f"🧹 Removed {dropped} duplicate rows from dataset_summary.csv")
+
+    filenames = sorted([f for f in os.listdir(args.input_dir) if f.lower().endswith(IMAGE_EXTENSIONS)])
+    if not args.no_resume:
+        filenames, skipped = resume_filter(args.input_dir, filenames, records, backend_model_id(args), args.manifest_path)
+        logging.info(f"⏭️ Resuming: {skipped} unchanged images already in the manifest, {len(filenames)} to analyze")
 
-    tasks = [(fname, args, prompt_template, fieldnames, hosts, i) for i, fname in enumerate(filenames)]
+    async def run():
+        # The engine owns asyncio primitives, so it must be created inside the running loop
+        engine = CurationEngine(args, prompt_template, fieldnames)
+        await engine.run(filenames)
 
-    with Pool(processes=args.num_workers) as pool:
-        list(tqdm(pool.imap_unordered(process_single_image, tasks), total=len(tasks), desc="Processing images"))
+    asyncio.run(run())
+    # --no_resume re-appends rows for images that were already in the CSV
+    dedupe_csv(csv_path, fieldnames)
 
 if __name__ == "__main__":
     main()
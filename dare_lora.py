@@ -1,8 +1,9 @@
 import torch
 import argparse
-from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 import os
+from lora_extraction import PRUNE_METHODS, SVD_METHODS, PoolConfig, iter_extracted_layers, print_error_report
+from safetensors_io import LazySafetensors, SpoolingSafetensorsWriter
 
 # Módulos alvo para a arquitetura Flux/DiT
 LORA_TARGET_MODULES = [
@@ -25,68 +26,67 @@ def create_lora(
     device: str,
     precision: str,
     prune_rate: float,
+    svd_method: str = "randomized",
+    svd_niter: int = 2,
+    svd_oversample: int = 8,
+    prefetch: int = 2,
+    seed: int = 0,
+    pool: PoolConfig = None,
+    prune_method: str = "sample",
+    prune_sample_size: int = 1_000_000,
 ):
-    print("--- Carregando Modelos ---")
-    base_sd = load_file(base_model_path, device="cpu")
-    tuned_sd = load_file(tuned_model_path, device="cpu")
+    print("--- Abrindo Modelos (somente headers) ---")
+    base_sd = LazySafetensors(base_model_path)
+    tuned_sd = LazySafetensors(tuned_model_path)
     final_dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}.get(precision, torch.bfloat16)
 
-    lora_sd = {}
-    common_keys = set(base_sd.keys()) & set(tuned_sd.keys())
+    # Camadas alvo presentes nos dois modelos, na ordem do arquivo ajustado (leitura sequencial do disco)
+    target_keys = [key for key in tuned_sd.keys() if key in base_sd and is_target_module(key)]
+    metadata = {"ss_network_module": "networks.lora", "ss_network_rank": str(rank), "ss_network_alpha": str(alpha)}
+    alpha_tensor = torch.tensor(alpha, dtype=torch.float32)
 
     print("\n--- Criando LoRA de Diferença (DARE+SVD) ---")
+    # Uma camada por vez: a thread de prefetch lê as próximas enquanto esta é fatorada,
+    # e cada par (down, up) vai direto para o disco
+    writer = SpoolingSafetensorsWriter(lora_output_path, metadata)
     processed_count = 0
-    for key in tqdm(common_keys, desc="  Processando diffs"):
-        if not is_target_module(key):
-            continue
-        
-        processed_count += 1
-        base_tensor = base_sd[key].to(device=device, dtype=torch.float32)
-        tuned_tensor = tuned_sd[key].to(device=device, dtype=torch.float32)
-
-        if base_tensor.shape != tuned_tensor.shape: continue
-        diff = tuned_tensor - base_tensor
-        if diff.dim() not in [2, 4]: continue
-
-        if prune_rate > 0:
-            diff_flat = diff.flatten()
-            num_to_prune = int(len(diff_flat) * prune_rate)
-            if num_to_prune > 0:
-                threshold = torch.kthvalue(diff_flat.abs(), k=num_to_prune).values
-                diff[diff.abs() < threshold] = 0
-
-        original_shape = diff.shape
-        try:
-            if diff.dim() == 4: diff = diff.reshape(original_shape[0], -1)
-            U, S, Vh = torch.linalg.svd(diff)
-            U, S, Vh = U[:, :rank], S[:rank], Vh[:rank, :]
-            lora_down, lora_up = Vh, U @ torch.diag(S)
-
-            if len(original_shape) == 4:
-                lora_down = lora_down.reshape(rank, original_shape[1], *original_shape[2:])
-                lora_up = lora_up.reshape(original_shape[0], rank, 1, 1)
+    errors = {}
+    try:
+        # SVD truncada (randomizada por padrão): só os `rank` componentes necessários são calculados.
+        # Com `pool`, as camadas são distribuídas entre processos e os resultados voltam na mesma ordem
+        layers = iter_extracted_layers(base_sd, tuned_sd, target_keys, rank, device, prune_rate,
+                                       svd_method, svd_niter, svd_oversample, seed, prefetch, pool,
+                                       prune_method, prune_sample_size)
+        for key, result, error in tqdm(layers, total=len(target_keys), desc="  Processando diffs"):
+            processed_count += 1
+            if error is not None:
+                print(f"🔥 Erro SVD na layer {key}: {error}. Ignorando.")
+                continue
+            if result is None:
+                continue
+            lora_down, lora_up, errors[key] = result
 
             # --- A CORREÇÃO CRÍTICA ESTÁ AQUI ---
             # Converte 'double_blocks.0.attn.proj.weight' para
             # 'lora_unet_double_blocks_0_attn_proj'
             lora_prefix = "lora_unet_" + key.replace(".weight", "").replace(".", "_")
 
-            lora_sd[f"{lora_prefix}.lora_down.weight"] = lora_down.cpu().to(final_dtype).contiguous()
-            lora_sd[f"{lora_prefix}.lora_up.weight"] = lora_up.cpu().to(final_dtype).contiguous()
-            lora_sd[f"{lora_prefix}.alpha"] = torch.tensor(alpha, dtype=torch.float32).cpu()
-            
-        except Exception as e:
-            print(f"🔥 Erro SVD na layer {key}: {e}. Ignorando.")
-            continue
+            writer.write_tensor(f"{lora_prefix}.lora_down.weight", lora_down.to(final_dtype).contiguous())
+            writer.write_tensor(f"{lora_prefix}.lora_up.weight", lora_up.to(final_dtype).contiguous())
+            writer.write_tensor(f"{lora_prefix}.alpha", alpha_tensor)
+    except BaseException:
+        writer.abort()
+        raise
 
-    if not lora_sd:
+    if not len(writer):
+        writer.abort()
         print("\n❌ Nenhum LoRA foi criado. Verifique os módulos alvo.")
         return
 
     print(f"\n✅ {processed_count} camadas foram processadas e extraídas para o LoRA.")
-    metadata = {"ss_network_module": "networks.lora", "ss_network_rank": str(rank), "ss_network_alpha": str(alpha)}
+    print_error_report(errors)
     print(f"💾 Salvando LoRA em: {lora_output_path}")
-    save_file(lora_sd, lora_output_path, metadata=metadata)
+    writer.close()
     print("\n✅ Processo concluído com sucesso!")
 
 def main():
@@ -99,12 +99,29 @@ def main():
     parser.add_argument("--prune_rate", type=float, default=0.85)
     parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
     parser.add_argument("--precision", type=str, default="bf16", choices=["fp32", "fp16", "bf16"])
+    parser.add_argument("--prune_method", type=str, default="sample", choices=PRUNE_METHODS,
+                        help="sample/histogram: limiar de magnitude estimado; exact: kthvalue completo; random: DARE original (descarte aleatório + reescala).")
+    parser.add_argument("--prune_sample_size", type=int, default=1_000_000, help="Tamanho da amostra para --prune_method sample.")
+    parser.add_argument("--svd_method", type=str, default="randomized", choices=SVD_METHODS, help="randomized (svd_lowrank) ou exact (linalg.svd completa).")
+    parser.add_argument("--svd_niter", type=int, default=2, help="Iterações de potência da SVD randomizada (mais = mais precisa).")
+    parser.add_argument("--svd_oversample", type=int, default=8, help="Colunas extras no sketch da SVD randomizada.")
+    parser.add_argument("--prefetch", type=int, default=2, help="Camadas lidas antecipadamente enquanto a atual é fatorada.")
+    parser.add_argument("--seed", type=int, default=0, help="Semente da SVD randomizada (derivada por camada, independe da ordem).")
+    parser.add_argument("--cpu_workers", type=int, default=0, help="Núcleos de CPU para fatorar camadas em paralelo (0 = sequencial; só com --device cpu).")
+    parser.add_argument("--large_workers", type=int, default=2, help="Processos para matrizes grandes, cada um com vários threads intra-op.")
+    parser.add_argument("--large_layer_numel", type=int, default=16 * 1024 * 1024, help="Elementos a partir dos quais uma camada é considerada grande.")
     args = parser.parse_args()
+    pool = PoolConfig.for_cpus(args.cpu_workers, args.large_workers, args.large_layer_numel) if args.cpu_workers > 0 else None
+    if pool is not None:
+        print(f"⚙️ Fatoração paralela: {pool.describe()}")
 
     create_lora(
         base_model_path=args.base_model, tuned_model_path=args.tuned_model,
         lora_output_path=args.lora_output, rank=args.rank, alpha=args.alpha,
-        device=args.device, precision=args.precision, prune_rate=args.prune_rate
+        device=args.device, precision=args.precision, prune_rate=args.prune_rate,
+        svd_method=args.svd_method, svd_niter=args.svd_niter, svd_oversample=args.svd_oversample,
+        prefetch=args.prefetch, seed=args.seed, pool=pool,
+        prune_method=args.prune_method, prune_sample_size=args.prune_sample_size
     )
 
 if __name__ == "__main__":
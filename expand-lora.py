@@ -1,40 +1,51 @@
 import argparse
-from safetensors.torch import load_file, save_file
+from safetensors_io import LazySafetensors, write_from_sources
 
-def expand_model(base_path, patch_path, output_path, allow_conflicts=False):
-    print(f"📂 Base (keep existing): {patch_path}")
-    print(f"➕ Adding missing from: {base_path}")
-
-    base = load_file(base_path)
-    patch = load_file(patch_path)
+def plan_expansion(base, patch, allow_conflicts=False):
+    """Key plan from the two headers alone: (output_name, source, source_key) in patch order, then added layers."""
+    plan = [(k, patch, k) for k in patch.keys()]
+    index = {k: i for i, k in enumerate(patch.keys())}
+    added = skipped = conflict = 0
 
-    new_state = dict(patch)  # start with Chroma
-    added = 0
-    skipped = 0
-    conflict = 0
-
-    for k, v in base.items():
-        if k not in new_state:
-            new_state[k] = v
+    for k, info in base.tensors.items():
+        if k not in index:
+            plan.append((k, base, k))
             added += 1
-        elif new_state[k].shape != v.shape:
+            continue
+        existing = patch.info(k)
+        if existing.shape != info.shape:
             conflict += 1
             if allow_conflicts:
-                print(f"⚠️ Conflict on shape, replacing anyway: {k}")
-                new_state[k] = v
+                print(f"⚠️ Conflict on shape, replacing anyway: {k} {existing.shape} -> {info.shape}")
+                plan[index[k]] = (k, base, k)
             else:
-                print(f"⛔ Shape mismatch, keeping original: {k}")
+                print(f"⛔ Shape mismatch, keeping original: {k} {existing.shape} vs {info.shape}")
         else:
+            if existing.dtype != info.dtype:
+                print(f"ℹ️ Same shape, different dtype, keeping original: {k} ({existing.dtype} vs {info.dtype})")
             skipped += 1
+    return plan, added, skipped, conflict
+
+def expand_model(base_path, patch_path, output_path, allow_conflicts=False, dry_run=False):
+    print(f"📂 Base (keep existing): {patch_path}")
+    print(f"➕ Adding missing from: {base_path}")
+
+    # Only the headers are read; tensor bytes are copied straight from the mmapped files
+    with LazySafetensors(base_path) as base, LazySafetensors(patch_path) as patch:
+        plan, added, skipped, conflict = plan_expansion(base, patch, allow_conflicts)
+
+        print("\n✅ Summary:")
+        print(f"  ➕ Added new layers: {added}")
+        print(f"  ↔️ Skipped existing (same shape): {skipped}")
+        print(f"  ⚠️ Conflicts (shape mismatch): {conflict}")
 
-    print("\n✅ Summary:")
-    print(f"  ➕ Added new layers: {added}")
-    print(f"  ↔️ Skipped existing (same shape): {skipped}")
-    print(f"  ⚠️ Conflicts (shape mismatch): {conflict}")
+        if dry_run:
+            print("\n🔎 Dry run, nothing written.")
+            return
 
-    print(f"\n💾 Saving to: {output_path}")
-    save_file(new_state, output_path)
-    print("✅ Done.")
+        print(f"\n💾 Saving to: {output_path}")
+        data_bytes = write_from_sources(output_path, plan, metadata=patch.metadata)
+        print(f"✅ Done. {len(plan)} layers, {data_bytes / 1024**3:.2f} GB of tensor data.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Expand a model by adding missing layers from another.")
@@ -42,6 +53,7 @@ if __name__ == "__main__":
     parser.add_argument("--patch", required=True, help="Path to the model to expand (e.g. chroma)")
     parser.add_argument("--output", required=True, help="Path to save the expanded model")
     parser.add_argument("--allow-conflicts", action="store_true", help="Force overwrite on shape conflict")
+    parser.add_argument("--dry-run", action="store_true", help="Only report added layers and conflicts, do not write")
 
     args = parser.parse_args()
-    expand_model(args.base, args.patch, args.output, args.allow_conflicts)
+    expand_model(args.base, args.patch, args.output, args.allow_conflicts, args.dry_run)
@@ -0,0 +1,101 @@
+import json
+import os
+import mimetypes
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+BACKENDS = ['gemini', 'mock']
+DEFAULT_MOCK_URL = 'http://127.0.0.1:8765'
+
+
+class GeminiBackend:
+    """Live Gemini Developer API through google-genai (files API + generate_content)."""
+
+    def __init__(self, api_key: str):
+        from google import genai
+        from google.genai import types
+        self.types = types
+        self.client = genai.Client(api_key=api_key)
+
+    def upload(self, path: str):
+        # The keyword changed between google-genai releases
+        try:
+            return self.client.files.upload(file_path=path)
+        except TypeError:
+            try:
+                return self.client.files.upload(path=path)
+            except TypeError:
+                return self.client.files.upload(file=path)
+
+    def get(self, name: str):
+        return self.client.files.get(name=name)
+
+    def generate(self, model: str, prompt: str, file):
+        types = self.types
+        contents = [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=prompt),
+                    types.Part.from_uri(file_uri=file.uri, mime_type=file.mime_type)
+                ],
+            ),
+        ]
+        config = types.GenerateContentConfig(response_mime_type="text/plain", candidate_count=1)
+        return self.client.models.generate_content(model=model, contents=contents, config=config)
+
+    def delete(self, name: str):
+        self.client.files.delete(name=name)
+
+
+class MockBackendError(RuntimeError):
+    pass
+
+
+class MockGeminiBackend:
+    """Same interface as GeminiBackend, talking to a local mock_gemini_server.py instead of the API."""
+
+    def __init__(self, base_url: str = DEFAULT_MOCK_URL, timeout: float = 120):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, body: bytes | None = None, headers: dict | None = None) -> dict:
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                payload = resp.read()
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode('utf-8', errors='replace')
+            status = 'RESOURCE_EXHAUSTED' if e.code == 429 else 'ERROR'
+            raise MockBackendError(f"{e.code} {status}: {detail}") from None
+        return json.loads(payload) if payload else {}
+
+    def upload(self, path: str):
+        with open(path, 'rb') as f:
+            data = f.read()
+        mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        info = self._request('POST', '/files', body=data, headers={
+            'Content-Type': mime_type,
+            'X-Display-Name': os.path.basename(path),
+        })
+        return SimpleNamespace(**info)
+
+    def get(self, name: str):
+        return SimpleNamespace(**self._request('GET', f'/{name}'))
+
+    def generate(self, model: str, prompt: str, file):
+        body = json.dumps({'model': model, 'prompt': prompt, 'file': file.name}).encode('utf-8')
+        info = self._request('POST', '/generate', body=body, headers={'Content-Type': 'application/json'})
+        return SimpleNamespace(text=info['text'], parts=[], usage_metadata=SimpleNamespace(**info.get('usage', {})))
+
+    def delete(self, name: str):
+        self._request('DELETE', f'/{name}')
+
+
+def make_backend(kind: str, api_key: str | None = None, mock_url: str | None = None):
+    if kind == 'gemini':
+        return GeminiBackend(api_key)
+    if kind == 'mock':
+        return MockGeminiBackend(mock_url or DEFAULT_MOCK_URL)
+    raise ValueError(f"Unknown backend '{kind}'. Use one of {BACKENDS}.")
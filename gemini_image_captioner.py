@@ -5,8 +5,12 @@ import re
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-from google import genai
-from google.genai import types
+
+from gemini_backends import BACKENDS, DEFAULT_MOCK_URL, make_backend
+from caption_cache import CaptionCache, DEFAULT_CACHE_PATH
+from caption_manifest import (CaptionManifest, STATUS_DONE, STATUS_ERROR, default_manifest_path,
+                              export_captions, is_error_caption, timed_call)
+from caption_trace import StageTrace, TraceWriter, is_rate_limit_error, print_summary
 
 IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".webp"]
 MAX_CHAR_LEN = 2048
@@ -32,45 +36,48 @@ You are creating a caption for training a text-to-image generative model (like S
 ⚠️ Write only one sentence, max 30 words, starting with `{trigger_word}`
 """
 
-def upload_and_wait_until_active(client, path, retries=3):
+def upload_and_wait_until_active(client, path, retries=3, trace=None):
+    if trace is None:
+        trace = StageTrace(os.path.basename(path))
     for attempt in range(retries):
+        if attempt:
+            trace.count("upload_retries")
         try:
-            uploaded = client.files.upload(file=path)
-            for _ in range(180):  # ~90s max
-                status = client.files.get(name=uploaded.name)
-                if str(status.state).lower() == "active":
-                    return uploaded
-                time.sleep(0.5)
+            with trace.stage("upload"):
+                uploaded = client.upload(path)
+            trace.count("bytes_uploaded", os.path.getsize(path))
+            with trace.stage("activation"):
+                for _ in range(180):  # ~90s max
+                    status = client.get(uploaded.name)
+                    trace.count("poll_iterations")
+                    if str(status.state).lower() == "active":
+                        return uploaded
+                    time.sleep(0.5)
             print(f"⏳ Timeout waiting for file activation: {path} (attempt {attempt+1})")
         except Exception as e:
             print(f"⚠️ Upload error for {path} (attempt {attempt+1}): {e}")
+            if is_rate_limit_error(e):
+                trace.count("rate_limited")
         time.sleep(1)
     raise RuntimeError(f"❌ Failed to activate file after {retries} attempts: {path}")
 
-def generate_caption(image_path, args, image_filename):
-    client = genai.Client(api_key=args.gemini_token)
+def generate_caption(image_path, args, image_filename, trace=None):
+    if trace is None:
+        trace = StageTrace(image_filename)
+    client = make_backend(args.backend, args.gemini_token, args.mock_url)
     prompt = args.template.format(image_filename=image_filename, trigger_word=args.trigger_word)
 
-    file = upload_and_wait_until_active(client, image_path)
-
-    contents = [
-        types.Content(
-            role="user",
-            parts=[
-                types.Part.from_text(text=prompt),
-                types.Part.from_uri(file_uri=file.uri, mime_type=file.mime_type)
-            ]
-        )
-    ]
-
-    config = types.GenerateContentConfig(response_mime_type="text/plain")
+    file = upload_and_wait_until_active(client, image_path, trace=trace)
 
     try:
-        response = client.models.generate_content(
-            model=args.gemini_model,
-            contents=contents,
-            config=config
-        )
+        try:
+            with trace.stage("generation"):
+                response = client.generate(args.gemini_model, prompt, file)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                trace.count("rate_limited")
+            raise
+        trace.record_usage(response)
 
         if hasattr(response, "text") and response.text:
             caption = response.text.strip()
@@ -81,7 +88,8 @@ def generate_caption(image_path, args, image_filename):
 
     finally:
         try:
-            client.files.delete(name=file.name)
+            with trace.stage("deletion"):
+                client.delete(file.name)
         except Exception as e:
             print(f"⚠️ Failed to delete file: {e}")
 
@@ -93,33 +101,68 @@ def process_image(image_path, args):
     filename = os.path.basename(image_path)
     base_name = os.path.splitext(filename)[0]
     txt_path = os.path.join(args.output_dir_txt, base_name + ".txt")
+    trace = StageTrace(base_name)
 
-    if args.skip_existing and os.path.exists(txt_path):
-        with open(txt_path, "r", encoding="utf-8") as f:
-            return base_name, f.read().strip()
-
-    caption = generate_caption(image_path, args, filename)
-
-    if args.save_txt:
-        os.makedirs(args.output_dir_txt, exist_ok=True)
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(caption)
-    return base_name, caption
+    try:
+        if args.skip_existing and os.path.exists(txt_path):
+            trace.status = "skipped"
+            with open(txt_path, "r", encoding="utf-8") as f:
+                return base_name, f.read().strip()
+
+        # Shared cross-run cache: content hash + model + rendered prompt (minus the filename),
+        # so renamed/copied/moved images are never re-sent to the API
+        cache_key = content_hash = None
+        if args.caption_cache is not None:
+            try:
+                with trace.stage("cache_lookup"):
+                    content_hash = args.caption_cache.file_hash(image_path)
+                    rendered_prompt = args.template.format(image_filename='{image_filename}', trigger_word=args.trigger_word)
+                    cache_key = args.caption_cache.make_key(content_hash, args.gemini_model, rendered_prompt)
+                    cached_caption = args.caption_cache.get(cache_key)
+                if cached_caption:
+                    trace.status = "cached"
+                    return base_name, cached_caption
+            except Exception as e:
+                print(f"⚠️ Caption cache lookup failed for {image_path}: {e}")
+                cache_key = None
+
+        caption = generate_caption(image_path, args, filename, trace=trace)
+
+        if is_error_caption(caption, args.trigger_word):
+            trace.status = "error"
+        elif cache_key:
+            args.caption_cache.put(cache_key, content_hash, args.gemini_model, caption)
+        return base_name, caption
+    except Exception:
+        trace.status = "error"
+        raise
+    finally:
+        args.trace_writer.write(trace)
 
 def main():
     parser = argparse.ArgumentParser(description="Generate image captions using Gemini Developer API")
     parser.add_argument('--folder', required=True, help='Folder with images')
     parser.add_argument('--output_dir_txt', default='captions_txt', help='Where to save .txt caption files')
     parser.add_argument('--csv_path', default='captions.csv', help='CSV output path')
-    parser.add_argument('--append_csv', action='store_true', help='Append to CSV instead of overwriting')
+    parser.add_argument('--append_csv', action='store_true', help='Append only the captions completed in this run to the CSV instead of rebuilding it from the manifest')
     parser.add_argument('--skip_existing', action='store_true', help='Skip if .txt file already exists')
-    parser.add_argument('--gemini_token', required=True, help='Google Gemini API Key')
+    parser.add_argument('--gemini_token', default=None, help='Google Gemini API Key (required with --backend gemini)')
     parser.add_argument('--gemini_model', default='models/gemini-pro-vision', help='Gemini model ID')
     parser.add_argument('--trigger_word', default='fluxpx', help='Trigger word prefix')
     parser.add_argument('--save_txt', action='store_true', help='Save individual .txt files')
     parser.add_argument('--num_threads', type=int, default=min(4, os.cpu_count()), help='Thread count')
     parser.add_argument('--caption_template_file', help='Custom template file (must include {image_filename} and {trigger_word})')
+    parser.add_argument('--manifest', default=None, help='SQLite run manifest used for resume (default: <csv_path>_manifest.sqlite)')
+    parser.add_argument('--max_attempts', type=int, default=5, help='Give up on an errored image after this many attempts (0 = no limit)')
+    parser.add_argument('--export_only', action='store_true', help='Only export CSV/.txt files from the manifest, without calling Gemini')
+    parser.add_argument('--caption_cache', default=DEFAULT_CACHE_PATH, help='SQLite caption cache shared across runs (content hash + model + prompt)')
+    parser.add_argument('--no_caption_cache', action='store_true', help='Do not read or write the caption cache')
+    parser.add_argument('--backend', choices=BACKENDS, default='gemini', help='gemini: live API; mock: local mock_gemini_server.py (offline tests/benchmarks)')
+    parser.add_argument('--mock_url', default=DEFAULT_MOCK_URL, help='Mock server URL (only with --backend mock)')
+    parser.add_argument('--trace_path', default=None, help='JSONL file for per-image stage timings/counters plus the end-of-run summary')
     args = parser.parse_args()
+    if args.backend == 'gemini' and not args.gemini_token and not args.export_only:
+        parser.error("--gemini_token is required with --backend gemini")
 
     if args.caption_template_file and os.path.exists(args.caption_template_file):
         with open(args.caption_template_file, 'r', encoding='utf-8') as f:
@@ -127,29 +170,52 @@ def main():
     else:
         args.template = DEFAULT_PROMPT_TEMPLATE
 
-    image_paths = sorted([
-        f for ext in IMAGE_EXTENSIONS
-        for f in glob.glob(os.path.join(args.folder, f"**/*{ext}"), recursive=True)
-    ])
-
-    if not args.append_csv or not os.path.exists(args.csv_path):
-        with open(args.csv_path, 'w', encoding='utf-8') as f:
-            f.write('file_name|caption\n')
-
-    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
-        futures = {executor.submit(process_image, path, args): path for path in image_paths}
-
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Generating Captions"):
-            path = futures[future]
-            try:
-                base_name, caption = future.result()
-                with open(args.csv_path, 'a', encoding='utf-8') as f:
-                    f.write(f"{sanitize(base_name)}|{sanitize(caption)}\n")
-            except Exception as e:
-                print(f"❌ Error processing {path}: {e}")
-                fallback = f"{args.trigger_word}, error_exception"
-                with open(args.csv_path, 'a', encoding='utf-8') as f:
-                    f.write(f"{sanitize(os.path.splitext(os.path.basename(path))[0])}|{fallback}\n")
+    manifest = CaptionManifest(args.manifest or default_manifest_path(args.csv_path))
+    print(f"🗂️ Run manifest: {manifest.path}")
+
+    args.caption_cache = None if args.no_caption_cache else CaptionCache(args.caption_cache)
+    run_started = time.time()
+
+    if not args.export_only:
+        image_paths = sorted([
+            f for ext in IMAGE_EXTENSIONS
+            for f in glob.glob(os.path.join(args.folder, f"**/*{ext}"), recursive=True)
+        ])
+
+        # Resume is driven by the manifest alone: done items are skipped, errored ones retried up to --max_attempts
+        skip = manifest.completed() | manifest.exhausted(args.max_attempts)
+        pending = [p for p in image_paths if os.path.relpath(p, args.folder) not in skip]
+        print(f"Found {len(image_paths)} images: {len(image_paths) - len(pending)} skipped from manifest, {len(pending)} pending.")
+        args.trace_writer = TraceWriter(args.trace_path)
+
+        with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+            futures = {executor.submit(timed_call, process_image, path, args): path for path in pending}
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Generating Captions"):
+                path = futures[future]
+                source_key = os.path.relpath(path, args.folder)
+                try:
+                    (base_name, caption), latency = future.result()
+                    if is_error_caption(caption, args.trigger_word):
+                        manifest.record(source_key, base_name, STATUS_ERROR, latency=latency, error=caption)
+                    else:
+                        manifest.record(source_key, base_name, STATUS_DONE, caption=caption, latency=latency)
+                except Exception as e:
+                    print(f"❌ Error processing {path}: {e}")
+                    manifest.record(source_key, os.path.splitext(os.path.basename(path))[0], STATUS_ERROR, error=str(e))
+
+        print_summary(args.trace_writer.close())
+
+    exported = export_captions(
+        manifest, args.csv_path, sanitize,
+        append_since=run_started if args.append_csv else None,
+        txt_dir=args.output_dir_txt if args.save_txt else None
+    )
+    summary = manifest.summary()
+    manifest.close()
+    if args.caption_cache is not None:
+        args.caption_cache.close()
+    print(f"✅ Exported {exported} captions to {args.csv_path} ({summary.get(STATUS_DONE, 0)} done, {summary.get(STATUS_ERROR, 0)} errored in manifest)")
 
 if __name__ == "__main__":
     main()
@@ -196,12 +196,18 @@ import os
 import warnings
 import glob
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import time
 
 from tqdm import tqdm
-from google import genai
-from google.genai import types
+
+from gemini_backends import BACKENDS, DEFAULT_MOCK_URL, make_backend
+from caption_cache import CaptionCache, DEFAULT_CACHE_PATH, hash_file
+from caption_manifest import (CaptionManifest, STATUS_DONE, STATUS_ERROR, default_manifest_path,
+                              export_captions, is_error_caption, timed_call)
+from caption_trace import StageTrace, TraceWriter, is_rate_limit_error, print_summary
 
 warnings.filterwarnings('ignore', category=UserWarning, module='google.generativeai.client')
 warnings.filterwarnings('ignore', category=UserWarning, module='google.ai.generativelanguage')
@@ -243,15 +249,104 @@ A girl stands beneath falling petals, her long hair swaying as soft light glows
 def sanitize_csv_field(text: str) -> str:
     return re.sub(r'\s+', ' ', text.replace('|', ' ').replace('\n', ' ').replace('\r', ' ')).strip()
 
+def get_duration(video_path: str) -> float:
+    command = [
+        "ffprobe", "-v", "0",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        video_path
+    ]
+    try:
+        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return float(result.stdout.decode().strip())
+    except Exception:
+        return 0.0
+
+def proxy_settings_from_args(args: argparse.Namespace) -> dict:
+    return {
+        'mode': args.proxy_mode,
+        'cache_dir': args.proxy_dir,
+        'height': args.proxy_height,
+        'bitrate': args.proxy_bitrate,
+        'fps': args.proxy_fps,
+        'gop': args.proxy_gop,
+        'strip_frames': args.proxy_strip_frames,
+        'strip_columns': args.proxy_strip_columns,
+    }
+
+def build_proxy_command(video_path: str, output_path: str, settings: dict) -> list[str]:
+    height = settings['height']
+    if settings['mode'] == 'keyframes':
+        # Tira única de quadros amostrados uniformemente ao longo do vídeo
+        frames = max(1, settings['strip_frames'])
+        columns = max(1, min(settings['strip_columns'], frames))
+        rows = (frames + columns - 1) // columns
+        duration = get_duration(video_path)
+        sample_rate = frames / duration if duration > 0 else 1
+        vf = f"fps={sample_rate:.6f},scale=-2:{height},tile={columns}x{rows}"
+        return [
+            'ffmpeg', '-y', '-v', 'error', '-i', video_path,
+            '-vf', vf, '-frames:v', '1', '-q:v', '4',
+            output_path
+        ]
+    gop = max(1, settings['gop'])
+    return [
+        'ffmpeg', '-y', '-v', 'error', '-i', video_path,
+        '-vf', f"scale=-2:'min({height},ih)',fps={settings['fps']}",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-b:v', settings['bitrate'], '-maxrate', settings['bitrate'], '-bufsize', settings['bitrate'],
+        '-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0',
+        '-an', '-movflags', '+faststart',
+        output_path
+    ]
+
+def build_proxy(video_path: str, settings: dict, content_hash: str | None = None) -> str:
+    """Roda em um processo do pool: gera (ou reaproveita do cache) o proxy de baixa resolução do vídeo.
+
+    content_hash é o hash já calculado para o cache de legendas; sem ele o vídeo é lido e hasheado aqui.
+    """
+    params = '|'.join(f"{k}={settings[k]}" for k in sorted(settings) if k != 'cache_dir')
+    params_hash = hashlib.blake2b(params.encode('utf-8'), digest_size=4).hexdigest()
+    ext = '.jpg' if settings['mode'] == 'keyframes' else '.mp4'
+    proxy_path = os.path.join(settings['cache_dir'], f"{content_hash or hash_file(video_path)}-{params_hash}{ext}")
+
+    if os.path.exists(proxy_path) and os.path.getsize(proxy_path) > 0:
+        return proxy_path
+
+    os.makedirs(settings['cache_dir'], exist_ok=True)
+    tmp_path = f"{proxy_path}.{os.getpid()}.tmp{ext}"
+    try:
+        subprocess.run(build_proxy_command(video_path, tmp_path, settings),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        os.replace(tmp_path, proxy_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return proxy_path
+
+def resolve_upload_path(video_path: str, proxy_future) -> str:
+    if proxy_future is None:
+        return video_path
+    try:
+        return proxy_future.result()
+    except Exception as e:
+        print(f"⚠️ Falha ao gerar proxy para {video_path}: {e}. Enviando o arquivo original.")
+        return video_path
+
 def generate_caption_with_gemini(
     video_path: str,
     gemini_api_key: str,
     gemini_model_name: str,
     video_filename: str,
     base_prompt_template: str,
-    trigger_word: str
+    trigger_word: str,
+    trace: StageTrace | None = None,
+    backend: str = 'gemini',
+    mock_url: str | None = None
 ) -> str:
-    client = genai.Client(api_key=gemini_api_key)
+    if trace is None:
+        trace = StageTrace(video_filename)
+    client = make_backend(backend, gemini_api_key, mock_url)
     model_for_api = gemini_model_name
 
     prompt_to_send = base_prompt_template.format(video_filename=video_filename, trigger_word=trigger_word)
@@ -260,50 +355,30 @@ def generate_caption_with_gemini(
     uploaded_file_details = None
     try:
         # print(f"DEBUG: Fazendo upload de {video_path}")
-        try:
-            uploaded_file_details = client.files.upload(file_path=video_path)
-        except TypeError:
-            try:
-                uploaded_file_details = client.files.upload(path=video_path)
-            except TypeError:
-                 uploaded_file_details = client.files.upload(file=video_path)
+        with trace.stage('upload'):
+            uploaded_file_details = client.upload(video_path)
+        trace.count('bytes_uploaded', os.path.getsize(video_path))
 
         # print(f"DEBUG: Upload de {video_path} como {uploaded_file_details.name}, estado inicial: {uploaded_file_details.state}")
 
-        for i in range(120):
-            current_file_status = client.files.get(name=uploaded_file_details.name)
-            # print(f"DEBUG Polling {i+1}: {current_file_status.name} state: {current_file_status.state}")
-            current_state_str = str(current_file_status.state).upper()
-            if "ACTIVE" in current_state_str:
-                break
-            time.sleep(0.5)
-        else:
-            # print(f"DEBUG: Arquivo {uploaded_file_details.name} não ficou ativo. Último estado: {current_file_status.state}")
-            raise RuntimeError(f"Arquivo {uploaded_file_details.name} não ativo após upload. Último estado: {current_file_status.state}")
+        with trace.stage('activation'):
+            for i in range(120):
+                current_file_status = client.get(uploaded_file_details.name)
+                trace.count('poll_iterations')
+                # print(f"DEBUG Polling {i+1}: {current_file_status.name} state: {current_file_status.state}")
+                current_state_str = str(current_file_status.state).upper()
+                if "ACTIVE" in current_state_str:
+                    break
+                time.sleep(0.5)
+            else:
+                # print(f"DEBUG: Arquivo {uploaded_file_details.name} não ficou ativo. Último estado: {current_file_status.state}")
+                raise RuntimeError(f"Arquivo {uploaded_file_details.name} não ativo após upload. Último estado: {current_file_status.state}")
         # print(f"DEBUG: Arquivo {uploaded_file_details.name} está ativo.")
 
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=prompt_to_send),
-                    types.Part.from_uri(file_uri=uploaded_file_details.uri, mime_type=uploaded_file_details.mime_type)
-                ],
-            ),
-        ]
-        
-        # Renomeado para config_obj para evitar confusão com o parâmetro 'config' da função
-        config_obj = types.GenerateContentConfig(
-            response_mime_type="text/plain",
-            candidate_count=1
-        )
-
         # print(f"DEBUG: Gerando conteúdo com o modelo {model_for_api}...")
-        response = client.models.generate_content(
-            model=model_for_api,
-            contents=contents,
-            config=config_obj # <--- CORREÇÃO APLICADA AQUI
-        )
+        with trace.stage('generation'):
+            response = client.generate(model_for_api, prompt_to_send, uploaded_file_details)
+        trace.record_usage(response)
         # print("DEBUG: Resposta recebida do Gemini.")
 
         raw_gemini_output_text = ""
@@ -330,6 +405,9 @@ def generate_caption_with_gemini(
 
     except Exception as e:
         print(f"‼️ ERRO em generate_caption_with_gemini para {video_filename}: {type(e).__name__} - {e}")
+        trace.count('exceptions')
+        if is_rate_limit_error(e):
+            trace.count('rate_limited')
         # import traceback
         # traceback.print_exc() # Descomente para debug MUITO detalhado do erro exato
         return f"{trigger_word}, error_exception_during_generation_for_{sanitize_csv_field(video_filename)}"
@@ -337,51 +415,103 @@ def generate_caption_with_gemini(
         if uploaded_file_details and hasattr(uploaded_file_details, 'name'):
             try:
                 # print(f"DEBUG: Tentando excluir arquivo {uploaded_file_details.name}")
-                client.files.delete(name=uploaded_file_details.name)
+                with trace.stage('deletion'):
+                    client.delete(uploaded_file_details.name)
             except Exception as e_del:
                 print(f"⚠️ Falha ao excluir arquivo Gemini {uploaded_file_details.name}: {e_del}")
 
 
-def process_video_for_caption(video_path: str, args: argparse.Namespace) -> tuple[str, str]:
+def lookup_cached_caption(video_path: str, args: argparse.Namespace) -> tuple:
+    """(content_hash, cache_key, legenda em cache ou None). O hash é memoizado por (path, tamanho, mtime) no cache."""
+    if args.caption_cache is None:
+        return None, None, None
+    template_to_use = args.custom_caption_template_content if args.custom_caption_template_content else DEFAULT_CAPTION_TEMPLATE
+    try:
+        content_hash = args.caption_cache.file_hash(video_path)
+        rendered_prompt = template_to_use.format(video_filename='{video_filename}', trigger_word=args.trigger_word)
+        cache_key = args.caption_cache.make_key(content_hash, args.gemini_model, rendered_prompt)
+        return content_hash, cache_key, args.caption_cache.get(cache_key)
+    except Exception as e_cache:
+        print(f"⚠️ Erro ao consultar cache de legendas para {video_path}: {e_cache}")
+        return None, None, None
+
+def prepare_video(video_path: str, args: argparse.Namespace, proxy_executor, proxy_settings: dict) -> tuple:
+    """Consulta o cache primeiro; o proxy só é enviado ao pool de processos em caso de miss, reaproveitando o mesmo hash."""
+    lookup = lookup_cached_caption(video_path, args)
+    proxy_future = None
+    if not lookup[2]:
+        proxy_future = proxy_executor.submit(build_proxy, video_path, proxy_settings, lookup[0])
+    return lookup, proxy_future
+
+def process_video_for_caption(video_path: str, args: argparse.Namespace, prepared=None) -> tuple[str, str]:
     base_name = os.path.splitext(os.path.basename(video_path))[0]
     # print(f"🎬 Processando: {video_path}")
+    trace = StageTrace(base_name)
+    try:
+        if args.skip_existing_txt:
+            txt_file_path = os.path.join(args.output_dir_txt, base_name + ".txt")
+            if os.path.exists(txt_file_path):
+                try:
+                    with open(txt_file_path, 'r', encoding='utf-8') as f_txt:
+                        existing_caption = f_txt.read().strip()
+                    if existing_caption:
+                        # print(f"⏭️ Usando .txt existente: {txt_file_path}")
+                        trace.status = 'skipped'
+                        return base_name, existing_caption
+                except Exception as e_read:
+                    print(f"⚠️ Erro ao ler .txt {txt_file_path}: {e_read}. Gerando novamente.")
+
+        template_to_use = args.custom_caption_template_content if args.custom_caption_template_content else DEFAULT_CAPTION_TEMPLATE
+
+        # Cache compartilhado entre execuções: hash do conteúdo + modelo + prompt renderizado (sem o nome do arquivo),
+        # então vídeos renomeados, copiados ou movidos para outro dataset não são reenviados.
+        # Com proxies, a consulta já foi feita em prepare_video (antes de qualquer transcodificação).
+        with trace.stage('cache_lookup'):
+            if prepared is not None:
+                (content_hash, cache_key, cached_caption), proxy_future = prepared.result()
+            else:
+                (content_hash, cache_key, cached_caption), proxy_future = lookup_cached_caption(video_path, args), None
+        if cached_caption:
+            trace.status = 'cached'
+            return base_name, cached_caption
+
+        with trace.stage('proxy_wait'):
+            upload_path = resolve_upload_path(video_path, proxy_future)
+
+        caption_from_gemini = generate_caption_with_gemini(
+            video_path=upload_path,
+            gemini_api_key=args.gemini_token,
+            gemini_model_name=args.gemini_model,
+            video_filename=base_name,
+            base_prompt_template=template_to_use,
+            trigger_word=args.trigger_word,
+            trace=trace,
+            backend=args.backend,
+            mock_url=args.mock_url
+        )
 
-    if args.skip_existing_txt:
-        txt_file_path = os.path.join(args.output_dir_txt, base_name + ".txt")
-        if os.path.exists(txt_file_path):
-            try:
-                with open(txt_file_path, 'r', encoding='utf-8') as f_txt:
-                    existing_caption = f_txt.read().strip()
-                if existing_caption:
-                    # print(f"⏭️ Usando .txt existente: {txt_file_path}")
-                    return base_name, existing_caption
-            except Exception as e_read:
-                print(f"⚠️ Erro ao ler .txt {txt_file_path}: {e_read}. Gerando novamente.")
-
-    template_to_use = args.custom_caption_template_content if args.custom_caption_template_content else DEFAULT_CAPTION_TEMPLATE
-    
-    caption_from_gemini = generate_caption_with_gemini(
-        video_path=video_path,
-        gemini_api_key=args.gemini_token,
-        gemini_model_name=args.gemini_model,
-        video_filename=base_name,
-        base_prompt_template=template_to_use,
-        trigger_word=args.trigger_word
-    )
-
-    final_caption_for_files = caption_from_gemini.strip()
+        final_caption_for_files = caption_from_gemini.strip()
 
-    if not final_caption_for_files or \
-       final_caption_for_files.lower() == args.trigger_word.lower() or \
-       final_caption_for_files.lower() == args.trigger_word.lower() + ",":
-        # print(f"⚠️ Legenda final vazia ou mínima para {base_name} após chamada Gemini. Saída Gemini: '{caption_from_gemini}'. Usando erro padrão.") # Descomente para debug
-        final_caption_for_files = f"{args.trigger_word}, error_empty_or_minimal_output_for_{sanitize_csv_field(base_name)}"
+        if not final_caption_for_files or \
+           final_caption_for_files.lower() == args.trigger_word.lower() or \
+           final_caption_for_files.lower() == args.trigger_word.lower() + ",":
+            # print(f"⚠️ Legenda final vazia ou mínima para {base_name} após chamada Gemini. Saída Gemini: '{caption_from_gemini}'. Usando erro padrão.") # Descomente para debug
+            final_caption_for_files = f"{args.trigger_word}, error_empty_or_minimal_output_for_{sanitize_csv_field(base_name)}"
     
-    # if not final_caption_for_files.lower().startswith(args.trigger_word.lower()): # Descomente para debug
-    #    print(f"INFO: Legenda para '{base_name}' NÃO começou com a trigger '{args.trigger_word}'. Legenda: '{final_caption_for_files}'")
-
-
-    return base_name, final_caption_for_files
+        # if not final_caption_for_files.lower().startswith(args.trigger_word.lower()): # Descomente para debug
+        #    print(f"INFO: Legenda para '{base_name}' NÃO começou com a trigger '{args.trigger_word}'. Legenda: '{final_caption_for_files}'")
+
+        if is_error_caption(final_caption_for_files, args.trigger_word):
+            trace.status = 'error'
+        elif cache_key:
+            args.caption_cache.put(cache_key, content_hash, args.gemini_model, final_caption_for_files)
+
+        return base_name, final_caption_for_files
+    except Exception:
+        trace.status = 'error'
+        raise
+    finally:
+        args.trace_writer.write(trace)
 
 
 def main():
@@ -389,16 +519,36 @@ def main():
     parser.add_argument('--folder', required=True, help='Pasta com arquivos de vídeo (pode buscar recursivamente)')
     parser.add_argument('--output_dir_txt', default='captions_txt', help='Pasta de saída para arquivos .txt')
     parser.add_argument('--csv_path', default='metadata.csv', help='Caminho de saída do CSV (ex: metadata.csv)')
-    parser.add_argument('--append_csv', action='store_true', help='Anexar ao CSV existente em vez de sobrescrever')
+    parser.add_argument('--append_csv', action='store_true', help='Anexar ao CSV apenas as legendas concluídas nesta execução, em vez de reconstruí-lo a partir do manifesto')
     parser.add_argument('--skip_existing_txt', action='store_true', help='Pular vídeos se um arquivo de legenda .txt já existir (lê o conteúdo se existir)')
-    parser.add_argument('--gemini_token', type=str, required=True, help='Chave API do Google AI Studio para Gemini')
+    parser.add_argument('--gemini_token', type=str, default=None, help='Chave API do Google AI Studio para Gemini (obrigatória com --backend gemini)')
     parser.add_argument('--num_threads', type=int, default=min(2, os.cpu_count() or 1), help='Número de threads paralelas (reduzido para evitar rate limit).')
     parser.add_argument('--gemini_model', type=str, default='models/gemini-pro-vision', help='Modelo Gemini a ser usado (ex: models/gemini-pro-vision para API com client.files ou models/gemini-1.5-flash-latest para API mais nova)')
     parser.add_argument('--caption_template_file', type=str, default=None, help='Caminho para um arquivo de texto de template de prompt personalizado. Substitui o padrão. Deve conter os placeholders {video_filename} e {trigger_word}.')
     parser.add_argument('--trigger_word', type=str, default='lvwpx', help="Trigger word primária a ser incluída no prompt e no início da legenda.")
     parser.add_argument('--save_txt', action='store_true', help='Salvar legendas como arquivos .txt individuais em output_dir_txt')
+    parser.add_argument('--proxy', action='store_true', help='Transcodificar cada vídeo para um proxy leve (cache local) antes do upload')
+    parser.add_argument('--proxy_mode', choices=['video', 'keyframes'], default='video', help='video: proxy de baixa resolução/bitrate com GOP curto; keyframes: tira única de quadros amostrados (imagem)')
+    parser.add_argument('--proxy_dir', default='.proxy_cache', help='Pasta de cache dos proxies (chaveada pelo hash do vídeo de origem)')
+    parser.add_argument('--proxy_height', type=int, default=360, help='Altura máxima do proxy em pixels')
+    parser.add_argument('--proxy_bitrate', default='400k', help='Bitrate de vídeo do proxy (ex: 400k)')
+    parser.add_argument('--proxy_fps', type=int, default=12, help='FPS do proxy')
+    parser.add_argument('--proxy_gop', type=int, default=12, help='Tamanho do GOP do proxy (intervalo entre keyframes)')
+    parser.add_argument('--proxy_strip_frames', type=int, default=8, help='Número de quadros na tira (apenas --proxy_mode keyframes)')
+    parser.add_argument('--proxy_strip_columns', type=int, default=4, help='Colunas da tira de quadros (apenas --proxy_mode keyframes)')
+    parser.add_argument('--proxy_workers', type=int, default=os.cpu_count() or 1, help='Processos paralelos para gerar os proxies')
+    parser.add_argument('--manifest', type=str, default=None, help='Manifesto SQLite da execução (padrão: <csv_path>_manifest.sqlite). Controla a retomada.')
+    parser.add_argument('--max_attempts', type=int, default=5, help='Máximo de tentativas por vídeo com erro antes de desistir (0 = sem limite)')
+    parser.add_argument('--export_only', action='store_true', help='Apenas exportar CSV/.txt a partir do manifesto, sem chamar o Gemini')
+    parser.add_argument('--caption_cache', type=str, default=DEFAULT_CACHE_PATH, help='Cache SQLite de legendas compartilhado entre execuções (hash do vídeo + modelo + prompt)')
+    parser.add_argument('--no_caption_cache', action='store_true', help='Não consultar nem gravar o cache de legendas')
+    parser.add_argument('--backend', choices=BACKENDS, default='gemini', help='gemini: API real; mock: servidor local mock_gemini_server.py (testes/benchmark offline)')
+    parser.add_argument('--mock_url', type=str, default=DEFAULT_MOCK_URL, help='URL do servidor mock (apenas --backend mock)')
+    parser.add_argument('--trace_path', type=str, default=None, help='Arquivo JSONL para o trace por vídeo (tempos de upload/ativação/geração/exclusão e contadores) e o resumo final')
     
     args = parser.parse_args()
+    if args.backend == 'gemini' and not args.gemini_token and not args.export_only:
+        parser.error("--gemini_token é obrigatório com --backend gemini")
 
     args.custom_caption_template_content = None
     if args.caption_template_file:
@@ -414,55 +564,88 @@ def main():
         except Exception as e:
             print(f"⚠️ Não foi possível carregar o template personalizado de {args.caption_template_file}: {e}. Usando template padrão.")
 
-    if args.save_txt:
-        os.makedirs(args.output_dir_txt, exist_ok=True)
-
-    if not args.append_csv or not os.path.exists(args.csv_path):
-        csv_dir = os.path.dirname(args.csv_path)
-        if csv_dir and not os.path.exists(csv_dir):
-            os.makedirs(csv_dir, exist_ok=True)
-        with open(args.csv_path, 'w', encoding='utf-8') as f:
-            f.write('file_name|caption\n')
-
-    video_files = sorted([f for ext in VIDEO_EXTENSIONS for f in glob.glob(os.path.join(args.folder, f'**/*{ext}'), recursive=True)])
-    
-    if not video_files:
-        print(f"Nenhum arquivo de vídeo encontrado em {args.folder} com as extensões {VIDEO_EXTENSIONS}")
-        return
-
-    print(f"Encontrados {len(video_files)} arquivos de vídeo para processar com a trigger word '{args.trigger_word}'.")
-    print(f"Usando modelo Gemini: {args.gemini_model}")
-
+    manifest = CaptionManifest(args.manifest or default_manifest_path(args.csv_path))
+    print(f"🗂️ Manifesto da execução: {manifest.path}")
+
+    args.caption_cache = None if args.no_caption_cache else CaptionCache(args.caption_cache)
+    run_started = time.time()
+
+    if not args.export_only:
+        video_files = sorted([f for ext in VIDEO_EXTENSIONS for f in glob.glob(os.path.join(args.folder, f'**/*{ext}'), recursive=True)])
+
+        if not video_files:
+            print(f"Nenhum arquivo de vídeo encontrado em {args.folder} com as extensões {VIDEO_EXTENSIONS}")
+            manifest.close()
+            return
+
+        # A retomada usa apenas o manifesto: concluídos são pulados, erros são tentados de novo até --max_attempts.
+        skip = manifest.completed() | manifest.exhausted(args.max_attempts)
+        pending = [f for f in video_files if os.path.relpath(f, args.folder) not in skip]
+
+        print(f"Encontrados {len(video_files)} arquivos de vídeo para processar com a trigger word '{args.trigger_word}'.")
+        print(f"Retomando pelo manifesto: {len(video_files) - len(pending)} pulados, {len(pending)} pendentes.")
+        print(f"Usando modelo Gemini: {args.gemini_model}")
+        args.trace_writer = TraceWriter(args.trace_path)
+
+        # Os proxies são gerados em um pool de processos; cada legenda espera apenas pelo seu proxy,
+        # então os uploads começam enquanto os proxies seguintes ainda estão sendo codificados.
+        # A preparação consulta o cache de legendas antes, e só vídeos sem legenda em cache viram proxy.
+        proxy_executor = prepare_executor = None
+        prepared = {}
+        if args.proxy and pending:
+            print(f"🎞️ Gerando proxies ({args.proxy_mode}) em '{args.proxy_dir}' com {args.proxy_workers} processos.")
+            proxy_settings = proxy_settings_from_args(args)
+            proxy_executor = ProcessPoolExecutor(max_workers=args.proxy_workers)
+            prepare_executor = ThreadPoolExecutor(max_workers=args.proxy_workers)
+            for video_path in pending:
+                if args.skip_existing_txt:
+                    base_name = os.path.splitext(os.path.basename(video_path))[0]
+                    if os.path.exists(os.path.join(args.output_dir_txt, base_name + ".txt")):
+                        continue
+                prepared[video_path] = prepare_executor.submit(prepare_video, video_path, args, proxy_executor, proxy_settings)
+
+        with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+            futures_map = {executor.submit(timed_call, process_video_for_caption, video_path, args, prepared.get(video_path)): video_path for video_path in pending}
+
+            for future in tqdm(as_completed(futures_map), total=len(pending), desc="Gerando Legendas"):
+                video_path_processed = futures_map[future]
+                source_key = os.path.relpath(video_path_processed, args.folder)
+                try:
+                    (base_name, caption_tags), latency = future.result()
+                    if is_error_caption(caption_tags, args.trigger_word):
+                        manifest.record(source_key, base_name, STATUS_ERROR, latency=latency, error=caption_tags)
+                    else:
+                        manifest.record(source_key, base_name, STATUS_DONE, caption=caption_tags, latency=latency)
+
+                except Exception as e:
+                    print(f"‼️ Erro FATAL ao processar vídeo {video_path_processed} no loop principal: {type(e).__name__} - {e}")
+                    # import traceback
+                    # traceback.print_exc()
+                    error_base_name = os.path.splitext(os.path.basename(video_path_processed))[0]
+                    manifest.record(source_key, error_base_name, STATUS_ERROR, error=f"{type(e).__name__}: {e}")
+
+        if prepare_executor is not None:
+            prepare_executor.shutdown()
+        if proxy_executor is not None:
+            proxy_executor.shutdown()
+
+        print_summary(args.trace_writer.close())
+        if args.trace_path:
+            print(f"🧾 Trace salvo em: {args.trace_path}")
+
+    # CSV e .txt são exportados numa única passada a partir do manifesto; linhas de erro ficam só no manifesto.
+    exported = export_captions(
+        manifest, args.csv_path, sanitize_csv_field,
+        append_since=run_started if args.append_csv else None,
+        txt_dir=args.output_dir_txt if args.save_txt else None
+    )
+    summary = manifest.summary()
+    manifest.close()
+    if args.caption_cache is not None:
+        args.caption_cache.close()
 
-    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
-        futures_map = {executor.submit(process_video_for_caption, video_path, args): video_path for video_path in video_files}
-        
-        for future in tqdm(as_completed(futures_map), total=len(video_files), desc="Gerando Legendas"):
-            video_path_processed = futures_map[future]
-            try:
-                base_name, caption_tags = future.result()
-                
-                if args.save_txt:
-                    txt_file = os.path.join(args.output_dir_txt, base_name + ".txt")
-                    with open(txt_file, 'w', encoding='utf-8') as f_txt:
-                        f_txt.write(caption_tags)
-                
-                caption_for_csv = sanitize_csv_field(caption_tags)
-                row = [sanitize_csv_field(base_name), caption_for_csv]
-                
-                with open(args.csv_path, 'a', encoding='utf-8') as f_csv:
-                    f_csv.write('|'.join(row) + '\n')
-
-            except Exception as e:
-                print(f"‼️ Erro FATAL ao processar vídeo {video_path_processed} no loop principal: {type(e).__name__} - {e}")
-                # import traceback
-                # traceback.print_exc()
-                error_base_name = os.path.splitext(os.path.basename(video_path_processed))[0]
-                error_row = [sanitize_csv_field(error_base_name), f"{args.trigger_word}, error_fatal_processing_in_main_loop"]
-                with open(args.csv_path, 'a', encoding='utf-8') as f_csv:
-                    f_csv.write('|'.join(error_row) + '\n')
-
-    print(f"\n✅ Geração de legendas concluída. Saídas em '{args.output_dir_txt}' (se --save_txt) e CSV em '{args.csv_path}'")
+    print(f"📊 Manifesto: {summary.get(STATUS_DONE, 0)} concluídos, {summary.get(STATUS_ERROR, 0)} com erro.")
+    print(f"\n✅ Geração de legendas concluída. {exported} legendas exportadas: '{args.output_dir_txt}' (se --save_txt) e CSV em '{args.csv_path}'")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,294 @@
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import torch
+
+SVD_METHODS = ['randomized', 'exact']
+PRUNE_METHODS = ['sample', 'histogram', 'exact', 'random']
+PRUNE_CHUNK = 4 * 1024 * 1024
+
+
+def truncated_svd(matrix: torch.Tensor, rank: int, method: str = 'randomized', niter: int = 2, oversample: int = 8):
+    """Top-`rank` singular triplets of a 2D matrix as (U, S, Vh) with full_matrices=False shapes.
+
+    'randomized' uses torch.svd_lowrank (Halko et al.) with `niter` power iterations on a
+    rank + oversample sketch, which costs O(m·n·k) instead of the O(m·n·min(m,n)) of a full SVD.
+    'exact' runs torch.linalg.svd and slices.
+    """
+    rank = min(rank, *matrix.shape)
+    if method == 'exact':
+        U, S, Vh = torch.linalg.svd(matrix, full_matrices=False)
+        return U[:, :rank], S[:rank], Vh[:rank, :]
+    if method != 'randomized':
+        raise ValueError(f"Unknown SVD method '{method}'. Use one of {SVD_METHODS}.")
+    q = min(rank + oversample, *matrix.shape)
+    U, S, V = torch.svd_lowrank(matrix, q=q, niter=niter)
+    return U[:, :rank], S[:rank], V[:, :rank].mT
+
+
+def extract_lora_pair(diff: torch.Tensor, rank: int, method: str = 'randomized', niter: int = 2, oversample: int = 8):
+    """Factorize a 2D (linear) or 4D (conv) weight difference into LoRA (down, up) weights.
+
+    Returns (lora_down, lora_up, relative_error), where relative_error is the Frobenius norm of the
+    residual divided by the norm of diff. Both SVD paths satisfy Uᵀ·diff·V = diag(S), so the residual
+    is sqrt(‖diff‖² − ‖S‖²) and no rank-r reconstruction has to be materialized.
+    """
+    original_shape = diff.shape
+    matrix = diff.reshape(original_shape[0], -1) if diff.dim() == 4 else diff
+    U, S, Vh = truncated_svd(matrix, rank, method, niter, oversample)
+    effective_rank = S.shape[0]
+    lora_down = Vh
+    lora_up = U * S.unsqueeze(0)
+
+    total = matrix.double().pow(2).sum().item()
+    kept = S.double().pow(2).sum().item()
+    relative_error = math.sqrt(max(total - kept, 0.0) / total) if total > 0 else 0.0
+
+    if diff.dim() == 4:
+        lora_down = lora_down.reshape(effective_rank, original_shape[1], *original_shape[2:])
+        lora_up = lora_up.reshape(original_shape[0], effective_rank, 1, 1)
+    return lora_down, lora_up, relative_error
+
+
+def magnitude_threshold(flat: torch.Tensor, prune_rate: float, method: str = 'sample',
+                        sample_size: int = 1_000_000, bins: int = 4096) -> float:
+    """|value| below which `prune_rate` of the elements of a 1D tensor lie.
+
+    'exact' is the kthvalue of the whole |flat| (one full-size temporary). 'sample' takes the
+    kthvalue of a uniform random sample, 'histogram' interpolates inside the bin of a chunked
+    histogram of |flat|; both only allocate sample- or chunk-sized temporaries.
+    """
+    numel = flat.numel()
+    k = max(1, min(numel, int(numel * prune_rate)))
+    if method == 'exact' or (method == 'sample' and numel <= sample_size):
+        return torch.kthvalue(flat.abs(), k=k).values.item()
+    if method == 'sample':
+        index = torch.randint(numel, (sample_size,), device=flat.device)
+        sample = flat[index].abs_()
+        return torch.kthvalue(sample, k=max(1, min(sample_size, int(sample_size * prune_rate)))).values.item()
+    if method != 'histogram':
+        raise ValueError(f"Unknown threshold method '{method}'. Use one of {PRUNE_METHODS}.")
+
+    max_abs = max(chunk.abs().max().item() for chunk in flat.split(PRUNE_CHUNK))
+    if max_abs == 0:
+        return 0.0
+    counts = torch.zeros(bins, dtype=torch.float64, device=flat.device)
+    for chunk in flat.split(PRUNE_CHUNK):
+        counts += torch.histc(chunk.abs(), bins=bins, min=0.0, max=max_abs).double()
+    cumulative = counts.cumsum(0)
+    bin_index = int(torch.searchsorted(cumulative, torch.tensor([float(k)], dtype=torch.float64, device=flat.device)).item())
+    bin_index = min(bin_index, bins - 1)
+    before = cumulative[bin_index - 1].item() if bin_index > 0 else 0.0
+    in_bin = counts[bin_index].item()
+    fraction = (k - before) / in_bin if in_bin > 0 else 0.0
+    return (bin_index + fraction) * max_abs / bins
+
+
+def prune_diff_(diff: torch.Tensor, prune_rate: float, method: str = 'sample', sample_size: int = 1_000_000) -> torch.Tensor:
+    """DARE step applied in place, chunk by chunk, so no full-size mask or |diff| copy is allocated.
+
+    Magnitude methods ('sample', 'histogram', 'exact') zero every element whose |value| is below the
+    estimated threshold. 'random' is the original DARE: drop each element with probability
+    prune_rate and rescale the survivors by 1 / (1 - prune_rate) so the expected delta is unchanged.
+    """
+    if prune_rate <= 0 or diff.numel() == 0:
+        return diff
+    flat = diff.view(-1)
+    if method == 'random':
+        if prune_rate >= 1:
+            return diff.zero_()
+        scale = 1.0 / (1.0 - prune_rate)
+        for chunk in flat.split(PRUNE_CHUNK):
+            chunk.masked_fill_(torch.rand_like(chunk) < prune_rate, 0).mul_(scale)
+        return diff
+    if int(flat.numel() * prune_rate) <= 0:
+        return diff
+    threshold = magnitude_threshold(flat, prune_rate, method, sample_size)
+    for chunk in flat.split(PRUNE_CHUNK):
+        chunk.masked_fill_(chunk.abs() < threshold, 0)
+    return diff
+
+
+def layer_seed(key: str, seed: int) -> int:
+    """Per-layer RNG seed, so randomized SVD results do not depend on processing order or worker count."""
+    return (seed * 1_000_003 + zlib.crc32(key.encode('utf-8'))) % (2 ** 63)
+
+
+def extract_layer(base_tensor: torch.Tensor, tuned_tensor: torch.Tensor, rank: int, device: str = 'cpu',
+                  prune_rate: float = 0.0, svd_method: str = 'randomized', svd_niter: int = 2, svd_oversample: int = 8,
+                  seed: int | None = None, prune_method: str = 'sample', prune_sample_size: int = 1_000_000):
+    """diff -> DARE magnitude pruning -> truncated SVD for one layer.
+
+    Returns (lora_down, lora_up, relative_error) on the CPU, or None when the pair cannot be
+    factorized (shape mismatch or not a linear/conv weight).
+    """
+    if base_tensor.shape != tuned_tensor.shape:
+        return None
+    if seed is not None:
+        torch.manual_seed(seed)
+    diff = tuned_tensor.to(device=device, dtype=torch.float32) - base_tensor.to(device=device, dtype=torch.float32)
+    if diff.dim() not in [2, 4]:
+        return None
+
+    prune_diff_(diff, prune_rate, prune_method, prune_sample_size)
+
+    lora_down, lora_up, relative_error = extract_lora_pair(diff, rank, svd_method, svd_niter, svd_oversample)
+    return lora_down.cpu(), lora_up.cpu(), relative_error
+
+
+def print_error_report(errors: dict[str, float], worst: int = 5):
+    """Summary of the per-layer relative approximation errors returned by extract_lora_pair."""
+    if not errors:
+        return
+    values = sorted(errors.values())
+    mean = sum(values) / len(values)
+    median = values[len(values) // 2]
+    print(f"📐 Erro relativo de aproximação (Frobenius): média {mean:.4f}, mediana {median:.4f}, máximo {values[-1]:.4f}")
+    for key, error in sorted(errors.items(), key=lambda item: item[1], reverse=True)[:worst]:
+        print(f"   - {key}: {error:.4f}")
+
+
+def iter_layer_pairs(base, tuned, keys, prefetch: int = 2):
+    """Yield (key, base_tensor, tuned_tensor) for each key, reading ahead on a background thread.
+
+    base and tuned are LazySafetensors. At most `prefetch` pairs wait in the queue, so while the
+    caller diffs and factorizes one layer the next ones are read from disk, and peak memory stays at
+    a few layers instead of two full checkpoints.
+    """
+    pairs = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pairs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for key in keys:
+                if not put((key, base.get_tensor(key), tuned.get_tensor(key))):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = pairs.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+@dataclass
+class PoolConfig:
+    """Worker layout for parallel extraction on CPU.
+
+    Layers with at least large_numel elements go to `large_workers` processes that each use
+    `large_threads` intra-op threads; everything smaller goes to `small_workers` single-threaded
+    processes, so many small SVDs run side by side instead of leaving cores idle.
+    """
+    small_workers: int
+    large_workers: int = 1
+    large_threads: int = 1
+    large_numel: int = 16 * 1024 * 1024
+
+    @classmethod
+    def for_cpus(cls, cpus: int | None = None, large_workers: int = 2, large_numel: int = 16 * 1024 * 1024):
+        cpus = cpus or os.cpu_count() or 1
+        large_workers = max(1, min(large_workers, cpus // 2))
+        large_threads = max(1, cpus // (2 * large_workers))
+        small_workers = max(1, cpus - large_workers * large_threads)
+        return cls(small_workers, large_workers, large_threads, large_numel)
+
+    def describe(self) -> str:
+        return (f"{self.small_workers} small x 1 thread + {self.large_workers} large x {self.large_threads} threads "
+                f"(large >= {self.large_numel:,} elements)")
+
+
+_worker_state = {}
+
+
+def _init_worker(base_path: str, tuned_path: str, threads: int, options: dict):
+    from safetensors_io import LazySafetensors
+    torch.set_num_threads(threads)
+    _worker_state['base'] = LazySafetensors(base_path)
+    _worker_state['tuned'] = LazySafetensors(tuned_path)
+    _worker_state['options'] = options
+
+
+def _extract_in_worker(key: str, seed: int):
+    # Each worker reads its own layer pair from the mmapped files; only the small factors travel back
+    base_tensor = _worker_state['base'].get_tensor(key)
+    tuned_tensor = _worker_state['tuned'].get_tensor(key)
+    return extract_layer(base_tensor, tuned_tensor, seed=layer_seed(key, seed), **_worker_state['options'])
+
+
+def iter_extracted_layers(base, tuned, keys, rank: int, device: str = 'cpu', prune_rate: float = 0.0,
+                          svd_method: str = 'randomized', svd_niter: int = 2, svd_oversample: int = 8,
+                          seed: int = 0, prefetch: int = 2, pool: PoolConfig | None = None,
+                          prune_method: str = 'sample', prune_sample_size: int = 1_000_000):
+    """Yield (key, result, error) for every key, always in the order of `keys`.
+
+    result is what extract_layer returns (or None), error the exception that prevented it. Without a
+    pool, layers are processed here one at a time with a prefetch thread; with a pool (CPU only),
+    they are dispatched to the small/large worker processes with a bounded number in flight.
+    """
+    options = {'rank': rank, 'device': device, 'prune_rate': prune_rate, 'svd_method': svd_method,
+               'svd_niter': svd_niter, 'svd_oversample': svd_oversample,
+               'prune_method': prune_method, 'prune_sample_size': prune_sample_size}
+    if pool is None or device != 'cpu':
+        for key, base_tensor, tuned_tensor in iter_layer_pairs(base, tuned, keys, prefetch):
+            try:
+                yield key, extract_layer(base_tensor, tuned_tensor, seed=layer_seed(key, seed), **options), None
+            except Exception as e:
+                yield key, None, e
+        return
+
+    # spawn: forking a process whose torch thread pools are already running can deadlock
+    context = multiprocessing.get_context('spawn')
+    small = ProcessPoolExecutor(pool.small_workers, mp_context=context, initializer=_init_worker,
+                                initargs=(base.path, tuned.path, 1, options))
+    large = ProcessPoolExecutor(pool.large_workers, mp_context=context, initializer=_init_worker,
+                                initargs=(base.path, tuned.path, pool.large_threads, options))
+    max_in_flight = 4 * (pool.small_workers + pool.large_workers)
+    pending = deque()
+    try:
+        for key in keys:
+            executor = large if base.info(key).numel >= pool.large_numel else small
+            pending.append((key, executor.submit(_extract_in_worker, key, seed)))
+            while len(pending) >= max_in_flight:
+                yield _collect(*pending.popleft())
+        while pending:
+            yield _collect(*pending.popleft())
+    finally:
+        for _, future in pending:
+            future.cancel()
+        small.shutdown(wait=True, cancel_futures=True)
+        large.shutdown(wait=True, cancel_futures=True)
+
+
+def _collect(key, future):
+    try:
+        return key, future.result(), None
+    except Exception as e:
+        return key, None, e
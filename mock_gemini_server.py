@@ -0,0 +1,188 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class MockSettings:
+    upload_mbps: float = 50.0           # simulated upload bandwidth per request (0 = unlimited)
+    activation_median: float = 1.5      # seconds until an uploaded file becomes ACTIVE (lognormal)
+    activation_sigma: float = 0.5
+    generation_median: float = 3.0      # generate_content latency in seconds (lognormal)
+    generation_sigma: float = 0.4
+    error_rate_429: float = 0.0         # probability of a random 429 on upload/generate
+    rpm_limit: int = 0                  # generate requests per minute before 429 (0 = no quota)
+    caption_prefix: str = ''
+    seed: int | None = None
+
+
+class MockGeminiState:
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.rng = random.Random(settings.seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.generate_times = deque()
+        self.stats = {'uploads': 0, 'generates': 0, 'deletes': 0, 'polls': 0, 'rate_limited': 0}
+
+    def lognormal(self, median: float, sigma: float) -> float:
+        if median <= 0:
+            return 0.0
+        with self.lock:
+            return self.rng.lognormvariate(0.0, sigma) * median
+
+    def should_rate_limit(self, is_generate: bool) -> bool:
+        with self.lock:
+            if self.settings.error_rate_429 and self.rng.random() < self.settings.error_rate_429:
+                self.stats['rate_limited'] += 1
+                return True
+            if is_generate and self.settings.rpm_limit:
+                now = time.monotonic()
+                while self.generate_times and now - self.generate_times[0] > 60:
+                    self.generate_times.popleft()
+                if len(self.generate_times) >= self.settings.rpm_limit:
+                    self.stats['rate_limited'] += 1
+                    return True
+                self.generate_times.append(now)
+        return False
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def state(self) -> MockGeminiState:
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code: int, payload: dict):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == '/files':
+            self.handle_upload(body)
+        elif self.path == '/generate':
+            self.handle_generate(body)
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_GET(self):
+        with self.state.lock:
+            info = self.state.files.get(self.path.lstrip('/'))
+            self.state.stats['polls'] += 1
+        if info is None:
+            self.send_json(404, {'error': 'file not found'})
+            return
+        active = time.monotonic() >= info['active_at']
+        self.send_json(200, self.file_payload(info, 'ACTIVE' if active else 'PROCESSING'))
+
+    def do_DELETE(self):
+        with self.state.lock:
+            removed = self.state.files.pop(self.path.lstrip('/'), None)
+            self.state.stats['deletes'] += 1
+        self.send_json(200 if removed else 404, {})
+
+    def file_payload(self, info: dict, state: str) -> dict:
+        return {'name': info['name'], 'uri': f"mock://{info['name']}", 'mime_type': info['mime_type'],
+                'display_name': info['display_name'], 'size_bytes': info['size'], 'state': state}
+
+    def handle_upload(self, body: bytes):
+        settings = self.state.settings
+        if settings.upload_mbps > 0:
+            time.sleep(len(body) / (settings.upload_mbps * 1e6 / 8))
+        if self.state.should_rate_limit(is_generate=False):
+            self.send_json(429, {'error': 'RESOURCE_EXHAUSTED (mock upload quota)'})
+            return
+        name = f"files/{uuid.uuid4().hex[:16]}"
+        info = {
+            'name': name,
+            'size': len(body),
+            'mime_type': self.headers.get('Content-Type', 'application/octet-stream'),
+            'display_name': self.headers.get('X-Display-Name', name),
+            'active_at': time.monotonic() + self.state.lognormal(settings.activation_median, settings.activation_sigma),
+        }
+        with self.state.lock:
+            self.state.files[name] = info
+            self.state.stats['uploads'] += 1
+        self.send_json(200, self.file_payload(info, 'PROCESSING'))
+
+    def handle_generate(self, body: bytes):
+        settings = self.state.settings
+        request = json.loads(body or b'{}')
+        with self.state.lock:
+            info = self.state.files.get(request.get('file', ''))
+        if info is None or time.monotonic() < info['active_at']:
+            self.send_json(400, {'error': 'FAILED_PRECONDITION: file is not ACTIVE'})
+            return
+        if self.state.should_rate_limit(is_generate=True):
+            self.send_json(429, {'error': 'RESOURCE_EXHAUSTED (mock generate quota)'})
+            return
+        time.sleep(self.state.lognormal(settings.generation_median, settings.generation_sigma))
+        with self.state.lock:
+            self.state.stats['generates'] += 1
+
+        text = f"{settings.caption_prefix} a mock caption of {info['display_name']} with gentle motion, soft light and a static camera.".strip()
+        prompt_tokens = len(request.get('prompt', '').split()) + 258
+        output_tokens = len(text.split())
+        self.send_json(200, {'text': text, 'usage': {
+            'prompt_token_count': prompt_tokens,
+            'candidates_token_count': output_tokens,
+            'total_token_count': prompt_tokens + output_tokens,
+        }})
+
+
+def start_server(host: str = '127.0.0.1', port: int = 0, settings: MockSettings | None = None) -> ThreadingHTTPServer:
+    """Start the mock server on a daemon thread. port=0 picks a free port (see server.server_address)."""
+    server = ThreadingHTTPServer((host, port), MockGeminiHandler)
+    server.daemon_threads = True
+    server.state = MockGeminiState(settings or MockSettings())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini files/generate API (for offline tests and benchmarks)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--upload_mbps', type=float, default=MockSettings.upload_mbps, help='Simulated upload bandwidth per request in Mbit/s (0 = unlimited)')
+    parser.add_argument('--activation_median', type=float, default=MockSettings.activation_median, help='Median seconds until a file becomes ACTIVE')
+    parser.add_argument('--activation_sigma', type=float, default=MockSettings.activation_sigma, help='Lognormal sigma of the activation delay')
+    parser.add_argument('--generation_median', type=float, default=MockSettings.generation_median, help='Median generate_content latency in seconds')
+    parser.add_argument('--generation_sigma', type=float, default=MockSettings.generation_sigma, help='Lognormal sigma of the generation latency')
+    parser.add_argument('--error_rate_429', type=float, default=0.0, help='Probability of a random 429 on each upload/generate')
+    parser.add_argument('--rpm_limit', type=int, default=0, help='Generate requests per minute before returning 429 (0 = unlimited)')
+    parser.add_argument('--caption_prefix', default='', help='Text every mock caption starts with (use the trigger word)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    settings = MockSettings(**{k: v for k, v in vars(args).items() if k not in ('host', 'port')})
+    server = start_server(args.host, args.port, settings)
+    print(f"🧪 Mock Gemini server on http://{args.host}:{server.server_address[1]} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"stats: {server.state.stats}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,25 @@
 import os
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
+import copy
+import time
+import queue
+import sqlite3
+import hashlib
+import argparse
+import threading
+import json
+import urllib.error
+import urllib.request
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from dataclasses import dataclass
 from typing import Optional
 
+try:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+except ImportError:
+    # Só o backend "transformers" precisa deles; o backend "openai" apenas conversa com um servidor
+    torch = None
+
 @dataclass
 class Config:
     # Diretórios de arquivos de texto
@@ -13,7 +29,7 @@ class Config:
     # Configuração do modelo
     MODEL_NAME: str = "Qwen/Qwen2.5-7B-Instruct"
     MAX_TOKENS: int = 200
-    BATCH_SIZE: int = 1  # Mantido para compatibilidade, mas o processamento é arquivo a arquivo
+    BATCH_SIZE: int = 16  # Máximo de arquivos por lote de geração (reduzido automaticamente em caso de OOM)
     
     # Configurações de quantização
     USE_QUANTIZATION: bool = True  # Ativa ou desativa a quantização
@@ -23,6 +39,16 @@ class Config:
     TEMPERATURE: float = 0.7
     TOP_P: float = 0.9
 
+    # Reutiliza o KV-cache do SYSTEM_PROMPT (calculado uma vez) em todas as gerações
+    USE_PREFIX_CACHE: bool = True
+
+    # Backend "openai": servidor compatível com a API OpenAI (llama.cpp server, vLLM, Ollama)
+    SERVER_URL: str = "http://127.0.0.1:8080/v1"
+    API_KEY: Optional[str] = None
+    CONCURRENCY: int = 8  # Requisições simultâneas; o batching contínuo do servidor faz o resto
+    REQUEST_TIMEOUT: float = 300
+    MAX_RETRIES: int = 3
+
 # Template do prompt do sistema
 SYSTEM_PROMPT = """You are an AI prompt engineer tasked with helping me modifying a list of automatically generated prompts.
 
@@ -37,8 +63,16 @@ Keep the original text but only do the following modifications:
 - mention the clothing details of the characters
 - use only declarative sentences"""
 
+def build_messages(text: str, max_tokens: int) -> list[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Could you enhance and refine the following text while maintaining its core meaning:\n\n{text}\n\nPlease limit the response to {max_tokens} tokens."}
+    ]
+
 class Qwen25Refiner:
     def __init__(self, config: Config):
+        if torch is None:
+            raise ImportError("The transformers backend needs torch and transformers: pip install torch transformers accelerate")
         self.config = config
         
         # Preparar parâmetros para carregamento do modelo
@@ -62,86 +96,463 @@ class Qwen25Refiner:
             **model_kwargs
         )
         self.tokenizer = AutoTokenizer.from_pretrained(config.MODEL_NAME)
+        # Padding à esquerda para que todas as sequências do lote terminem alinhadas antes da geração
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.batch_size = max(1, config.BATCH_SIZE)
 
-    def refine_text(self, text: str) -> str:
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": f"Could you enhance and refine the following text while maintaining its core meaning:\n\n{text}\n\nPlease limit the response to {self.config.MAX_TOKENS} tokens."}
-        ]
+        self.prefix_text = None
+        self.prefix_ids = None
+        self.prefix_cache = None
+        if config.USE_PREFIX_CACHE:
+            self.build_prefix_cache()
 
+    def build_prefix_cache(self):
+        """Pré-calcula o KV-cache do turno de sistema, que é idêntico em todos os prompts."""
+        prefix_text = self.tokenizer.apply_chat_template(
+            [{"role": "system", "content": SYSTEM_PROMPT}],
+            tokenize=False,
+            add_generation_prompt=False
+        )
+        sample_prompt = self.build_prompt("sample")
+        prefix_ids = self.tokenizer(prefix_text, return_tensors="pt", add_special_tokens=False).input_ids
+        sample_ids = self.tokenizer(sample_prompt, return_tensors="pt", add_special_tokens=False).input_ids
+        # Só é seguro se o prefixo também for um prefixo exato em tokens do prompt completo
+        if not sample_prompt.startswith(prefix_text) or \
+           sample_ids.shape[1] <= prefix_ids.shape[1] or \
+           not torch.equal(sample_ids[0, :prefix_ids.shape[1]], prefix_ids[0]):
+            print("System prompt prefix does not tokenize as a clean prefix; prefix cache disabled")
+            return
+
+        self.prefix_text = prefix_text
+        self.prefix_ids = prefix_ids.to(self.model.device)
+        with torch.inference_mode():
+            self.prefix_cache = self.model(self.prefix_ids, use_cache=True).past_key_values
+        # Sonda de compatibilidade feita uma única vez: versões do transformers que não aceitam um
+        # past_key_values pré-calculado no generate falham aqui com TypeError/ValueError
         try:
-            # Aplica o template do chat
-            prompt = self.tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )
+            with torch.inference_mode():
+                self.model.generate(**self.prepare_inputs([sample_prompt]), max_new_tokens=1, do_sample=False,
+                                    pad_token_id=self.tokenizer.pad_token_id)
+        except (TypeError, ValueError) as e:
+            print(f"Prefix cache not supported by this model/transformers version ({e}); prefix cache disabled")
+            self.prefix_text = self.prefix_ids = self.prefix_cache = None
+            return
+        print(f"Cached system prompt prefix ({self.prefix_ids.shape[1]} tokens)")
+
+    def expand_prefix_cache(self, batch_size: int):
+        cache = copy.deepcopy(self.prefix_cache)
+        if batch_size == 1:
+            return cache
+        if hasattr(cache, "batch_repeat_interleave"):
+            cache.batch_repeat_interleave(batch_size)
+            return cache
+        # Formato legado: tupla de (key, value) por camada
+        return tuple(tuple(t.repeat_interleave(batch_size, dim=0) for t in layer) for layer in cache)
 
-            # Prepara os inputs para o modelo
-            model_inputs = self.tokenizer([prompt], return_tensors="pt").to(self.model.device)
+    def build_prompt(self, text: str) -> str:
+        # Aplica o template do chat
+        return self.tokenizer.apply_chat_template(
+            build_messages(text, self.config.MAX_TOKENS),
+            tokenize=False,
+            add_generation_prompt=True
+        )
+
+    def prepare_inputs(self, prompts: list[str]) -> dict:
+        if self.prefix_cache is None:
+            # Prepara os inputs para o modelo (lote com padding à esquerda)
+            return dict(self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device))
+
+        # Só o texto após o turno de sistema é tokenizado; o padding fica entre o prefixo em cache e o sufixo,
+        # e a attention_mask o ignora (as posições são derivadas dela, então continuam contíguas)
+        suffixes = [prompt[len(self.prefix_text):] for prompt in prompts]
+        suffix_inputs = self.tokenizer(suffixes, return_tensors="pt", padding=True, add_special_tokens=False).to(self.model.device)
+        batch_size = len(prompts)
+        prefix_mask = torch.ones((batch_size, self.prefix_ids.shape[1]), dtype=suffix_inputs.attention_mask.dtype, device=self.model.device)
+        return {
+            "input_ids": torch.cat([self.prefix_ids.expand(batch_size, -1), suffix_inputs.input_ids], dim=1),
+            "attention_mask": torch.cat([prefix_mask, suffix_inputs.attention_mask], dim=1),
+            "past_key_values": self.expand_prefix_cache(batch_size),
+        }
+
+    def generate_batch(self, texts: list[str]) -> list[str]:
+        prompts = [self.build_prompt(text) for text in texts]
+        model_inputs = self.prepare_inputs(prompts)
 
-            # Gera a resposta
+        # Gera as respostas (erros vão para o tratamento de iter_refined)
+        with torch.inference_mode():
             generated_ids = self.model.generate(
                 **model_inputs,
                 max_new_tokens=self.config.MAX_TOKENS,
                 do_sample=True,
                 temperature=self.config.TEMPERATURE,
-                top_p=self.config.TOP_P
+                top_p=self.config.TOP_P,
+                pad_token_id=self.tokenizer.pad_token_id
             )
 
-            # Extrai a resposta gerada
-            generated_ids = [
-                output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-            ]
-            response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        # Todas as linhas do lote têm o mesmo comprimento de entrada, então a resposta começa no mesmo índice
+        prompt_length = model_inputs["input_ids"].shape[1]
+        responses = self.tokenizer.batch_decode(generated_ids[:, prompt_length:], skip_special_tokens=True)
+        return [response.strip() for response in responses]
+
+    def iter_refined(self, texts: list[str]):
+        """Refina os textos em lotes e produz (índice, texto refinado) assim que cada lote termina.
+
+        Os textos são ordenados por comprimento para minimizar padding. Em caso de falta de memória
+        o tamanho do lote é reduzido pela metade e o lote é repetido.
+        """
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        start = 0
+        while start < len(order):
+            chunk = order[start:start + self.batch_size]
+            try:
+                outputs = self.generate_batch([texts[i] for i in chunk])
+            except torch.cuda.OutOfMemoryError:
+                if self.batch_size == 1:
+                    print("Out of memory even with batch size 1, skipping text")
+                    torch.cuda.empty_cache()
+                    yield chunk[0], ""
+                    start += 1
+                    continue
+                self.batch_size = max(1, self.batch_size // 2)
+                torch.cuda.empty_cache()
+                print(f"Out of memory, reducing batch size to {self.batch_size}")
+                continue
+            except Exception as e:
+                print(f"Error refining batch: {str(e)}")
+                outputs = [""] * len(chunk)
+            yield from zip(chunk, outputs)
+            start += len(chunk)
+
+    def refine_batch(self, texts: list[str]) -> list[str]:
+        results = [""] * len(texts)
+        for i, output in self.iter_refined(texts):
+            results[i] = output
+        return results
 
-            return response.strip()
+    def refine_text(self, text: str) -> str:
+        return self.refine_batch([text])[0]
+
+class OpenAIServerRefiner:
+    """Mesmo contrato de Qwen25Refiner (batch_size + iter_refined), mas enviando cada texto como uma requisição
+    /chat/completions a um servidor local compatível com OpenAI (llama.cpp server, vLLM, Ollama).
+
+    Não há lotes do lado do cliente: até CONCURRENCY requisições ficam em voo e o batching contínuo do
+    servidor as agrupa. Serve para nós só com CPU rodando um GGUF quantizado.
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.url = config.SERVER_URL.rstrip("/") + "/chat/completions"
+        self.batch_size = max(1, config.CONCURRENCY)
+        self.pool = ThreadPoolExecutor(max_workers=self.batch_size)
+        print(f"Using OpenAI-compatible server {config.SERVER_URL} (model {config.MODEL_NAME}, {self.batch_size} concurrent requests)")
+
+    def request(self, text: str) -> str:
+        payload = {
+            "model": self.config.MODEL_NAME,
+            "messages": build_messages(text, self.config.MAX_TOKENS),
+            "max_tokens": self.config.MAX_TOKENS,
+            "temperature": self.config.TEMPERATURE,
+            "top_p": self.config.TOP_P,
+            "stream": False,
+        }
+        headers = {"Content-Type": "application/json"}
+        if self.config.API_KEY:
+            headers["Authorization"] = f"Bearer {self.config.API_KEY}"
+        req = urllib.request.Request(self.url, data=json.dumps(payload).encode("utf-8"), headers=headers, method="POST")
+        with urllib.request.urlopen(req, timeout=self.config.REQUEST_TIMEOUT) as resp:
+            response = json.loads(resp.read())
+        return (response["choices"][0]["message"]["content"] or "").strip()
+
+    def refine_with_retries(self, text: str) -> str:
+        for attempt in range(1, self.config.MAX_RETRIES + 1):
+            try:
+                return self.request(text)
+            except urllib.error.HTTPError as e:
+                detail = e.read().decode("utf-8", errors="replace")[:200]
+                error = f"HTTP {e.code}: {detail}"
+            except Exception as e:
+                error = str(e)
+            if attempt < self.config.MAX_RETRIES:
+                # Backoff exponencial: o servidor pode estar carregando o modelo ou com a fila cheia
+                time.sleep(2 ** attempt)
+        print(f"Error refining text after {self.config.MAX_RETRIES} attempts: {error}")
+        return ""
+
+    def iter_refined(self, texts: list[str]):
+        """Produz (índice, texto refinado) na ordem em que as respostas chegam."""
+        futures = {self.pool.submit(self.refine_with_retries, text): i for i, text in enumerate(texts)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def refine_batch(self, texts: list[str]) -> list[str]:
+        results = [""] * len(texts)
+        for i, output in self.iter_refined(texts):
+            results[i] = output
+        return results
+
+    def refine_text(self, text: str) -> str:
+        return self.refine_batch([text])[0]
+
+BACKENDS = {"transformers": Qwen25Refiner, "openai": OpenAIServerRefiner}
+
+class RefineManifest:
+    """Manifest SQLite do refinamento: um registro por arquivo de entrada com o hash do texto de origem.
+
+    Cada resultado é gravado na sua própria transação (WAL), então uma instância interrompida
+    perde no máximo os textos em andamento.
+    """
+
+    def __init__(self, path: str):
+        manifest_dir = os.path.dirname(path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        self.path = path
+        # Lido na thread principal, escrito apenas pela thread de escrita
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                file_name TEXT PRIMARY KEY,
+                source_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                model TEXT,
+                error TEXT,
+                updated_at REAL
+            )
+        """)
+        self.conn.commit()
 
+    def done_hashes(self, model: str) -> dict[str, str]:
+        """file_name -> source_hash dos itens concluídos pelo mesmo modelo/backend/prompt (ver refine_id)."""
+        return dict(self.conn.execute("SELECT file_name, source_hash FROM items WHERE status = 'done' AND model = ?",
+                                      (model,)))
+
+    def record(self, file_name: str, source_hash: str, status: str, model: str, error: Optional[str] = None):
+        self.conn.execute("""
+            INSERT INTO items (file_name, source_hash, status, attempts, model, error, updated_at)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT(file_name) DO UPDATE SET
+                source_hash = excluded.source_hash,
+                status = excluded.status,
+                attempts = items.attempts + 1,
+                model = excluded.model,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+        """, (file_name, source_hash, status, model, error, time.time()))
+        self.conn.commit()
+
+    def summary(self) -> dict[str, int]:
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM items GROUP BY status'))
+
+    def close(self):
+        self.conn.close()
+
+def source_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def refine_id(backend: str, config: Config) -> str:
+    """Identifica o que produziu uma saída (backend, modelo, prompt e limite de tokens); gravado na coluna model.
+
+    Trocar qualquer um deles faz a retomada refazer os textos em vez de manter a saída do modelo anterior.
+    """
+    template = json.dumps(build_messages("{text}", config.MAX_TOKENS), sort_keys=True)
+    prompt_hash = hashlib.blake2b(template.encode("utf-8"), digest_size=4).hexdigest()
+    return f"{backend}:{config.MODEL_NAME}:{prompt_hash}"
+
+def write_atomic(path: str, text: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+def reader_stage(input_dir: str, output_dir: str, done_hashes: dict[str, str], read_queue: queue.Queue, stats: dict):
+    """Estágio 1: lista e lê os .txt, pulando os que já têm saída refinada do mesmo texto de origem."""
+    try:
+        with os.scandir(input_dir) as entries:
+            filenames = sorted(entry.name for entry in entries if entry.is_file() and entry.name.endswith('.txt'))
+        stats["found"] = len(filenames)
+        for filename in filenames:
+            try:
+                with open(os.path.join(input_dir, filename), "rb") as file:
+                    data = file.read()
+                input_text = data.decode("utf-8").strip()
+            except Exception as e:
+                print(f"Error reading file {filename}: {str(e)}")
+                stats["read_errors"] += 1
+                continue
+            if not input_text:
+                print(f"Skipping file {filename}: empty content")
+                stats["empty"] += 1
+                continue
+            digest = source_hash(data)
+            if done_hashes.get(filename) == digest and os.path.exists(os.path.join(output_dir, filename)):
+                stats["skipped"] += 1
+                continue
+            read_queue.put((filename, input_text, digest))
+    finally:
+        read_queue.put(None)
+
+def writer_stage(output_dir: str, manifest: RefineManifest, model_id: str, write_queue: queue.Queue, stats: dict):
+    """Estágio 3: grava cada saída de forma atômica e registra o progresso no manifest."""
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        filename, digest, refined_text = item
+        output_path = os.path.join(output_dir, filename)
+        if not refined_text:
+            # Saída vazia é tratada como falha e será refeita na próxima execução
+            manifest.record(filename, digest, "error", model_id, "empty output")
+            stats["errors"] += 1
+            continue
+        try:
+            write_atomic(output_path, refined_text)
         except Exception as e:
-            print(f"Error refining text: {str(e)}")
-            return ""
+            print(f"Error processing file {filename}: {str(e)}")
+            manifest.record(filename, digest, "error", model_id, str(e))
+            stats["errors"] += 1
+            continue
+        manifest.record(filename, digest, "done", model_id)
+        stats["written"] += 1
+        print(f"[{stats['written'] + stats['errors']}] Refined text saved to {output_path}")
+
+def refine_stage(refiner, read_queue: queue.Queue, write_queue: queue.Queue, window_size: int):
+    """Estágio 2 (transformers): agrupa até window_size textos lidos e os refina em lotes ordenados por comprimento."""
+    finished = False
+    while not finished:
+        window = []
+        item = read_queue.get()
+        while item is not None:
+            window.append(item)
+            if len(window) >= window_size:
+                break
+            try:
+                item = read_queue.get(timeout=0.05)
+            except queue.Empty:
+                break
+        if item is None:
+            finished = True
+        if not window:
+            continue
+        for idx, refined_text in refiner.iter_refined([text for _, text, _ in window]):
+            filename, _, digest = window[idx]
+            write_queue.put((filename, digest, refined_text))
+
+def server_refine_stage(refiner, read_queue: queue.Queue, write_queue: queue.Queue, poll_interval: float = 0.05):
+    """Estágio 2 do backend openai: mantém até batch_size (CONCURRENCY) requisições sempre em voo.
+
+    Sem janelas: cada resposta vai direto para a fila de escrita e libera a vaga para o próximo texto lido,
+    então o batching contínuo do servidor nunca fica esperando o fim de um lote do cliente.
+    """
+    in_flight = {}
+    finished = False
+    while in_flight or not finished:
+        while not finished and len(in_flight) < refiner.batch_size:
+            if in_flight:
+                try:
+                    item = read_queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                item = read_queue.get()
+            if item is None:
+                finished = True
+                break
+            filename, text, digest = item
+            in_flight[refiner.pool.submit(refiner.refine_with_retries, text)] = (filename, digest)
+        if not in_flight:
+            continue
+        # Com vagas livres e o leitor ainda ativo, acorda periodicamente para enviar os textos que chegarem
+        waiting_for_reader = not finished and len(in_flight) < refiner.batch_size
+        done, _ = wait(in_flight, timeout=poll_interval if waiting_for_reader else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            filename, digest = in_flight.pop(future)
+            write_queue.put((filename, digest, future.result()))
+
+def parse_args() -> argparse.Namespace:
+    defaults = Config()
+    parser = argparse.ArgumentParser(description="Refine .txt captions with Qwen2.5 (resumable streaming pipeline)")
+    parser.add_argument("--input_dir", default=defaults.INPUT_DIR, help="Folder with the .txt captions to refine")
+    parser.add_argument("--output_dir", default=defaults.OUTPUT_DIR, help="Folder where refined .txt files are written")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="transformers",
+                        help="transformers: load the model in-process; openai: send requests to an OpenAI-compatible server")
+    parser.add_argument("--model_name", default=defaults.MODEL_NAME, help="HF model id, or the model name the server expects")
+    parser.add_argument("--max_tokens", type=int, default=defaults.MAX_TOKENS)
+    parser.add_argument("--batch_size", type=int, default=defaults.BATCH_SIZE, help="Max texts per generate call (halved automatically on OOM)")
+    parser.add_argument("--quantization", type=int, choices=[0, 4, 8], default=defaults.QUANTIZATION_BITS, help="bitsandbytes 4/8-bit loading, 0 disables")
+    parser.add_argument("--temperature", type=float, default=defaults.TEMPERATURE)
+    parser.add_argument("--top_p", type=float, default=defaults.TOP_P)
+    parser.add_argument("--no_prefix_cache", action="store_true", help="Do not reuse the system prompt KV cache")
+    parser.add_argument("--server_url", default=defaults.SERVER_URL, help="Base URL of the OpenAI-compatible API (llama.cpp: :8080/v1, vLLM: :8000/v1, Ollama: :11434/v1)")
+    parser.add_argument("--api_key", default=os.environ.get("OPENAI_API_KEY"), help="Bearer token for the server, if it needs one")
+    parser.add_argument("--concurrency", type=int, default=defaults.CONCURRENCY, help="Concurrent requests with --backend openai")
+    parser.add_argument("--request_timeout", type=float, default=defaults.REQUEST_TIMEOUT)
+    parser.add_argument("--manifest", default=None, help="Progress manifest (default: <output_dir>/refine_manifest.sqlite)")
+    parser.add_argument("--no_resume", action="store_true", help="Refine every file again, even if its output is up to date")
+    parser.add_argument("--window", type=int, default=4, help="Batches read ahead and sorted by length together")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+
     # Inicializa a configuração
     config = Config(
-        USE_QUANTIZATION=True,  # Ativa ou desativa a quantização
-        QUANTIZATION_BITS=8     # Escolha entre 4 ou 8 bits
+        INPUT_DIR=args.input_dir,
+        OUTPUT_DIR=args.output_dir,
+        MODEL_NAME=args.model_name,
+        MAX_TOKENS=args.max_tokens,
+        BATCH_SIZE=args.batch_size,
+        USE_QUANTIZATION=args.quantization != 0,  # Ativa ou desativa a quantização
+        QUANTIZATION_BITS=args.quantization or 8,  # Escolha entre 4 ou 8 bits
+        TEMPERATURE=args.temperature,
+        TOP_P=args.top_p,
+        USE_PREFIX_CACHE=not args.no_prefix_cache,
+        SERVER_URL=args.server_url,
+        API_KEY=args.api_key,
+        CONCURRENCY=args.concurrency,
+        REQUEST_TIMEOUT=args.request_timeout
     )
     
-    # Inicializa o modelo
-    refiner = Qwen25Refiner(config)
-    
     # Garante que o diretório de saída existe
     os.makedirs(config.OUTPUT_DIR, exist_ok=True)
-    
-    # Lista os arquivos .txt no diretório de entrada
-    txt_files = [f for f in os.listdir(config.INPUT_DIR) if f.endswith('.txt')]
-    total_files = len(txt_files)
-    print(f"Found {total_files} .txt files to process.")
-    
-    for idx, filename in enumerate(txt_files):
-        input_path = os.path.join(config.INPUT_DIR, filename)
-        output_path = os.path.join(config.OUTPUT_DIR, filename)
-        try:
-            with open(input_path, "r", encoding="utf-8") as file:
-                input_text = file.read().strip()
-            
-            if not input_text:
-                print(f"Skipping file {filename}: empty content")
-                continue
-            
-            print(f"\nProcessing file {idx+1}/{total_files}: {filename}...")
-            refined_text = refiner.refine_text(input_text)
-            
-            with open(output_path, "w", encoding="utf-8") as file:
-                file.write(refined_text)
-                
-            print(f"Refined text saved to {output_path}")
-            
-        except Exception as e:
-            print(f"Error processing file {filename}: {str(e)}")
-    
-    print("\nProcessing complete!")
+    manifest = RefineManifest(args.manifest or os.path.join(config.OUTPUT_DIR, "refine_manifest.sqlite"))
+    model_id = refine_id(args.backend, config)
+    done_hashes = {} if args.no_resume else manifest.done_hashes(model_id)
+    if done_hashes:
+        print(f"Resuming: {len(done_hashes)} files already refined according to {manifest.path}")
+
+    # Inicializa o modelo (ou o cliente do servidor)
+    refiner = BACKENDS[args.backend](config)
+
+    # Leitura -> refinamento -> escrita, ligados por filas limitadas
+    stats = {"found": 0, "skipped": 0, "empty": 0, "read_errors": 0, "written": 0, "errors": 0}
+    window_size = refiner.batch_size * max(1, args.window)
+    read_queue = queue.Queue(maxsize=window_size * 2)
+    write_queue = queue.Queue(maxsize=window_size * 2)
+    reader = threading.Thread(target=reader_stage, args=(config.INPUT_DIR, config.OUTPUT_DIR, done_hashes, read_queue, stats), daemon=True)
+    writer = threading.Thread(target=writer_stage, args=(config.OUTPUT_DIR, manifest, model_id, write_queue, stats), daemon=True)
+    reader.start()
+    writer.start()
+
+    print(f"Refining texts from {config.INPUT_DIR} in batches of up to {refiner.batch_size}...")
+    try:
+        if isinstance(refiner, OpenAIServerRefiner):
+            server_refine_stage(refiner, read_queue, write_queue)
+        else:
+            refine_stage(refiner, read_queue, write_queue, window_size)
+    finally:
+        write_queue.put(None)
+        writer.join()
+        manifest.close()
+
+    print(f"\nProcessing complete! {stats['found']} .txt files found, {stats['skipped']} already up to date, "
+          f"{stats['written']} refined, {stats['errors']} failed, {stats['empty'] + stats['read_errors']} unreadable or empty. "
+          f"Refined texts saved to {config.OUTPUT_DIR}")
 
 if __name__ == "__main__":
     main()
@@ -1,21 +1,16 @@
 import argparse
-from safetensors.torch import load_file, save_file
+from safetensors_io import RenameRules, rename_safetensors
 
-def remove_prefix_from_keys(input_path, output_path, prefixes):
+def remove_prefix_from_keys(input_path, output_path, prefixes, regex_map=None):
     print(f"🔍 Loading: {input_path}")
-    state_dict = load_file(input_path)
+    rules = RenameRules(strip_prefixes=prefixes, regex_map=regex_map or [])
 
-    new_state_dict = {}
-    for k, v in state_dict.items():
-        new_key = k
-        for prefix in prefixes:
-            if new_key.startswith(prefix):
-                new_key = new_key[len(prefix):]
-                break
-        new_state_dict[new_key] = v
-
-    print(f"🧼 Prefixes removed. Saving as: {output_path}")
-    save_file(new_state_dict, output_path)
+    # Only the header is rewritten; tensor data is copied as-is by the kernel
+    print(f"🧼 Removing prefixes. Saving as: {output_path}")
+    stats = rename_safetensors(input_path, output_path, rules)
+    changed = sum(1 for old, new in stats["renamed"].items() if old != new)
+    print(f"🔑 {changed} of {len(stats['renamed'])} keys renamed, "
+          f"{stats['data_bytes'] / 1024**2:.1f} MB copied via {', '.join(stats['copy_methods']) or 'nothing'}")
     print("✅ Done.")
 
 if __name__ == "__main__":
@@ -24,6 +19,8 @@ if __name__ == "__main__":
     parser.add_argument("--output", type=str, required=True, help="Path to save output .safetensors file")
     parser.add_argument("--prefixes", nargs="+", default=["model.diffusion_model.", "diffusion_model."],
                         help="List of prefixes to remove from keys (default: model.diffusion_model., diffusion_model.)")
+    parser.add_argument("--regex", nargs=2, action="append", metavar=("PATTERN", "REPLACEMENT"), default=[],
+                        help="Extra re.sub rename applied after prefix removal (can be repeated)")
 
     args = parser.parse_args()
-    remove_prefix_from_keys(args.input, args.output, args.prefixes)
+    remove_prefix_from_keys(args.input, args.output, args.prefixes, args.regex)
@@ -0,0 +1,579 @@
+import json
+import mmap
+import os
+import re
+import struct
+import warnings
+from dataclasses import dataclass, field
+
+# Bytes per element of every dtype the safetensors format defines
+DTYPE_SIZES = {
+    'BOOL': 1, 'U8': 1, 'I8': 1, 'F8_E4M3': 1, 'F8_E5M2': 1,
+    'U16': 2, 'I16': 2, 'F16': 2, 'BF16': 2,
+    'U32': 4, 'I32': 4, 'F32': 4,
+    'U64': 8, 'I64': 8, 'F64': 8,
+}
+
+# Same names torch prints, so tools that used to report str(tensor.dtype) keep their output
+TORCH_DTYPE_NAMES = {
+    'BOOL': 'torch.bool', 'U8': 'torch.uint8', 'I8': 'torch.int8',
+    'F8_E4M3': 'torch.float8_e4m3fn', 'F8_E5M2': 'torch.float8_e5m2',
+    'U16': 'torch.uint16', 'I16': 'torch.int16', 'F16': 'torch.float16', 'BF16': 'torch.bfloat16',
+    'U32': 'torch.uint32', 'I32': 'torch.int32', 'F32': 'torch.float32',
+    'U64': 'torch.uint64', 'I64': 'torch.int64', 'F64': 'torch.float64',
+}
+
+MAX_HEADER_SIZE = 100 * 1024 * 1024
+HEADER_ALIGNMENT = 8
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class TensorInfo:
+    """One header entry. start/end are absolute file offsets of the tensor bytes."""
+    name: str
+    dtype: str
+    shape: tuple
+    start: int
+    end: int
+
+    @property
+    def numel(self) -> int:
+        n = 1
+        for dim in self.shape:
+            n *= dim
+        return n
+
+    @property
+    def nbytes(self) -> int:
+        return self.end - self.start
+
+    @property
+    def torch_dtype_name(self) -> str:
+        return TORCH_DTYPE_NAMES.get(self.dtype, self.dtype)
+
+
+def read_header(path: str) -> tuple[dict[str, TensorInfo], dict[str, str], int]:
+    """Parse only the JSON header of a .safetensors file.
+
+    Returns (tensors by name in file order, __metadata__, offset where the data section starts).
+    Costs one small read regardless of the checkpoint size.
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+        if len(prefix) != 8:
+            raise ValueError(f"{path}: file too small to be safetensors")
+        header_size = struct.unpack('<Q', prefix)[0]
+        if header_size > MAX_HEADER_SIZE:
+            raise ValueError(f"{path}: header size {header_size} is not plausible, not a safetensors file?")
+        raw = f.read(header_size)
+    if len(raw) != header_size:
+        raise ValueError(f"{path}: truncated header")
+
+    header = json.loads(raw)
+    metadata = header.pop('__metadata__', None) or {}
+    data_start = 8 + header_size
+    entries = sorted(header.items(), key=lambda item: item[1]['data_offsets'][0])
+    tensors = {}
+    for name, entry in entries:
+        begin, end = entry['data_offsets']
+        tensors[name] = TensorInfo(name, entry['dtype'], tuple(entry['shape']), data_start + begin, data_start + end)
+    return tensors, metadata, data_start
+
+
+class LazySafetensors:
+    """Read-only view of a .safetensors file that never loads more than one tensor at a time.
+
+    Key names, shapes, dtypes and sizes come from the header alone; tensors are materialized on
+    demand through safetensors' safe_open (memory-mapped), so inspecting a 30GB checkpoint costs
+    a few MB and milliseconds.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tensors, self.metadata, self.data_start = read_header(path)
+        self.file_size = os.path.getsize(path)
+        self._handles = {}
+        self._file = None
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.tensors)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.tensors
+
+    def __iter__(self):
+        return iter(self.tensors)
+
+    def keys(self):
+        return self.tensors.keys()
+
+    def info(self, key: str) -> TensorInfo:
+        return self.tensors[key]
+
+    def infos(self):
+        return self.tensors.values()
+
+    def total_params(self) -> int:
+        return sum(info.numel for info in self.tensors.values())
+
+    def get_tensor(self, key: str, device: str = 'cpu'):
+        # One safe_open handle per device, so a CUDA read after a CPU read does not get the CPU handle
+        device = str(device)
+        handle = self._handles.get(device)
+        if handle is None:
+            from safetensors import safe_open
+            handle = self._handles[device] = safe_open(self.path, framework='pt', device=device)
+        return handle.get_tensor(key)
+
+    def iter_tensors(self, keys=None, device: str = 'cpu'):
+        """Yield (key, tensor) one at a time, in file order unless keys is given."""
+        for key in (self.tensors if keys is None else keys):
+            yield key, self.get_tensor(key, device)
+
+    def raw_bytes(self, key: str) -> memoryview:
+        """Zero-copy view of a tensor's bytes in the memory-mapped file. Pages are read by the OS on access."""
+        if self._mmap is None:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        info = self.tensors[key]
+        return memoryview(self._mmap)[info.start:info.end]
+
+    def release(self, start: int, end: int):
+        """Drop already-consumed mmap pages from this process (they stay in the page cache), keeping RSS flat."""
+        if self._mmap is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        aligned = start - start % mmap.PAGESIZE
+        if end > aligned:
+            self._mmap.madvise(mmap.MADV_DONTNEED, aligned, end - aligned)
+
+    def iter_chunks(self, key: str, chunk_elems: int = 16 * 1024 * 1024):
+        """Yield the flattened tensor as float32 CPU tensors of at most chunk_elems elements.
+
+        Only one chunk is resident at a time (consumed mmap pages are released as it goes), so memory
+        stays bounded no matter how large the tensor is.
+        """
+        import torch
+        info = self.tensors[key]
+        dtype = torch_dtype(info.dtype)
+        item_size = DTYPE_SIZES[info.dtype]
+        view = self.raw_bytes(key)
+        for start in range(0, info.numel, chunk_elems):
+            count = min(chunk_elems, info.numel - start)
+            with warnings.catch_warnings():
+                # The mmap is read-only; the chunk is copied by .float() before anyone could write to it
+                warnings.simplefilter('ignore', UserWarning)
+                chunk = torch.frombuffer(view, dtype=dtype, count=count, offset=start * item_size)
+            chunk = chunk.float() if chunk.dtype != torch.float32 else chunk.clone()
+            self.release(info.start + start * item_size, info.start + (start + count) * item_size)
+            yield chunk
+
+    def close(self):
+        self._handles = {}
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A caller still holds a view; the mapping is released with it
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def torch_dtype(name: str):
+    """torch dtype for a safetensors dtype string."""
+    import torch
+    return getattr(torch, TORCH_DTYPE_NAMES[name].split('.', 1)[1])
+
+
+def dtype_name(tensor) -> str:
+    """safetensors dtype string of a torch tensor."""
+    name = str(tensor.dtype)
+    for st_name, torch_name in TORCH_DTYPE_NAMES.items():
+        if torch_name == name:
+            return st_name
+    raise ValueError(f"dtype {name} is not supported by safetensors")
+
+
+def tensor_bytes(tensor) -> memoryview:
+    """Raw little-endian bytes of a CPU tensor without an intermediate copy when it is already contiguous."""
+    import torch
+    flat = tensor.detach().to('cpu').contiguous().reshape(-1)
+    if flat.dtype != torch.uint8:
+        flat = flat.view(torch.uint8)
+    return memoryview(flat.numpy()).cast('B')
+
+
+def encode_header(header: dict) -> bytes:
+    """Length prefix + JSON header, space-padded so the data section starts 8-byte aligned."""
+    raw = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    raw += b' ' * (-(8 + len(raw)) % HEADER_ALIGNMENT)
+    return struct.pack('<Q', len(raw)) + raw
+
+
+class SafetensorsWriter:
+    """Writes a .safetensors file one tensor at a time.
+
+    The header is computed up front from (name, dtype, shape) entries, so the tensors never have to
+    be held together in memory. Tensors must be written in the order of the entries. Output goes to
+    a temporary file that only replaces `path` once every tensor has been written.
+    """
+
+    def __init__(self, path: str, entries, metadata: dict | None = None):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.layout = []
+        header = {}
+        if metadata:
+            header['__metadata__'] = {str(k): str(v) for k, v in metadata.items()}
+        offset = 0
+        for name, dtype, shape in entries:
+            if name in header:
+                raise ValueError(f"Duplicate tensor name '{name}'")
+            if dtype not in DTYPE_SIZES:
+                raise ValueError(f"Unknown safetensors dtype '{dtype}' for '{name}'")
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            size = numel * DTYPE_SIZES[dtype]
+            header[name] = {'dtype': dtype, 'shape': list(shape), 'data_offsets': [offset, offset + size]}
+            self.layout.append((name, size))
+            offset += size
+        self.data_size = offset
+
+        encoded = encode_header(header)
+        out_dir = os.path.dirname(path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        self.f = open(self.tmp_path, 'wb')
+        self.f.write(encoded)
+        self.data_start = len(encoded)
+        self.index = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _next(self, name: str) -> int:
+        if self.index >= len(self.layout):
+            raise ValueError(f"'{name}' was not declared in the writer entries")
+        expected, size = self.layout[self.index]
+        if name != expected:
+            raise ValueError(f"Tensors must be written in header order: expected '{expected}', got '{name}'")
+        self.index += 1
+        return size
+
+    def write_bytes(self, name: str, data):
+        size = self._next(name)
+        if len(data) != size:
+            raise ValueError(f"'{name}': got {len(data)} bytes, header says {size}")
+        self.f.write(data)
+
+    def write_tensor(self, name: str, tensor):
+        self.write_bytes(name, tensor_bytes(tensor))
+
+    def write_chunks(self, name: str, chunks):
+        """Write one tensor from consecutive pieces (tensors or bytes), so it never has to exist whole in memory."""
+        size = self._next(name)
+        written = 0
+        for chunk in chunks:
+            data = chunk if isinstance(chunk, (bytes, bytearray, memoryview)) else tensor_bytes(chunk)
+            written += len(data)
+            if written > size:
+                raise ValueError(f"'{name}': chunks exceed the {size} bytes declared in the header")
+            self.f.write(data)
+        if written != size:
+            raise ValueError(f"'{name}': got {written} bytes, header says {size}")
+
+    def copy_tensor(self, name: str, source: LazySafetensors, key: str):
+        """Copy a tensor's bytes straight from a source file's mmap, in blocks, without going through torch."""
+        info = source.info(key)
+        size = self._next(name)
+        if info.nbytes != size:
+            raise ValueError(f"'{name}': source '{key}' has {info.nbytes} bytes, header says {size}")
+        view = source.raw_bytes(key)
+        try:
+            for offset in range(0, size, COPY_BLOCK_SIZE):
+                end = min(offset + COPY_BLOCK_SIZE, size)
+                self.f.write(view[offset:end])
+                source.release(info.start + offset, info.start + end)
+        finally:
+            view.release()
+
+    def close(self):
+        if self.f is None:
+            return
+        if self.index != len(self.layout):
+            missing = self.layout[self.index][0]
+            self.abort()
+            raise ValueError(f"Writer closed before all tensors were written (next: '{missing}')")
+        self.f.close()
+        self.f = None
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_from_sources(path: str, plan, metadata: dict | None = None) -> int:
+    """Write a new .safetensors file whose tensors are byte copies of tensors in other files.
+
+    plan is a list of (output_name, LazySafetensors, source_key). The header is computed from the
+    source headers alone and every tensor is copied block by block from the mmapped inputs, so peak
+    memory is a copy block, not the model size. Returns the number of data bytes written.
+    """
+    entries = []
+    for name, source, key in plan:
+        info = source.info(key)
+        entries.append((name, info.dtype, info.shape))
+    with SafetensorsWriter(path, entries, metadata) as writer:
+        for name, source, key in plan:
+            writer.copy_tensor(name, source, key)
+        return writer.data_size
+
+
+def copy_range(src_fd: int, dst_fd: int, src_offset: int, dst_offset: int, count: int) -> str:
+    """Copy count bytes between file descriptors without passing them through Python.
+
+    Tries copy_file_range (in-kernel, reflinks on btrfs/xfs), then sendfile, then a large-buffer
+    pread/pwrite loop. Returns the method that was used.
+    """
+    if count <= 0:
+        return 'none'
+    if hasattr(os, 'copy_file_range'):
+        try:
+            done = 0
+            while done < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - done, src_offset + done, dst_offset + done)
+                if n == 0:
+                    raise OSError(f"copy_file_range stopped after {done} of {count} bytes")
+                done += n
+            return 'copy_file_range'
+        except OSError:
+            # EXDEV on old kernels across filesystems, ENOSYS/EINVAL on unsupported ones: fall through
+            if done:
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+            done = 0
+            while done < count:
+                n = os.sendfile(dst_fd, src_fd, src_offset + done, count - done)
+                if n == 0:
+                    raise OSError(f"sendfile stopped after {done} of {count} bytes")
+                done += n
+            return 'sendfile'
+        except OSError:
+            if done:
+                raise
+    buffer = bytearray(min(COPY_BLOCK_SIZE, count))
+    done = 0
+    while done < count:
+        n = os.preadv(src_fd, [memoryview(buffer)[:min(len(buffer), count - done)]], src_offset + done)
+        if n == 0:
+            raise OSError(f"Unexpected end of file after {done} of {count} bytes")
+        os.pwrite(dst_fd, memoryview(buffer)[:n], dst_offset + done)
+        done += n
+    return 'buffered'
+
+
+@dataclass
+class RenameRules:
+    """Key rewriting for rename_safetensors.
+
+    strip_prefixes: the first matching prefix is removed.
+    regex_map: (pattern, replacement) pairs applied in order with re.sub.
+    drop_unmatched: drop keys that no prefix or pattern matched.
+    scalars: (pattern, replacement, value) triples; for every output key matching pattern a scalar
+        F32 tensor named re.sub(pattern, replacement, key) is added (e.g. an alpha per lora_A).
+    """
+    strip_prefixes: list = field(default_factory=list)
+    regex_map: list = field(default_factory=list)
+    drop_unmatched: bool = False
+    scalars: list = field(default_factory=list)
+
+    def __post_init__(self):
+        self.regex_map = [(re.compile(p) if isinstance(p, str) else p, r) for p, r in self.regex_map]
+        self.scalars = [(re.compile(p) if isinstance(p, str) else p, r, v) for p, r, v in self.scalars]
+
+    def apply(self, key: str) -> str | None:
+        new_key = key
+        matched = False
+        for prefix in self.strip_prefixes:
+            if new_key.startswith(prefix):
+                new_key = new_key[len(prefix):]
+                matched = True
+                break
+        for pattern, replacement in self.regex_map:
+            new_key, n = pattern.subn(replacement, new_key)
+            matched = matched or n > 0
+        if self.drop_unmatched and not matched:
+            return None
+        return new_key
+
+    def injected(self, keys) -> dict[str, float]:
+        extra = {}
+        for key in keys:
+            for pattern, replacement, value in self.scalars:
+                if pattern.search(key):
+                    extra.setdefault(pattern.sub(replacement, key), value)
+        return extra
+
+
+def rename_safetensors(input_path: str, output_path: str, rules: RenameRules, metadata: dict | None = None) -> dict:
+    """Rename tensors by rewriting only the JSON header; tensor bytes are copied kernel-side.
+
+    Offsets are recomputed for the kept tensors, adjacent kept tensors are copied as one range, and
+    injected scalars are appended after the data section. CPU and memory use do not depend on the
+    file size. metadata=None keeps the input's __metadata__.
+    """
+    source = LazySafetensors(input_path)
+    renamed = {}
+    new_keys = set()
+    dropped = []
+    for key in source.keys():
+        new_key = rules.apply(key)
+        if new_key is None:
+            dropped.append(key)
+            continue
+        if new_key in new_keys:
+            raise ValueError(f"Rename produces duplicate key '{new_key}' (from '{key}')")
+        renamed[key] = new_key
+        new_keys.add(new_key)
+    injected = {k: v for k, v in rules.injected(renamed.values()).items() if k not in new_keys}
+
+    header = {}
+    meta = source.metadata if metadata is None else metadata
+    if meta:
+        header['__metadata__'] = {str(k): str(v) for k, v in meta.items()}
+    ranges = []
+    offset = 0
+    for key, new_key in renamed.items():
+        info = source.info(key)
+        header[new_key] = {'dtype': info.dtype, 'shape': list(info.shape), 'data_offsets': [offset, offset + info.nbytes]}
+        if ranges and ranges[-1][0] + ranges[-1][1] == info.start:
+            ranges[-1][1] += info.nbytes
+        else:
+            ranges.append([info.start, info.nbytes])
+        offset += info.nbytes
+    scalar_bytes = b''
+    for name, value in injected.items():
+        header[name] = {'dtype': 'F32', 'shape': [], 'data_offsets': [offset, offset + 4]}
+        scalar_bytes += struct.pack('<f', value)
+        offset += 4
+
+    encoded = encode_header(header)
+    out_dir = os.path.dirname(output_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    tmp_path = output_path + '.tmp'
+    methods = set()
+    try:
+        with open(input_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            dst.write(encoded)
+            dst.flush()
+            position = len(encoded)
+            for start, length in ranges:
+                methods.add(copy_range(src.fileno(), dst.fileno(), start, position, length))
+                position += length
+            os.pwrite(dst.fileno(), scalar_bytes, position)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {
+        'renamed': renamed,
+        'dropped': dropped,
+        'injected': injected,
+        'ranges': len(ranges),
+        'data_bytes': offset,
+        'copy_methods': sorted(methods - {'none'}),
+    }
+
+
+class SpoolingSafetensorsWriter:
+    """Writes a .safetensors file whose tensors are not known up front (names, count or shapes).
+
+    Each tensor's bytes are appended to a spool file as soon as it is produced, so only one tensor is
+    in memory at a time; close() writes the header and copies the spooled data behind it kernel-side.
+    """
+
+    def __init__(self, path: str, metadata: dict | None = None):
+        self.path = path
+        self.metadata = metadata
+        self.tmp_path = path + '.tmp'
+        self.spool_path = path + '.spool'
+        out_dir = os.path.dirname(path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        self.spool = open(self.spool_path, 'wb')
+        self.header = {}
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __len__(self) -> int:
+        return len(self.header)
+
+    def write_tensor(self, name: str, tensor):
+        if name in self.header:
+            raise ValueError(f"Duplicate tensor name '{name}'")
+        data = tensor_bytes(tensor)
+        self.spool.write(data)
+        self.header[name] = {'dtype': dtype_name(tensor), 'shape': list(tensor.shape),
+                             'data_offsets': [self.offset, self.offset + len(data)]}
+        self.offset += len(data)
+
+    def close(self):
+        if self.spool is None:
+            return
+        self.spool.close()
+        self.spool = None
+        header = dict(self.header)
+        if self.metadata:
+            header['__metadata__'] = {str(k): str(v) for k, v in self.metadata.items()}
+        encoded = encode_header(header)
+        try:
+            with open(self.spool_path, 'rb') as src, open(self.tmp_path, 'wb') as dst:
+                dst.write(encoded)
+                dst.flush()
+                copy_range(src.fileno(), dst.fileno(), 0, len(encoded), self.offset)
+            os.replace(self.tmp_path, self.path)
+        finally:
+            for leftover in (self.spool_path, self.tmp_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def abort(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        for leftover in (self.spool_path, self.tmp_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
@@ -0,0 +1,40 @@
+import time
+
+from caption_manifest import STATUS_DONE, STATUS_ERROR, CaptionManifest, export_captions
+
+
+def read_rows(csv_path):
+    with open(csv_path, encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def test_resumed_runs_do_not_duplicate_csv_rows(tmp_path):
+    csv_path = str(tmp_path / 'captions.csv')
+    manifest = CaptionManifest(str(tmp_path / 'captions_manifest.sqlite'))
+
+    # First run: two done, one error
+    manifest.record('a.png', 'a', STATUS_DONE, caption='cap a')
+    manifest.record('b.png', 'b', STATUS_DONE, caption='cap b')
+    manifest.record('c.png', 'c', STATUS_ERROR, error='boom')
+    assert export_captions(manifest, csv_path, str) == 2
+
+    # Resumed run: the errored item succeeds; the export is rebuilt, not appended
+    manifest.record('c.png', 'c', STATUS_DONE, caption='cap c')
+    assert export_captions(manifest, csv_path, str) == 3
+    assert read_rows(csv_path) == ['file_name|caption', 'a|cap a', 'b|cap b', 'c|cap c']
+    manifest.close()
+
+
+def test_append_only_exports_current_run(tmp_path):
+    csv_path = str(tmp_path / 'captions.csv')
+    manifest = CaptionManifest(str(tmp_path / 'captions_manifest.sqlite'))
+
+    first_run = time.time()
+    manifest.record('a.png', 'a', STATUS_DONE, caption='cap a')
+    assert export_captions(manifest, csv_path, str, append_since=first_run) == 1
+
+    second_run = time.time()
+    manifest.record('b.png', 'b', STATUS_DONE, caption='cap b')
+    assert export_captions(manifest, csv_path, str, append_since=second_run) == 1
+    assert read_rows(csv_path) == ['file_name|caption', 'a|cap a', 'b|cap b']
+    manifest.close()
@@ -1,72 +1,173 @@
 import torch
 import argparse
-from safetensors.torch import load_file, save_file, safe_open
+import re
 from tqdm import tqdm
 import os
 
+from safetensors_io import LazySafetensors, SafetensorsWriter, torch_dtype
+
+MERGE_MODES = ['add_difference', 'weighted']
+FLOAT_DTYPES = {'F16', 'BF16', 'F32', 'F64', 'F8_E4M3', 'F8_E5M2'}
+DEFAULT_BLOCK_PATTERN = r'(?:^|\.)blocks\.(\d+)\.'
+
+
+def parse_block_weights(spec: str):
+    """'0-9:0.5,30+:1.2,12:0' -> [(primeiro, último, peso)]; 'N+' vai até o último bloco."""
+    rules = []
+    if not spec:
+        return rules
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        blocks, _, weight = part.partition(':')
+        if not weight:
+            raise ValueError(f"Peso por bloco inválido '{part}' (use BLOCOS:PESO, ex. 0-9:0.5 ou 30+:1.2)")
+        blocks = blocks.strip()
+        if blocks.endswith('+'):
+            first, last = int(blocks[:-1]), None
+        elif '-' in blocks:
+            first, last = (int(b) for b in blocks.split('-', 1))
+        else:
+            first = last = int(blocks)
+        rules.append((first, last, float(weight)))
+    return rules
+
+
+def weight_for_key(key: str, default: float, block_weights, block_re) -> float:
+    """Peso da camada: a última regra de bloco que casar vence; camadas fora de blocos usam o peso global."""
+    if not block_weights:
+        return default
+    match = block_re.search(key)
+    if not match:
+        return default
+    block = int(match.group(1))
+    weight = default
+    for first, last, value in block_weights:
+        if block >= first and (last is None or block <= last):
+            weight = value
+    return weight
+
+
+def merge_chunks(base, tuned, reference, key: str, mode: str, weight: float, device: str, out_dtype, chunk_elems: int):
+    """Calcula a camada mesclada em pedaços lidos do mmap; só um pedaço de cada entrada fica em memória."""
+    base_chunks = base.iter_chunks(key, chunk_elems)
+    tuned_chunks = tuned.iter_chunks(key, chunk_elems)
+    ref_chunks = reference.iter_chunks(key, chunk_elems) if reference is not None else None
+    for base_chunk, tuned_chunk in zip(base_chunks, tuned_chunks):
+        base_chunk = base_chunk.to(device)
+        tuned_chunk = tuned_chunk.to(device)
+        if mode == 'weighted':
+            # (1 - w) * base + w * tuned, sem temporário extra
+            out = base_chunk.mul_(1.0 - weight).add_(tuned_chunk, alpha=weight)
+        else:
+            # base + w * (tuned - referência); sem referência, a referência é a própria base
+            ref_chunk = next(ref_chunks).to(device) if ref_chunks is not None else base_chunk
+            out = base_chunk.add_(tuned_chunk.sub_(ref_chunk), alpha=weight)
+        yield out.to(dtype=out_dtype, device='cpu')
+
+
+def plan_merge(base, tuned, reference, mode: str, weight: float, block_weights, block_re):
+    """Decide, só pelos headers, o que acontece com cada camada da saída.
+
+    Retorna [(nome, ação, origem, peso)] na ordem da base seguida das camadas novas do tuned. Camadas
+    cujo resultado é idêntico a uma das entradas (peso 0 ou 1 com o mesmo dtype) viram cópia de bytes.
+    """
+    plan = []
+    for key, info in base.tensors.items():
+        if key not in tuned:
+            plan.append((key, 'copy', base, None))
+            continue
+        tuned_info = tuned.info(key)
+        if tuned_info.shape != info.shape:
+            # Formato diferente: mantém a camada do tuned como está (e o dtype dela)
+            plan.append((key, 'copy', tuned, None))
+            continue
+        w = weight_for_key(key, weight, block_weights, block_re)
+        if info.dtype not in FLOAT_DTYPES or tuned_info.dtype not in FLOAT_DTYPES:
+            # Inteiros/bool (position ids, índices) não se mesclam: peso 0 mantém a base, qualquer outro usa o tuned
+            source = base if w == 0 else tuned
+            print(f"  ℹ️ {key}: dtype {tuned_info.dtype if source is tuned else info.dtype} não é float, "
+                  f"copiado do {'tuned' if source is tuned else 'base'} em vez de mesclado.")
+            plan.append((key, 'copy', source, None))
+            continue
+        if reference is not None and (key not in reference or reference.info(key).shape != info.shape):
+            plan.append((key, 'copy', base, None))
+            continue
+        if w == 0:
+            plan.append((key, 'copy', base, None))
+        elif w == 1 and reference is None and tuned_info.dtype == info.dtype:
+            plan.append((key, 'copy', tuned, None))
+        else:
+            plan.append((key, 'merge', None, w))
+    for key in tuned.keys():
+        if key not in base:
+            plan.append((key, 'copy', tuned, None))
+    return plan
+
+
 def upgrade_model_final(
     base_model_path: str,
     tuned_model_path: str,
     output_path: str,
     device: str,
+    mode: str = 'add_difference',
+    weight: float = 1.0,
+    reference_model_path: str = None,
+    block_weights: str = None,
+    block_pattern: str = DEFAULT_BLOCK_PATTERN,
+    chunk_mb: int = 256,
 ):
-    print(f"--- Fase 1: Carregando Modelo Base na Memória ---")
+    print(f"--- Fase 1: Lendo Headers ---")
     print(f"  Base: {base_model_path}")
-    final_sd = load_file(base_model_path, device="cpu")
-    base_keys = set(final_sd.keys())
-    print(f"  Modelo base carregado. {len(base_keys)} camadas.")
-
-    print(f"\n--- Fase 2: Aplicando Diferença via Streaming (Preservando dtype) ---")
-    print(f"  Modelo a ser aplicado (streaming): {tuned_model_path}")
-    
-    with safe_open(tuned_model_path, framework="pt", device="cpu") as f_tuned:
-        tuned_keys = set(f_tuned.keys())
-        
-        common_keys = base_keys & tuned_keys
-        for key in tqdm(common_keys, desc="  Atualizando camadas comuns"):
-            
-            # --- CORREÇÃO DE PRECISÃO AQUI ---
-            # 1. Lembre-se do dtype original
-            original_dtype = final_sd[key].dtype
-            
-            # 2. Faça o cálculo em float32 para precisão
-            base_tensor = final_sd[key].to(device=device, dtype=torch.float32)
-            tuned_tensor = f_tuned.get_tensor(key).to(device=device, dtype=torch.float32)
-
-            if base_tensor.shape != tuned_tensor.shape:
-                final_sd[key] = f_tuned.get_tensor(key).clone().to('cpu') # Mantém o dtype do tuned
-                continue
-
-            diff = tuned_tensor - base_tensor
-            
-            # 3. Converta o resultado de volta para o dtype original antes de salvar
-            final_sd[key] = (base_tensor + diff).to(dtype=original_dtype, device='cpu')
-            # ------------------------------------
-
-        new_keys = tuned_keys - base_keys
-        if new_keys:
-            print(f"\n--- Adicionando {len(new_keys)} Camadas Novas ---")
-            for key in tqdm(new_keys, desc="  Adicionando camadas novas"):
-                final_sd[key] = f_tuned.get_tensor(key).clone().to('cpu')
-
-    print("\n--- Fase 3: Salvando o Modelo Final ---")
-    output_dir = os.path.dirname(output_path)
-    os.makedirs(output_dir, exist_ok=True)
+    print(f"  Tuned: {tuned_model_path}")
+    base = LazySafetensors(base_model_path)
+    tuned = LazySafetensors(tuned_model_path)
+    reference = None
+    if reference_model_path:
+        if mode != 'add_difference':
+            raise ValueError("--reference_model só faz sentido com --mode add_difference")
+        print(f"  Referência: {reference_model_path}")
+        reference = LazySafetensors(reference_model_path)
+
+    rules = parse_block_weights(block_weights)
+    plan = plan_merge(base, tuned, reference, mode, weight, rules, re.compile(block_pattern))
+    merged = sum(1 for _, action, _, _ in plan if action == 'merge')
+    new_keys = sum(1 for key, _, _, _ in plan if key not in base)
+    print(f"  {len(base)} camadas na base, {len(tuned)} no tuned: {merged} mescladas, "
+          f"{len(plan) - merged} copiadas direto ({new_keys} novas).")
+    if mode == 'weighted':
+        print(f"  Modo: weighted -> (1 - {weight}) * base + {weight} * tuned")
+    else:
+        ref_name = 'referência' if reference is not None else 'base'
+        print(f"  Modo: add_difference -> base + {weight} * (tuned - {ref_name})")
+    if rules:
+        print(f"  Pesos por bloco: {block_weights}")
+
+    print(f"\n--- Fase 2: Mesclando em Streaming (Preservando dtype) ---")
+    # Por elemento: pedaços float32 de até três entradas, mais o pedaço convertido da saída
+    chunk_elems = max(1, chunk_mb * 1024 * 1024 // 16)
+    entries = []
+    for key, action, source, _ in plan:
+        info = source.info(key) if action == 'copy' else base.info(key)
+        entries.append((key, info.dtype, info.shape))
+
     print(f"💾 Salvando modelo completo e atualizado em: {output_path}")
-    
-    metadata = {}
     try:
-        with open(tuned_model_path, 'rb') as f:
-            header_size = int.from_bytes(f.read(8), 'little')
-            if header_size > 0:
-                import json
-                header_data = json.loads(f.read(header_size).decode('utf-8'))
-                if "__metadata__" in header_data:
-                    metadata = header_data["__metadata__"]
-    except Exception as e:
-        print(f"Não foi possível ler metadados: {e}")
-
-    save_file(final_sd, output_path, metadata=metadata)
+        with SafetensorsWriter(output_path, entries, metadata=tuned.metadata) as writer:
+            for key, action, source, w in tqdm(plan, desc="  Escrevendo camadas"):
+                if action == 'copy':
+                    writer.copy_tensor(key, source, key)
+                else:
+                    out_dtype = torch_dtype(base.info(key).dtype)
+                    writer.write_chunks(key, merge_chunks(base, tuned, reference, key, mode, w, device,
+                                                          out_dtype, chunk_elems))
+    finally:
+        base.close()
+        tuned.close()
+        if reference is not None:
+            reference.close()
+
     print("\n✅ Processo concluído com sucesso! O tamanho do arquivo deve ser o correto.")
 
 def main():
@@ -75,6 +176,17 @@ def main():
     parser.add_argument("--tuned_model", type=str, required=True)
     parser.add_argument("--output_path", type=str, required=True)
     parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--mode", type=str, default="add_difference", choices=MERGE_MODES,
+                        help="add_difference: base + peso * (tuned - referência); weighted: (1 - peso) * base + peso * tuned.")
+    parser.add_argument("--weight", type=float, default=1.0,
+                        help="Multiplicador/alpha global. Com add_difference e peso 1 o resultado é o tuned no dtype da base.")
+    parser.add_argument("--reference_model", type=str, default=None,
+                        help="Modelo subtraído no add_difference (padrão: a própria base).")
+    parser.add_argument("--block_weights", type=str, default=None,
+                        help="Pesos por bloco, ex. '0-9:0.5,30+:1.2'. Substituem --weight nesses blocos.")
+    parser.add_argument("--block_pattern", type=str, default=DEFAULT_BLOCK_PATTERN,
+                        help="Regex com um grupo capturando o índice do bloco no nome da camada.")
+    parser.add_argument("--chunk_mb", type=int, default=256, help="Memória de trabalho por pedaço ao mesclar.")
     args = parser.parse_args()
 
     upgrade_model_final(
@@ -82,7 +194,13 @@ def main():
         tuned_model_path=args.tuned_model,
         output_path=args.output_path,
         device=args.device,
+        mode=args.mode,
+        weight=args.weight,
+        reference_model_path=args.reference_model,
+        block_weights=args.block_weights,
+        block_pattern=args.block_pattern,
+        chunk_mb=args.chunk_mb,
     )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,25 +1,23 @@
-import torch
-from safetensors.torch import load_file
 import argparse
+from safetensors_io import LazySafetensors
 
 def format_shape(shape):
     return "[" + " ".join(f"{s:,}".replace(",", " ") for s in shape) + "]"
 
-def get_dtype(tensor):
-    return "BF16" if tensor.dtype == torch.bfloat16 else "F32" if tensor.dtype == torch.float32 else str(tensor.dtype).upper()
-
 def visualize_lora(file_path):
-    state_dict = load_file(file_path)
+    # Only the header is needed for names, shapes and dtypes
+    state_dict = LazySafetensors(file_path)
     hierarchy = {}
 
-    for key, tensor in state_dict.items():
+    for key in sorted(state_dict.keys()):
+        info = state_dict.info(key)
         parts = key.split(".")
         current = hierarchy
         for p in parts[:-1]:
             current = current.setdefault(p, {})
         current[parts[-1]] = {
-            "shape": format_shape(tensor.shape),
-            "dtype": get_dtype(tensor)
+            "shape": format_shape(info.shape),
+            "dtype": info.dtype
         }
 
     def print_recursive(tree, prefix=""):
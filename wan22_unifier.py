@@ -10,6 +10,7 @@ import os
 from pathlib import Path
 import json
 from datetime import datetime
+from safetensors_io import LazySafetensors, write_from_sources
 
 def load_model_safely(model_path):
     """
@@ -31,6 +32,64 @@ def load_model_safely(model_path):
         print(f"❌ Error loading {model_path}: {e}")
         return None
 
+def is_safetensors(*paths):
+    return all(path.endswith('.safetensors') for path in paths)
+
+def build_unified_metadata(high_noise_path, low_noise_path, threshold):
+    return {
+        '__wan22_unified_metadata__': {
+            'version': '1.0.0',
+            'created_at': datetime.now().isoformat(),
+            'high_noise_model': os.path.basename(high_noise_path),
+            'low_noise_model': os.path.basename(low_noise_path),
+            'default_threshold': threshold,
+            'description': 'WAN 2.2 Unified Model - Contains both High and Low Noise models'
+        },
+        '__wan22_threshold_config__': {
+            'default': threshold,
+            'recommended': {
+                'general': 0.5,
+                'high_detail': 0.3,
+                'fast_generation': 0.7,
+                'artistic': 0.4,
+                'photorealistic': 0.6
+            }
+        }
+    }
+
+def create_unified_model_streaming(high_noise_path, low_noise_path, output_path, threshold=0.5):
+    """
+    Unifica sem carregar os modelos: o header de saída é montado a partir dos headers de entrada
+    e os bytes de cada tensor são copiados direto dos arquivos mapeados em memória
+    """
+    try:
+        high_noise_model = LazySafetensors(high_noise_path)
+        low_noise_model = LazySafetensors(low_noise_path)
+    except Exception as e:
+        print(f"❌ Error reading model headers: {e}")
+        return False
+    
+    plan = [(f'high_noise.{key}', high_noise_model, key) for key in high_noise_model.keys()]
+    plan += [(f'low_noise.{key}', low_noise_model, key) for key in low_noise_model.keys()]
+    metadata = {k: json.dumps(v) for k, v in build_unified_metadata(high_noise_path, low_noise_path, threshold).items()}
+    
+    print(f"🔗 Unified model plan:")
+    print(f"   - High Noise keys: {len(high_noise_model)}")
+    print(f"   - Low Noise keys: {len(low_noise_model)}")
+    print(f"   - Total size: {high_noise_model.total_params() + low_noise_model.total_params():,} parameters")
+    
+    print(f"💾 Streaming unified model to: {output_path}")
+    try:
+        written = write_from_sources(output_path, plan, metadata)
+        print(f"✅ Unified model saved successfully! ({written / 1024**3:.2f} GB of tensor data)")
+        return True
+    except Exception as e:
+        print(f"❌ Error saving unified model: {e}")
+        return False
+    finally:
+        high_noise_model.close()
+        low_noise_model.close()
+
 def create_unified_model(high_noise_path, low_noise_path, output_path, threshold=0.5):
     """
     Cria um modelo unificado contendo ambos os modelos
@@ -38,6 +97,9 @@ def create_unified_model(high_noise_path, low_noise_path, output_path, threshold
     print("🎭 WAN 2.2 Model Unifier")
     print("=" * 50)
     
+    if is_safetensors(high_noise_path, low_noise_path, output_path):
+        return create_unified_model_streaming(high_noise_path, low_noise_path, output_path, threshold)
+    
     # Carrega os modelos
     high_noise_model = load_model_safely(high_noise_path)
     low_noise_model = load_model_safely(low_noise_path)
@@ -47,16 +109,10 @@ def create_unified_model(high_noise_path, low_noise_path, output_path, threshold
         return False
     
     # Cria o modelo unificado
+    metadata = build_unified_metadata(high_noise_path, low_noise_path, threshold)
     unified_model = {
         # Metadata do modelo unificado
-        '__wan22_unified_metadata__': {
-            'version': '1.0.0',
-            'created_at': datetime.now().isoformat(),
-            'high_noise_model': os.path.basename(high_noise_path),
-            'low_noise_model': os.path.basename(low_noise_path),
-            'default_threshold': threshold,
-            'description': 'WAN 2.2 Unified Model - Contains both High and Low Noise models'
-        },
+        '__wan22_unified_metadata__': metadata['__wan22_unified_metadata__'],
         
         # Modelo High Noise com prefixo
         **{f'high_noise.{key}': value for key, value in high_noise_model.items()},
@@ -65,16 +121,7 @@ def create_unified_model(high_noise_path, low_noise_path, output_path, threshold
         **{f'low_noise.{key}': value for key, value in low_noise_model.items()},
         
         # Configurações de threshold
-        '__wan22_threshold_config__': {
-            'default': threshold,
-            'recommended': {
-                'general': 0.5,
-                'high_detail': 0.3,
-                'fast_generation': 0.7,
-                'artistic': 0.4,
-                'photorealistic': 0.6
-            }
-        }
+        '__wan22_threshold_config__': metadata['__wan22_threshold_config__']
     }
     
     print(f"🔗 Unified model created:")
@@ -105,12 +152,35 @@ def create_unified_model(high_noise_path, low_noise_path, output_path, threshold
         print(f"❌ Error saving unified model: {e}")
         return False
 
+def extract_model_streaming(unified_path, model_type, output_path):
+    """
+    Extrai copiando apenas os bytes dos tensores com o prefixo escolhido
+    """
+    prefix = f'{model_type}_noise.'
+    try:
+        with LazySafetensors(unified_path) as unified_model:
+            plan = [(key[len(prefix):], unified_model, key) for key in unified_model.keys() if key.startswith(prefix)]
+            if not plan:
+                print(f"❌ No {model_type} model found in unified file!")
+                return False
+            write_from_sources(output_path, plan)
+        
+        print(f"✅ {model_type.title()} model extracted to: {output_path} ({len(plan)} keys)")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Error extracting model: {e}")
+        return False
+
 def extract_model_from_unified(unified_path, model_type, output_path):
     """
     Extrai um modelo específico do arquivo unificado
     """
     print(f"📤 Extracting {model_type} model from unified file")
     
+    if is_safetensors(unified_path, output_path):
+        return extract_model_streaming(unified_path, model_type, output_path)
+    
     try:
         if unified_path.endswith('.safetensors'):
             from safetensors.torch import load_file
@@ -155,10 +225,16 @@ def inspect_unified_model(unified_path):
     
     try:
         if unified_path.endswith('.safetensors'):
-            from safetensors.torch import load_file
-            unified_model = load_file(unified_path)
+            # Só o header: nomes das keys e o __metadata__ onde ficam as configurações
+            with LazySafetensors(unified_path) as header:
+                unified_model = dict.fromkeys(header.keys())
+                unified_model.update(header.metadata)
         else:
-            unified_model = torch.load(unified_path, map_location='cpu')
+            try:
+                unified_model = torch.load(unified_path, map_location='cpu', mmap=True)
+            except (RuntimeError, TypeError):
+                # Formato legado (não-zip) não pode ser mapeado em memória; torch antigo nem aceita mmap
+                unified_model = torch.load(unified_path, map_location='cpu')
         
         # Conta os tipos de keys
         high_noise_keys = [k for k in unified_model.keys() if k.startswith('high_noise.')]